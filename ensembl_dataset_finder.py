@@ -10,22 +10,11 @@ Usage:
   python ensembl_dataset_finder.py --interactive
 """
 
-import requests
-import xml.etree.ElementTree as ET
 import argparse
-import os
 import time
-import sys
 from datetime import datetime
 import logging
 
-# Configure logging
-logging.basicConfig(
-    filename=f'ensembl_dataset_search_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-
 # Define Ensembl API endpoints
 ENSEMBL_APIS = {
     'Ensembl': 'https://www.ensembl.org',
@@ -40,6 +29,10 @@ def get_registry_info(api_base):
     """
     Get BioMart registry information for a specific Ensembl API
     """
+    # Imported here so importing this module stays cheap
+    import requests
+    import xml.etree.ElementTree as ET
+
     api_name = next((name for name, url in ENSEMBL_APIS.items() if url == api_base), "Unknown API")
     registry_url = f"{api_base}/biomart/martservice?type=registry"
     
@@ -325,9 +318,18 @@ def parse_arguments():
     
     return parser.parse_args()
 
+def configure_logging():
+    """Log to a timestamped file; only called when run as a script"""
+    logging.basicConfig(
+        filename=f'ensembl_dataset_search_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log',
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
 def main():
     """Main function"""
     args = parse_arguments()
+    configure_logging()
     
     # Get species list
     species_list = []
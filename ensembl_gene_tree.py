@@ -4,35 +4,106 @@ import json
 import os
 import time
 import signal
-import xml.etree.ElementTree as ET
+import threading
 import argparse
+import functools
+import itertools
+import math
+import random
+import re
 from datetime import datetime
 import logging
-from tqdm import tqdm
-import timeout_decorator
-import urllib3
 import sys
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+import ensembl_transport
+from ensembl_transport import get_transport, select_mirrors, CircuitOpenError, MIRROR_CHOICE_FILE, HEDGE_MAX_EXTRA
+from gene_tree_traversal import walk_gene_tree, summarize_gene_tree
+from gene_tree_index import GeneTreeIndex, DEFAULT_INDEX_FILE
+from gene_manifest import GeneManifest, ProcessedGenes
+from gene_tree_store import open_tree_writer, gene_file_identifier, atomic_write, OUTPUT_LAYOUTS, DEFAULT_SHARD_SIZE
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# Importing this module does no I/O: logging and warning filters are set up
+# by configure_logging() from the command line entry point, and tqdm,
+# timeout_decorator and ElementTree are imported on first use
 
 # Global variables to track progress
 last_processed_gene = None
 processed_genes = set()
 total_genes = 0
-current_gene_number = 0
+retry_queue = None
 
-# Configure logging
-logging.basicConfig(
-    filename=f'ensembl_gene_tree_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log',
-    level=logging.DEBUG,  # Changed from INFO to DEBUG for more detailed logs
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Set by a signal or the deadline: stop dispatching genes and drain
+stop_event = threading.Event()
+run_deadline = None
+# One worker reports an outage and waits it out; the others queue behind it
+_ensembl_wait_lock = threading.Lock()
+
+# Exit status of a run that stopped early but can be resumed (EX_TEMPFAIL)
+EXIT_RESUMABLE = 75
+DEFAULT_DRAIN_MARGIN = 600
+
+# Failed genes are retried with exponential backoff before being given up on
+MAX_GENE_ATTEMPTS = 5
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 1800
+DEAD_LETTER_FILE = 'dead_letter.tsv'
+
+# Gene IDs in the order the checkpoint's processed bitmap indexes, kept next
+# to checkpoint.json so the bitmap survives a re-sorted or regenerated list
+GENE_ORDER_FILE = 'checkpoint_genes.txt'
+
+# One JSON line per species run: genes processed, elapsed time, peak memory,
+# requests and bytes received
+RUN_STATS_FILE = 'gene_tree_run_stats.jsonl'
+
+# Used until a run has been measured: one gene every two seconds per worker
+# (the one second pause after each gene plus the lookup and tree requests)
+DEFAULT_GENES_PER_SECOND = 0.5
+DEFAULT_BYTES_PER_REQUEST = 64 * 1024
+
+# --quiet replaces per-gene console output with one progress line per interval
+DEFAULT_PROGRESS_INTERVAL = 30
+quiet = False
+# Set when run as a script: library use (gene_tree_client) gets progress messages
+# through logging only, never on stdout
+console = False
+progress = None
+progress_interval = DEFAULT_PROGRESS_INTERVAL
+
+# Fields of per-gene log records, written as keys by the JSON log format
+GENE_LOG_FIELDS = ('gene_id', 'status', 'compara', 'tree_id', 'from_index', 'attempts', 'error')
+
+# Gene lists longer than this are fetched as parallel per-chromosome queries
+BIOMART_CHUNK_GENES = 20000
+BIOMART_WORKERS = 4
+
+# Gene manifest columns beyond gene ID and name, and the BioMart attribute
+# each comes from; datasets that lack an attribute simply leave it out
+MANIFEST_ATTRIBUTES = {
+    'description': 'description',
+    'chromosome': 'chromosome_name',
+    'start': 'start_position',
+    'end': 'end_position',
+    'strand': 'strand',
+    'canonical_transcript': 'ensembl_transcript_id',
+    'gene_tree_id': 'gene_tree_stable_id'
+}
+# Transcript attributes give one row per transcript; this filter keeps only
+# each gene's canonical one, so a manifest stays one row per gene
+CANONICAL_FILTER = 'transcript_is_canonical'
+DEFAULT_MANIFEST_COLUMNS = list(MANIFEST_ATTRIBUTES)
+
+# Species that must be looked up in a specific division
+SPECIES_API_MAPPING = {
+    "Ciona savignyi": "Metazoa",
+    # Add other specific mappings if needed
+}
 
 # Define Ensembl API endpoints
 ENSEMBL_APIS = {
     'Ensembl': {
         'rest': 'https://rest.ensembl.org',
-        'mart': 'https://asia.ensembl.org/biomart/martservice'
+        'mart': 'https://www.ensembl.org/biomart/martservice'
     },
     'Metazoa': {
         'rest': 'https://rest.ensemblgenomes.org',
@@ -52,6 +123,67 @@ ENSEMBL_APIS = {
     }
 }
 
+class JsonLogFormatter(logging.Formatter):
+    """
+    One JSON object per log record, with the per-gene fields as keys
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage().strip()
+        }
+        for field in GENE_LOG_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def configure_logging(log_file=None, level='DEBUG', log_format='text'):
+    """
+    Log to log_file (nowhere if None) and silence the warnings for
+    verify=False requests. Only called when run as a script.
+    """
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    if log_file is None:
+        # Keeps library warnings off the console as well
+        logging.getLogger().addHandler(logging.NullHandler())
+        return
+    handler = logging.FileHandler(log_file)
+    if log_format == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logging.basicConfig(level=level, handlers=[handler])
+
+def timeout(seconds):
+    """
+    timeout_decorator.timeout(seconds), with timeout_decorator imported on
+    the first call of the decorated function instead of at import
+    """
+    def decorator(func):
+        timed = None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            nonlocal timed
+            if timed is None:
+                import timeout_decorator
+                timed = timeout_decorator.timeout(seconds)(func)
+            return timed(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timeout_error():
+    """
+    Exception class raised by timeout(), for except clauses and isinstance
+    """
+    import timeout_decorator
+    return timeout_decorator.TimeoutError
+
 def request_with_retry(url, headers=None, max_retries=3, initial_backoff=1):
     """Make requests with exponential backoff retry logic"""
     if headers is None:
@@ -60,7 +192,7 @@ def request_with_retry(url, headers=None, max_retries=3, initial_backoff=1):
     retries = 0
     while retries < max_retries:
         try:
-            response = requests.get(url, headers=headers, verify=False, timeout=60)
+            response = get_transport().get(url, headers=headers, verify=False, timeout=60)
             return response
         except requests.RequestException as e:
             wait_time = initial_backoff * (2 ** retries)
@@ -72,25 +204,35 @@ def request_with_retry(url, headers=None, max_retries=3, initial_backoff=1):
     logging.error(f"All {max_retries} requests failed for {url}")
     return None
 
-def get_registry_info(api_key):
+# Parsed registries by registry URL; a species list looks each one up once
+_registry_cache = {}
+
+def get_registry_info(api_key, transport=None, cache=None):
     """
     Get BioMart registry information for a specific Ensembl API
     Returns: (mart_name, virtual_schema, datasets) or (None, None, []) on error
+    Registries are kept in cache, by default the one shared by the script.
     """
     if api_key not in ENSEMBL_APIS:
         logging.error(f"Unknown API key: {api_key}")
         return None, None, []
         
-    api_base = ENSEMBL_APIS[api_key]['mart']
+    transport = transport or get_transport()
+    # Use whichever mirror select_mirrors() found fastest
+    api_base = transport.preferred_url(ENSEMBL_APIS[api_key]['mart'])
     registry_url = f"{api_base}?type=registry"
+    cache = _registry_cache if cache is None else cache
+    if registry_url in cache:
+        return cache[registry_url]
     
     try:
-        response = requests.get(registry_url, timeout=30)
+        response = transport.get(registry_url, timeout=30)
         response.raise_for_status()
         
         # Parse the XML registry
         registry_xml = response.text
         
+        import xml.etree.ElementTree as ET
         try:
             root = ET.fromstring(registry_xml)
         except ET.ParseError as e:
@@ -143,7 +285,7 @@ def get_registry_info(api_key):
         # Get datasets for this mart - KEY FIX: Handle TSV response
         datasets_url = f"{api_base}?type=datasets&mart={gene_mart['name']}"
         
-        response = requests.get(datasets_url, timeout=30)
+        response = transport.get(datasets_url, timeout=30)
         response.raise_for_status()
         
         # Parse the datasets - TSV format, NOT XML
@@ -164,7 +306,8 @@ def get_registry_info(api_key):
                     })
         
         logging.info(f"Found {len(datasets)} datasets in {api_key}")
-        return gene_mart['name'], gene_mart['virtualSchema'], datasets
+        cache[registry_url] = (gene_mart['name'], gene_mart['virtualSchema'], datasets)
+        return cache[registry_url]
         
     except requests.exceptions.RequestException as e:
         logging.error(f"Network error fetching registry from {api_key}: {e}")
@@ -237,7 +380,7 @@ def find_dataset_for_species(scientific_name, datasets):
     
     return None, 0
 
-def search_species_dataset(species_name):
+def search_species_dataset(species_name, transport=None, registry_cache=None):
     """
     Search for a species dataset across Ensembl APIs
     Returns a dictionary with API details and dataset information
@@ -245,10 +388,10 @@ def search_species_dataset(species_name):
     matches = []
     
     for api_key, api_urls in ENSEMBL_APIS.items():
-        print(f"Searching for {species_name} in {api_key}...")
+        report(f"Searching for {species_name} in {api_key}...")
         
         # Get registry information
-        mart_name, virtual_schema, datasets = get_registry_info(api_key)
+        mart_name, virtual_schema, datasets = get_registry_info(api_key, transport, registry_cache)
         
         if datasets:
             # Find matching dataset
@@ -270,97 +413,245 @@ def search_species_dataset(species_name):
     
     if matches:
         best_match = matches[0]
-        print(f"Found best match for {species_name}: {best_match['dataset']} in {best_match['api_key']} (score: {best_match['score']})")
+        report(f"Found best match for {species_name}: {best_match['dataset']} in {best_match['api_key']} (score: {best_match['score']})")
         return best_match
     else:
-        print(f"No matching dataset found for {species_name}")
+        report(f"No matching dataset found for {species_name}", logging.WARNING)
         return None
 
-def fetch_genes_from_biomart(species_api_info):
+def manifest_attributes(columns):
     """
-    FIXED: Fetch protein-coding genes from BioMart for a specific species
-    Handles TSV response format correctly
+    BioMart attributes requested after gene ID and name for manifest columns
+    """
+    return [MANIFEST_ATTRIBUTES[column] for column in columns]
+
+def biomart_attributes(species_api_info, transport):
+    """
+    Names of the attributes a dataset offers
+    """
+    mart_url = transport.preferred_url(species_api_info['mart_url'])
+    response = transport.get(f"{mart_url}?type=attributes&dataset={species_api_info['dataset']}", timeout=120)
+    response.raise_for_status()
+    return {line.split('\t')[0] for line in response.text.split('\n') if line.strip()}
+
+def available_manifest_columns(species_api_info, transport, columns):
+    """
+    The requested manifest columns the dataset can provide
+    """
+    try:
+        attributes = biomart_attributes(species_api_info, transport)
+        filters = biomart_filters(species_api_info, transport) if 'canonical_transcript' in columns else {}
+    except requests.exceptions.RequestException as e:
+        logging.warning(f"Could not list attributes of {species_api_info['dataset']}: {e}")
+        return []
+    available = [column for column in columns if MANIFEST_ATTRIBUTES[column] in attributes and
+                 (column != 'canonical_transcript' or CANONICAL_FILTER in filters)]
+    missing = [column for column in columns if column not in available]
+    if missing:
+        report(f"Dataset {species_api_info['dataset']} does not provide: {', '.join(missing)}", logging.WARNING)
+    return available
+
+def biomart_gene_query(species_api_info, count=False, filters=None, columns=()):
+    """
+    BioMart XML query for the protein-coding genes of a species; with
+    count=True BioMart answers with the number of genes only. filters maps
+    further filter names to values (comma-separated for lists); columns are
+    the manifest columns to add to gene ID and name.
     """
-    dataset = species_api_info['dataset']
-    mart_url = species_api_info['mart_url']
-    mart_name = species_api_info.get('mart_name', 'metazoa_mart')
     virtual_schema = species_api_info.get('virtual_schema', 'metazoa_mart')
-    
-    # Create BioMart XML query
-    xml_query = f'''<?xml version="1.0" encoding="UTF-8"?>
+    extra_attributes = ''.join(f'\n        <Attribute name="{name}" />' for name in manifest_attributes(columns))
+    extra_filters = ''.join(f'\n        <Filter name="{name}" value="{value}"/>'
+                            for name, value in (filters or {}).items())
+    if 'canonical_transcript' in columns:
+        extra_filters += f'\n        <Filter name="{CANONICAL_FILTER}" excluded="0"/>'
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE Query>
-<Query  virtualSchemaName="{virtual_schema}" formatter="TSV" header="0" uniqueRows="1" count="" datasetConfigVersion="0.6">
-    <Dataset name="{dataset}" interface="default">
+<Query  virtualSchemaName="{virtual_schema}" formatter="TSV" header="0" uniqueRows="1" count="{'1' if count else ''}" datasetConfigVersion="0.6">
+    <Dataset name="{species_api_info['dataset']}" interface="default">
         <Attribute name="ensembl_gene_id" />
-        <Attribute name="external_gene_name" />
-        <Filter name="biotype" value="protein_coding"/>
+        <Attribute name="external_gene_name" />{extra_attributes}
+        <Filter name="biotype" value="protein_coding"/>{extra_filters}
     </Dataset>
 </Query>'''
-    
-    print(f"Fetching genes from BioMart using dataset: {dataset}")
-    
+
+def count_genes_in_biomart(species_api_info, transport=None):
+    """
+    Number of protein-coding genes of a species, or None if BioMart does not
+    answer with a number
+    """
+    transport = transport or get_transport()
+    mart_url = transport.preferred_url(species_api_info['mart_url'])
     try:
-        # Post the XML query to BioMart
-        response = requests.post(
+        response = transport.post(
             mart_url,
-            data={'query': xml_query},
+            data={'query': biomart_gene_query(species_api_info, count=True)},
             headers={'Content-Type': 'application/x-www-form-urlencoded'},
-            timeout=300  # 5 minutes timeout
+            timeout=120
         )
         response.raise_for_status()
-        
-        # Parse the TSV response - NOT XML!
-        genes = []
-        lines = response.text.strip().split('\n')
-        
-        if not lines or lines[0].strip() == '':
-            print("Empty response from BioMart")
-            return []
-            
-        # Check if response contains an error message
-        if 'error' in response.text.lower() or 'exception' in response.text.lower():
-            print(f"BioMart error response: {response.text[:500]}")
-            return []
-            
-        print(f"BioMart returned {len(lines)} lines")
-        
-        # Parse TSV format
-        for line_num, line in enumerate(lines):
-            if line.strip():  # Skip empty lines
-                parts = line.split('\t')
-                if len(parts) >= 2:
-                    gene_id = parts[0].strip()
-                    gene_symbol = parts[1].strip() if parts[1].strip() else 'Unknown'
-                    
-                    if gene_id:  # Only add if gene_id is not empty
-                        genes.append({
-                            'gene_id': gene_id,
-                            'gene_symbol': gene_symbol,
-                            'ensembl_id': gene_id
-                        })
-                else:
-                    print(f"Warning: Line {line_num + 1} has unexpected format: {line}")
-        
-        print(f"Successfully parsed {len(genes)} genes from BioMart")
-        
-        # Filter out any genes without proper IDs
-        valid_genes = [g for g in genes if g['gene_id'] and g['gene_id'] != '']
-        
-        if len(valid_genes) != len(genes):
-            print(f"Filtered out {len(genes) - len(valid_genes)} genes with invalid IDs")
-        
-        return valid_genes
-        
+        return int(response.text.strip())
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Network error counting genes of {species_api_info['dataset']}: {e}")
+    except ValueError:
+        logging.error(f"Unexpected BioMart count response for {species_api_info['dataset']}: {response.text[:200]}")
+    return None
+
+def parse_biomart_genes(text, columns=()):
+    """
+    Genes of a TSV BioMart answer with gene ID and gene name columns followed
+    by the attributes of the manifest columns
+    """
+    genes = {}
+    for line_num, line in enumerate(text.strip().split('\n')):
+        if line.strip():  # Skip empty lines
+            parts = line.split('\t')
+            if len(parts) >= 2:
+                gene_id = parts[0].strip()
+                gene_symbol = parts[1].strip() if parts[1].strip() else 'Unknown'
+
+                if gene_id:  # Only add if gene_id is not empty
+                    gene = {
+                        'gene_id': gene_id,
+                        'gene_symbol': gene_symbol,
+                        'ensembl_id': gene_id
+                    }
+                    values = [value.strip() for value in parts[2:]] + [''] * len(columns)
+                    gene.update(zip(columns, values))
+                    genes.setdefault(gene_id, gene)
+            else:
+                report(f"Warning: Line {line_num + 1} has unexpected format: {line}", logging.WARNING)
+    return list(genes.values())
+
+def query_biomart_genes(species_api_info, transport, filters=None, columns=(), timeout=300):
+    """
+    Run one gene list query. Raises ValueError when BioMart answers with an
+    error message instead of rows.
+    """
+    mart_url = transport.preferred_url(species_api_info['mart_url'])
+    response = transport.post(
+        mart_url,
+        data={'query': biomart_gene_query(species_api_info, filters=filters, columns=columns)},
+        headers={'Content-Type': 'application/x-www-form-urlencoded'},
+        timeout=timeout
+    )
+    response.raise_for_status()
+    text = response.text
+    # BioMart reports errors as plain text instead of rows; only the start of
+    # the answer is checked since gene descriptions may mention errors
+    head = text.lstrip()[:200].lower()
+    if head.startswith('query error') or 'exception' in head:
+        raise ValueError(f"BioMart error response: {text[:500]}")
+    return parse_biomart_genes(text, columns)
+
+def biomart_filters(species_api_info, transport):
+    """
+    Filters a dataset offers, by name, with the listed values of each
+    """
+    mart_url = transport.preferred_url(species_api_info['mart_url'])
+    response = transport.get(f"{mart_url}?type=filters&dataset={species_api_info['dataset']}", timeout=120)
+    response.raise_for_status()
+    filters = {}
+    for line in response.text.split('\n'):
+        parts = line.split('\t')
+        if parts[0].strip():
+            values = parts[2].strip('[]') if len(parts) > 2 else ''
+            filters[parts[0]] = [value.strip() for value in values.split(',') if value.strip()]
+    return filters
+
+def biomart_chromosomes(species_api_info, transport):
+    """
+    Values of a dataset's chromosome_name filter, or [] if it has none
+    """
+    return biomart_filters(species_api_info, transport).get('chromosome_name', [])
+
+def fetch_genes_in_chunks(species_api_info, transport, expected, workers=BIOMART_WORKERS, columns=()):
+    """
+    Fetch a large gene list as concurrent queries over groups of chromosomes
+    Returns the merged genes, or None when the dataset cannot be split or the
+    chunks do not add up to the expected count.
+    """
+    try:
+        chromosomes = biomart_chromosomes(species_api_info, transport)
+    except requests.exceptions.RequestException as e:
+        logging.warning(f"Could not list chromosomes of {species_api_info['dataset']}: {e}")
+        return None
+    if len(chromosomes) < 2:
+        return None
+
+    # Round-robin so the large chromosomes, usually listed first, are spread out
+    chunk_count = min(len(chromosomes), max(workers, math.ceil(expected / BIOMART_CHUNK_GENES)))
+    chunks = [chromosomes[i::chunk_count] for i in range(chunk_count)]
+    report(f"Fetching {expected} genes as {chunk_count} queries over {len(chromosomes)} chromosomes "
+          f"({workers} at a time)")
+
+    genes = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(query_biomart_genes, species_api_info, transport,
+                                   {'chromosome_name': ','.join(chunk)}, columns)
+                   for chunk in chunks]
+        try:
+            # In submission order, so the gene list order does not depend on timing
+            for future in futures:
+                for gene in future.result():
+                    genes.setdefault(gene['gene_id'], gene)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            report(f"Chunked BioMart query failed: {e}", logging.WARNING)
+            for future in futures:
+                future.cancel()
+            return None
+
+    if len(genes) != expected:
+        report(f"Chunked queries returned {len(genes)} genes but BioMart counted {expected}", logging.WARNING)
+        return None
+    return list(genes.values())
+
+def fetch_genes_from_biomart(species_api_info, transport=None, workers=BIOMART_WORKERS,
+                            manifest_columns=DEFAULT_MANIFEST_COLUMNS):
+    """
+    Fetch the protein-coding genes of a species from BioMart
+
+    The genes are counted first. Datasets with more than BIOMART_CHUNK_GENES
+    genes are fetched as parallel per-chromosome queries, which are checked
+    against the count; anything else, or a failed split, is one query.
+    Each gene also gets those manifest_columns the dataset provides.
+    """
+    transport = transport or get_transport()
+    dataset = species_api_info['dataset']
+
+    report(f"Fetching genes from BioMart using dataset: {dataset}")
+    columns = available_manifest_columns(species_api_info, transport, manifest_columns) if manifest_columns else []
+    expected = count_genes_in_biomart(species_api_info, transport)
+    if expected is not None:
+        report(f"BioMart counts {expected} protein-coding genes")
+    if expected and expected > BIOMART_CHUNK_GENES and workers > 1:
+        genes = fetch_genes_in_chunks(species_api_info, transport, expected, workers, columns)
+        if genes is not None:
+            report(f"Successfully fetched {len(genes)} genes from BioMart")
+            return genes
+        report("Falling back to a single BioMart query")
+
+    try:
+        genes = query_biomart_genes(species_api_info, transport, columns=columns)
     except requests.exceptions.Timeout:
-        print("BioMart request timed out")
+        report("BioMart request timed out", logging.WARNING)
         return []
     except requests.exceptions.RequestException as e:
-        print(f"Network error fetching genes from BioMart: {e}")
+        report(f"Network error fetching genes from BioMart: {e}", logging.WARNING)
+        return []
+    except ValueError as e:
+        report(str(e), logging.WARNING)
         return []
     except Exception as e:
-        print(f"Error parsing BioMart response: {e}")
-        print(f"Response content (first 500 chars): {response.text[:500]}")
+        report(f"Error parsing BioMart response: {e}", logging.WARNING)
         return []
+
+    if not genes:
+        report("Empty response from BioMart", logging.WARNING)
+        return []
+    report(f"Successfully parsed {len(genes)} genes from BioMart")
+    if expected is not None and len(genes) != expected:
+        report(f"Warning: BioMart counted {expected} genes but returned {len(genes)}", logging.WARNING)
+    return genes
         
 def save_genes_to_csv(genes, species_name):
     """
@@ -375,15 +666,10 @@ def save_genes_to_csv(genes, species_name):
     try:
         with open(filename, 'w', newline='') as csvfile:
             fieldnames = ['gene_id', 'gene_symbol', 'ensembl_id']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            fieldnames += [column for column in MANIFEST_ATTRIBUTES if column in genes[0]]
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore', restval='')
             writer.writeheader()
-            
-            for gene in genes:
-                writer.writerow({
-                    'gene_id': gene['gene_id'],
-                    'gene_symbol': gene['gene_symbol'],
-                    'ensembl_id': gene['ensembl_id']
-                })
+            writer.writerows(genes)
         
         print(f"CSV file '{filename}' has been created with {len(genes)} genes.")
         return filename
@@ -392,6 +678,266 @@ def save_genes_to_csv(genes, species_name):
         print(f"Error saving genes to CSV: {e}")
         return None
 
+class GeneSelection:
+    """
+    Subset of a gene list chosen on the command line. A gene is selected
+    when it passes every filter given; sample then keeps a seeded random
+    sample of the selected genes, in gene list order. The selection is taken
+    from the full manifest once it is read, because checkpoints index the
+    whole gene list.
+    """
+
+    def __init__(self, gene_ids=None, symbols=None, symbol_regex=None, regions=None, sample=None, seed=0):
+        self.gene_ids = set(gene_ids) if gene_ids else None
+        # Symbols are matched case-insensitively: species differ in case conventions
+        self.symbols = {symbol.lower() for symbol in symbols} if symbols else None
+        self.symbol_pattern = re.compile(symbol_regex) if symbol_regex else None
+        self.regions = regions or []
+        self.sample = sample
+        self.seed = seed
+
+    def __bool__(self):
+        return bool(self.gene_ids is not None or self.symbols is not None or self.symbol_pattern
+                    or self.regions or self.sample)
+
+    def matches(self, gene):
+        if self.gene_ids is not None and gene['gene_id'] not in self.gene_ids:
+            return False
+        if self.symbols is not None and gene['gene_symbol'].lower() not in self.symbols:
+            return False
+        if self.symbol_pattern and not self.symbol_pattern.search(gene['gene_symbol']):
+            return False
+        if self.regions and not any(in_region(gene, region) for region in self.regions):
+            return False
+        return True
+
+    def select(self, manifest):
+        """
+        Indices of the selected genes of a GeneManifest, in gene list order
+        """
+        if self.regions and not {'chromosome', 'start', 'end'} <= set(manifest.columns):
+            raise ValueError("--region needs chromosome, start and end columns, which the gene list lacks; "
+                             "remove it to fetch a gene list with them (see --manifest-columns)")
+        selected = (index for index in range(len(manifest)) if self.matches(manifest.gene(index)))
+        if not self.sample:
+            return list(selected)
+        # Reservoir sample of indices, kept in gene list order
+        rng = random.Random(self.seed)
+        reservoir = []
+        for position, index in enumerate(selected):
+            if position < self.sample:
+                reservoir.append(index)
+            else:
+                slot = rng.randint(0, position)
+                if slot < self.sample:
+                    reservoir[slot] = index
+        return sorted(reservoir)
+
+def in_region(gene, region):
+    """
+    Whether a gene with manifest location columns overlaps a
+    (chromosome, start, end) region; start and end None mean the whole
+    chromosome
+    """
+    chromosome, start, end = region
+    if gene.get('chromosome') != chromosome:
+        return False
+    if start is None:
+        return True
+    try:
+        return int(gene['start']) <= end and int(gene['end']) >= start
+    except (KeyError, ValueError):
+        return False
+
+def gene_from_row(row, manifest_columns=()):
+    """
+    Gene dict of a gene list CSV row (gene_id, gene_symbol and the manifest
+    columns), or None if the row has no gene ID
+    """
+    gene_id = row.get('gene_id') or row.get('ensembl_id') or row.get('WBGeneID')
+    if not gene_id:
+        return None
+    gene = {
+        'gene_id': gene_id,
+        'gene_symbol': row.get('gene_symbol') or row.get('symbol') or gene_id
+    }
+    gene.update((column, row[column]) for column in manifest_columns)
+    return gene
+
+def read_gene_list(gene_csv_file):
+    """
+    GeneManifest of a gene list CSV with gene_id, gene_symbol and any
+    manifest columns
+    """
+    with open(gene_csv_file, 'r') as csvfile:
+        reader = csv.DictReader(csvfile)
+        fieldnames = reader.fieldnames or []
+        detail(f"CSV columns: {fieldnames}")
+        manifest_columns = [column for column in MANIFEST_ATTRIBUTES if column in fieldnames]
+        manifest = GeneManifest(manifest_columns)
+        for i, row in enumerate(reader):
+            if i < 5:  # Print first 5 rows for debugging
+                detail(f"Row {i+1}: {row}")
+
+            gene = gene_from_row(row, manifest_columns)
+            if gene is None:
+                print(f"Warning: No gene ID found for row: {row}")
+                continue
+            manifest.append(gene)
+        return manifest
+
+def genes_to_process(manifest, selection=None, gene_shard=None):
+    """
+    Manifest indices a run covers: the genes of a selection, or all of them,
+    split by --gene-shard. None means every gene.
+    """
+    indices = selection.select(manifest) if selection else None
+    if gene_shard:
+        # Every parts-th gene, so each part gets an even share of the list
+        part, parts = gene_shard
+        indices = (indices or range(len(manifest)))[part::parts]
+    return indices
+
+def read_name_list(value):
+    """
+    Names from a file (one per line) or a comma-separated list
+    """
+    if os.path.isfile(value):
+        with open(value, 'r') as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+def parse_region(value):
+    """
+    --region: CHROMOSOME or CHROMOSOME:START-END
+    """
+    chromosome, _, span = value.rpartition(':')
+    if chromosome and re.fullmatch(r'[\d,]+-[\d,]+', span):
+        start, end = (int(position.replace(',', '')) for position in span.split('-'))
+        if start > end:
+            raise argparse.ArgumentTypeError(f"region {value} ends before it starts")
+        return chromosome, start, end
+    return value, None, None
+
+def selection_from_args(args):
+    """
+    GeneSelection from the command line, or None when no filter is given
+    """
+    selection = GeneSelection(
+        gene_ids=read_name_list(args.gene_ids) if args.gene_ids else None,
+        symbols=read_name_list(args.gene_symbols) if args.gene_symbols else None,
+        symbol_regex=args.symbol_regex,
+        regions=args.region,
+        sample=args.sample,
+        seed=args.seed
+    )
+    return selection if selection else None
+
+def parse_manifest_columns(value):
+    """
+    --manifest-columns: comma-separated MANIFEST_ATTRIBUTES keys, or 'none'
+    """
+    if value.strip().lower() == 'none':
+        return []
+    columns = [column.strip() for column in value.split(',') if column.strip()]
+    unknown = [column for column in columns if column not in MANIFEST_ATTRIBUTES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown manifest columns {', '.join(unknown)}; "
+                                         f"choose from {', '.join(MANIFEST_ATTRIBUTES)}")
+    return columns
+
+def parse_gene_shard(value):
+    """
+    Parse "I/N" (part I of N, counting from 0) as (I, N)
+    """
+    try:
+        part, parts = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected PART/PARTS, e.g. 0/8, not {value!r}")
+    if parts < 1 or not 0 <= part < parts:
+        raise argparse.ArgumentTypeError(f"part must be between 0 and {parts - 1}")
+    return part, parts
+
+def species_output_dir(species_name, api_key, gene_shard=None):
+    """
+    Output directory of a species, or of one part of it when genes are split
+    across jobs with --gene-shard
+    """
+    species_dir = f"{species_name.replace(' ', '_')}_gene_tree_files_{api_key.lower()}"
+    if gene_shard:
+        part, parts = gene_shard
+        species_dir = f"{species_dir}_part{part:03d}of{parts:03d}"
+    return species_dir
+
+def record_run_stats(species_name, api_key, genes, seconds, workers, gene_shard=None, stats_file=RUN_STATS_FILE,
+                     requests_made=None, bytes_received=None):
+    """
+    Append the throughput of a species run to the run statistics used by
+    gene_tree_jobs.py plan
+    """
+    import resource
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    entry = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'species': species_name,
+        'api_key': api_key,
+        'genes': genes,
+        'seconds': round(seconds, 1),
+        'workers': workers,
+        'gene_shard': '/'.join(str(v) for v in gene_shard) if gene_shard else None,
+        'peak_rss_mb': round(peak_rss_mb, 1),
+        'requests': requests_made,
+        'bytes': bytes_received
+    }
+    try:
+        with open(stats_file, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    except OSError as e:
+        logging.warning(f"Could not record run statistics in {stats_file}: {e}")
+
+def load_run_stats(stats_file=RUN_STATS_FILE, workers=None):
+    """
+    Run statistics entries, restricted to runs with the given number of
+    workers when there are any
+    """
+    entries = []
+    try:
+        with open(stats_file, 'r') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        return []
+    matching = [e for e in entries if e.get('workers') == workers]
+    return matching or entries
+
+def measured_throughput(entries, workers):
+    """
+    Genes per second per run, weighted by run length
+    Returns (genes_per_second, measured) with measured False for the default.
+    """
+    genes = sum(e.get('genes', 0) for e in entries)
+    seconds = sum(e.get('seconds', 0) for e in entries)
+    if genes and seconds:
+        rate = genes / seconds
+        # Runs with a different worker count scale roughly linearly
+        measured_workers = round(sum(e.get('workers', 1) * e.get('seconds', 0) for e in entries) / seconds)
+        return rate * workers / max(measured_workers, 1), True
+    return DEFAULT_GENES_PER_SECOND * workers, False
+
+def measured_bytes_per_request(entries):
+    """
+    Mean response size over runs that recorded their traffic
+    """
+    recorded = [e for e in entries if e.get('requests') and e.get('bytes') is not None]
+    requests_made = sum(e['requests'] for e in recorded)
+    if not requests_made:
+        return DEFAULT_BYTES_PER_REQUEST, False
+    return sum(e['bytes'] for e in recorded) / requests_made, True
+
 def convert_to_ensembl_format(species_name):
     """
     Convert species name to Ensembl API format
@@ -426,8 +972,8 @@ def read_species_from_file(filename):
         return None
 
 # Function to fetch gene information from Ensembl with timeout
-@timeout_decorator.timeout(300)  # 5 minutes timeout
-def fetch_gene_info(gene_id, base_url):
+@timeout(300)  # 5 minutes timeout
+def fetch_gene_info(gene_id, base_url, transport=None):
     """Fetch gene information with better error handling"""
     lookup_url = f"{base_url}/lookup/id/{gene_id}?content-type=application/json"
     headers = {"Content-Type": "application/json", "Accept": "application/json"}
@@ -435,7 +981,7 @@ def fetch_gene_info(gene_id, base_url):
     logging.debug(f"Fetching gene info. URL: {lookup_url}")
     
     try:
-        response = requests.get(lookup_url, headers=headers, verify=False, timeout=60)
+        response = (transport or get_transport()).get(lookup_url, headers=headers, verify=False, timeout=60)
         logging.debug(f"Fetching gene info: Status Code {response.status_code}")
         
         if response.status_code == 200 and response.text.strip():
@@ -451,213 +997,507 @@ def fetch_gene_info(gene_id, base_url):
                 logging.error(f"Response: {response.text[:200]}...")
             return None
             
-    except (requests.RequestException, timeout_decorator.TimeoutError) as e:
+    except (requests.RequestException, timeout_error()) as e:
         logging.error(f"Request error fetching gene info: {e}")
         return None
 
-# Function to fetch gene tree information from Ensembl with timeout
-@timeout_decorator.timeout(300)  # 5 minutes timeout
-def fetch_gene_tree_info(gene_id, gene_symbol, species_name, base_url, timeout=30):
+# Compara database holding the gene trees of each division
+COMPARA_DATABASES = {
+    'Ensembl': 'vertebrates',
+    'Metazoa': 'metazoa',
+    'Plants': 'plants',
+    'Fungi': 'fungi',
+    'Protists': 'protists'
+}
+PAN_COMPARA_DATABASE = 'pan_homology'
+
+# Ways of finding a gene's tree, in default order: (strategy, endpoint, compara)
+# where compara None means the division's own database
+GENE_TREE_STRATEGIES = [
+    ('member_id', 'id', None),
+    ('member_symbol', 'symbol', None),
+    ('pan_member_id', 'id', PAN_COMPARA_DATABASE)
+]
+STRATEGY_STATS_FILE = 'compara_strategy_stats.json'
+STRATEGY_MIN_ATTEMPTS = 25
+# A disabled strategy is tried again this long after it was last rejected
+STRATEGY_REPROBE_SECONDS = 24 * 3600
+
+# Error messages of a /genetree request for a member Ensembl does not know,
+# as opposed to a known gene that is in no tree
+UNKNOWN_MEMBER_PATTERN = re.compile(r"unable to find|not found|no member|could not find (?!.*tree)")
+
+def get_compara_database(api_key):
     """
-    FIXED: Fetch gene tree information for a specific gene using the correct API endpoint
+    Name of the Compara database holding the gene trees of a division
+    """
+    return COMPARA_DATABASES.get(api_key, 'vertebrates')
+
+def request_gene_tree(url, gene_id, timeout=30, transport=None):
+    """
+    GET a /genetree endpoint and classify the outcome
+    Returns (outcome, data) with outcome 'found', 'missing' (the gene has no
+    tree), 'rejected' (the endpoint does not serve this request, e.g. a wrong
+    compara database) or 'failed' (a transient error worth retrying). A
+    member Ensembl does not know at all is 'unknown': another strategy, such
+    as the gene symbol, may still find its tree.
     """
-    # Convert species name to Ensembl format for API calls
-    species_ensembl_format = convert_to_ensembl_format(species_name)
-    
-    # For Metazoa API, we need to add compara parameter
-    if 'ensemblgenomes.org' in base_url:
-        compara_param = 'compara=metazoa'
-    else:
-        compara_param = ''
-    
-    # Primary endpoint: gene tree by member ID
-    primary_url = f"{base_url}/genetree/member/id/{species_ensembl_format}/{gene_id}"
-    if compara_param:
-        primary_url += f"?{compara_param}"
-    
     headers = {
         'Content-Type': 'application/json',
         'Accept': 'application/json'
     }
     
     try:
-        print(f"Fetching gene tree for {gene_id} from {primary_url}")
-        
-        # Try primary endpoint first
-        response = requests.get(primary_url, headers=headers, timeout=timeout)
+        response = (transport or get_transport()).get(url, headers=headers, timeout=timeout, hedge='genetree')
         
         if response.status_code == 200:
             try:
                 gene_tree_data = response.json()
-                if gene_tree_data and 'tree' in gene_tree_data:
-                    return gene_tree_data
-                else:
-                    print(f"No gene tree data found for {gene_id}")
-                    return None
             except json.JSONDecodeError:
-                print(f"Invalid JSON response for {gene_id}")
-                return None
-        elif response.status_code == 400:
-            print(f"Bad request for {gene_id} - possibly invalid gene ID format")
-            return None
-        elif response.status_code == 404:
-            print(f"Gene {gene_id} not found in gene trees")
-            return None
+                detail(f"Invalid JSON response for {gene_id}", gene_id)
+                return 'failed', None
+            if gene_tree_data and 'tree' in gene_tree_data:
+                return 'found', gene_tree_data
+            detail(f"No gene tree data found for {gene_id}", gene_id)
+            return 'missing', None
+        elif response.status_code in (400, 404):
+            # Ensembl answers 400 for genes without a tree, for unknown
+            # members and for a wrong compara database / species
+            message = response.text.lower()
+            if 'compara' in message or 'database' in message or 'species' in message:
+                detail(f"Endpoint rejected request for {gene_id}: {response.text[:200]}", gene_id)
+                return 'rejected', None
+            if UNKNOWN_MEMBER_PATTERN.search(message) or (response.status_code == 404 and 'tree' not in message):
+                detail(f"Member not found for {gene_id}: {response.text[:200]}", gene_id)
+                return 'unknown', None
+            detail(f"Gene {gene_id} has no gene tree", gene_id)
+            return 'missing', None
         else:
-            print(f"API returned status code {response.status_code} for {gene_id}")
-            return None
+            detail(f"API returned status code {response.status_code} for {gene_id}", gene_id)
+            # Server errors and rate limiting pass; other client errors do not
+            if response.status_code >= 500 or response.status_code == 429:
+                return 'failed', None
+            return 'rejected', None
             
+    except CircuitOpenError:
+        # Every mirror is down: not an answer about this gene or strategy
+        raise
     except requests.exceptions.Timeout:
-        print(f"Timeout fetching gene tree for {gene_id}")
-        return None
+        detail(f"Timeout fetching gene tree for {gene_id}", gene_id)
+        return 'failed', None
     except requests.exceptions.RequestException as e:
-        print(f"Network error fetching gene tree for {gene_id}: {e}")
-        return None
-    except Exception as e:
-        print(f"Unexpected error fetching gene tree for {gene_id}: {e}")
-        return None
+        detail(f"Network error fetching gene tree for {gene_id}: {e}", gene_id)
+        return 'failed', None
 
-# Function to process gene tree data
-def process_gene_tree(gene_id, gene_symbol, species_name, base_url, output_dir):
+class GeneTreeUnavailable(Exception):
     """
-    FIXED: Process gene tree information for a single gene
+    Raised when a gene's tree could not be looked up because of transient
+    errors, as opposed to Ensembl answering that the gene has no tree
     """
-    try:
-        gene_tree_info = fetch_gene_tree_info(gene_id, gene_symbol, species_name, base_url)
-        
-        if gene_tree_info:
-            # Save the gene tree data
-            file_identifier = gene_symbol if gene_symbol and gene_symbol.lower() != "unknown" else gene_id
-            output_file = os.path.join(output_dir, f'{file_identifier}_gene_tree.json')
-            
-            with open(output_file, 'w') as f:
-                json.dump(gene_tree_info, f, indent=2)
-            
-            print(f"Gene tree saved to {output_file}")
-            
-            # Also save a summary text file
-            summary_file = os.path.join(output_dir, f'{file_identifier}_gene_tree.txt')
-            with open(summary_file, 'w') as f:
-                f.write(f"Gene Tree Information for {gene_id} ({gene_symbol})\n")
-                f.write(f"Species: {species_name}\n")
-                f.write(f"Tree ID: {gene_tree_info.get('id', 'N/A')}\n")
-                f.write(f"Tree Type: {gene_tree_info.get('type', 'N/A')}\n")
-                
-                if 'tree' in gene_tree_info:
-                    tree_data = gene_tree_info['tree']
-                    f.write(f"Tree Structure: {tree_data.get('newick', 'N/A')}\n")
-                    
-                    # Count species in the tree
-                    if 'children' in tree_data:
-                        species_count = count_species_in_tree(tree_data)
-                        f.write(f"Species count in tree: {species_count}\n")
-            
-            return True
-        else:
-            # Create a "no tree" file
-            file_identifier = gene_symbol if gene_symbol and gene_symbol.lower() != "unknown" else gene_id
-            output_file = os.path.join(output_dir, f'{file_identifier}_gene_tree.txt')
-            
-            with open(output_file, 'w') as f:
-                f.write(f"No gene tree available for {gene_id} ({gene_symbol})\n")
-                f.write(f"Species: {species_name}\n")
-                f.write(f"This gene may not be included in comparative genomics analyses.\n")
-            
-            print(f"No gene tree available for {gene_id}. Written to {output_file}")
+
+class GeneTreeResolver:
+    """
+    Find a gene's tree in the right Compara database for its division
+
+    Strategies are tried in order of how often they settled a lookup for the
+    division, by finding the tree or, for the division's own Compara asked by
+    gene ID, by answering that there is none. A strategy the server has
+    rejected STRATEGY_MIN_ATTEMPTS times without it ever settling a lookup is
+    no longer attempted for that division, except for one probe every
+    STRATEGY_REPROBE_SECONDS. Timeouts and server errors say nothing about a
+    strategy and never disable it, and the authoritative strategy is always
+    attempted.
+    The counts are kept in STRATEGY_STATS_FILE so later runs start from what
+    earlier runs learned.
+    """
+
+    def __init__(self, api_key, base_url, stats_file=STRATEGY_STATS_FILE, min_attempts=STRATEGY_MIN_ATTEMPTS,
+                 transport=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.transport = transport
+        self.compara = get_compara_database(api_key)
+        # strategy -> (endpoint, compara database it asks)
+        self.strategies = {strategy: (endpoint, compara or self.compara)
+                           for strategy, endpoint, compara in GENE_TREE_STRATEGIES}
+        self.stats_file = stats_file
+        self.min_attempts = min_attempts
+        self.all_stats = {}
+        if stats_file and os.path.exists(stats_file):
+            try:
+                with open(stats_file, 'r') as f:
+                    self.all_stats = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logging.warning(f"Ignoring unreadable strategy stats {stats_file}: {e}")
+        self.stats = self.all_stats.setdefault(api_key, {})
+        for strategy, _, _ in GENE_TREE_STRATEGIES:
+            stats = self.stats.setdefault(strategy, {'attempts': 0, 'successes': 0, 'failures': 0})
+            stats.setdefault('missing', 0)
+            stats.setdefault('rejected', 0)
+        self._unsaved = 0
+        self._lock = threading.Lock()
+
+    def is_disabled(self, strategy):
+        stats = self.stats[strategy]
+        if self.is_authoritative(*self.strategies[strategy]) or not self._rejected_only(strategy):
             return False
-            
-    except Exception as e:
-        print(f"Error processing gene tree for {gene_id}: {e}")
-        # Create error file
-        file_identifier = gene_symbol if gene_symbol and gene_symbol.lower() != "unknown" else gene_id
-        error_file = os.path.join(output_dir, f'{file_identifier}_ERROR.txt')
-        with open(error_file, 'w') as f:
-            f.write(f"Error processing gene tree for {gene_id}: {str(e)}\n")
-        return False
+        return time.time() - stats.get('disabled_at', 0) < STRATEGY_REPROBE_SECONDS
+
+    def _rejected_only(self, strategy):
+        return self.stats[strategy]['rejected'] >= self.min_attempts and self.settled(strategy) == 0
+
+    def ordered_strategies(self):
+        """
+        Enabled strategies, most often settling the lookup first
+        """
+        order = []
+        for position, (strategy, (endpoint, compara)) in enumerate(self.strategies.items()):
+            if self.is_disabled(strategy):
+                continue
+            rate = (self.settled(strategy) + 1) / (self.stats[strategy]['attempts'] + 2)
+            order.append((-rate, position, strategy, endpoint, compara))
+        return [entry[2:] for entry in sorted(order)]
+
+    def settled(self, strategy):
+        """
+        Attempts of a strategy that ended the lookup: trees found, plus
+        authoritative answers that there is none
+        """
+        stats = self.stats[strategy]
+        if self.is_authoritative(*self.strategies[strategy]):
+            return stats['successes'] + stats['missing']
+        return stats['successes']
+
+    def is_authoritative(self, endpoint, compara):
+        """
+        Whether a 'missing' answer settles that the gene has no tree: the
+        division's own Compara asked by gene ID. A symbol may name another
+        gene, and the pan-taxonomic Compara holds only a subset of species.
+        """
+        return endpoint == 'id' and compara == self.compara
+
+    def _record(self, strategy, outcome):
+        with self._lock:
+            stats = self.stats[strategy]
+            stats['attempts'] += 1
+            if outcome == 'found':
+                stats['successes'] += 1
+            elif outcome == 'missing':
+                stats['missing'] += 1
+            elif outcome in ('failed', 'rejected'):
+                stats['failures'] += 1
+            if outcome == 'rejected':
+                stats['rejected'] += 1
+                if (not self.is_authoritative(*self.strategies[strategy]) and self._rejected_only(strategy)
+                        and not self.is_disabled(strategy)):
+                    if 'disabled_at' not in stats:
+                        report(f"Strategy {strategy} never settled a lookup for {self.api_key}; "
+                              "no longer attempting it")
+                    logging.info(f"Disabled gene tree strategy {strategy} for {self.api_key}")
+                    stats['disabled_at'] = time.time()
+            elif self.settled(strategy) and stats.pop('disabled_at', None):
+                logging.info(f"Re-enabled gene tree strategy {strategy} for {self.api_key}")
+            self._unsaved += 1
+            if self._unsaved >= 50:
+                self._save()
+
+    def resolve(self, gene_id, gene_symbol, species_ensembl_format, timeout=30):
+        """
+        Returns (gene_tree_info, compara), or (None, None) when the gene has
+        no tree. Strategies are tried until one finds the tree or the
+        division's Compara answers that the gene has none. Raises
+        GeneTreeUnavailable when a strategy failed and no such answer came,
+        so the gene is retried rather than written off.
+        """
+        strategies = self.ordered_strategies()
+        if not strategies:
+            raise GeneTreeUnavailable(f"No gene tree strategy is enabled for {self.api_key}")
+        failed = []
+        for strategy, endpoint, compara in strategies:
+            if endpoint == 'symbol':
+                if not gene_symbol or gene_symbol.lower() == 'unknown' or gene_symbol == gene_id:
+                    continue
+                member = gene_symbol
+            else:
+                member = gene_id
+            url = f"{self.base_url}/genetree/member/{endpoint}/{species_ensembl_format}/{member}?compara={compara}"
+            logging.debug(f"Trying {strategy} strategy: {url}")
+            outcome, gene_tree_info = request_gene_tree(url, gene_id, timeout, self.transport)
+            self._record(strategy, outcome)
+            if outcome == 'found':
+                return gene_tree_info, compara
+            if outcome == 'missing' and self.is_authoritative(endpoint, compara):
+                return None, None
+            if outcome == 'failed':
+                failed.append(strategy)
+        if failed:
+            raise GeneTreeUnavailable(f"Gene tree lookup for {gene_id} failed ({', '.join(failed)})")
+        return None, None
+
+    def fetch_tree_by_id(self, tree_id, gene_id, timeout=30):
+        """
+        Fetch a tree by its stable ID, as listed in a gene manifest
+        Returns (gene_tree_info, compara) or (None, None); raises
+        GeneTreeUnavailable on a transient error
+        """
+        url = f"{self.base_url}/genetree/id/{tree_id}?compara={self.compara}"
+        outcome, gene_tree_info = request_gene_tree(url, gene_id, timeout, self.transport)
+        if outcome == 'found':
+            return gene_tree_info, self.compara
+        if outcome == 'failed':
+            raise GeneTreeUnavailable(f"Gene tree {tree_id} for {gene_id} could not be fetched")
+        return None, None
+
+    def expected_requests(self):
+        """
+        Expected /genetree requests per gene: strategies are tried in order
+        until one finds the tree or settles that there is none, at their
+        observed rates
+        """
+        expected = 0.0
+        reached = 1.0
+        for strategy, _, _ in self.ordered_strategies():
+            attempts = self.stats[strategy]['attempts']
+            expected += reached
+            reached *= 1 - (self.settled(strategy) / attempts if attempts else 0.0)
+        return expected
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if not self.stats_file:
+            return
+        # The statistics only guide strategy order: failing to save them
+        # must not fail a gene or skip the checkpoint
+        try:
+            with atomic_write(self.stats_file) as f:
+                json.dump(self.all_stats, f, indent=2)
+        except OSError as e:
+            logging.warning(f"Could not save strategy stats to {self.stats_file}: {e}")
+            return
+        self._unsaved = 0
 
 def count_species_in_tree(tree_node):
     """
-    Recursively count unique species in a gene tree
-    """
-    species_set = set()
-    
-    def traverse_tree(node):
-        if isinstance(node, dict):
-            # Check if this is a leaf node with sequence info
-            if 'sequence' in node:
-                seq_info = node['sequence']
-                if 'name' in seq_info:
-                    # Extract species from sequence name (usually format: SPECIES_GENEID)
-                    seq_name = seq_info['name']
-                    if '_' in seq_name:
-                        species_part = seq_name.split('_')[0]
-                        species_set.add(species_part)
-            
-            # Recursively process children
-            if 'children' in node:
-                for child in node['children']:
-                    traverse_tree(child)
-    
-    traverse_tree(tree_node)
-    return len(species_set)
+    Count unique species (by taxonomy) in a gene tree
+    """
+    return len(walk_gene_tree(tree_node, collect_leaves=False).species)
 
-def process_gene_batch_for_species(genes, output_dir, total_genes, species_name, checkpoint_file, base_url):
+# Function to process gene tree data
+def process_gene_tree_data(gene_tree_info):
     """
-    Process a batch of genes for gene tree information
+    Extract one row per leaf (gene ID, gene name, species) from a gene tree
     """
-    global current_gene_number, processed_genes
-    
-    for gene in tqdm(genes, desc="Processing genes"):
-        current_gene_number += 1
-        
-        if gene['gene_id'] in processed_genes:
-            print(f"Skipping already processed gene: {gene['gene_id']}")
-            continue
-        
-        print(f"Processing gene {current_gene_number} of {total_genes}: {gene['gene_id']}")
-        
-        try:
-            success = process_gene_tree(
-                gene['gene_id'], 
-                gene['gene_symbol'], 
-                species_name, 
-                base_url, 
-                output_dir
-            )
-            
-            if success:
-                print(f"Successfully processed {gene['gene_id']}")
-            else:
-                print(f"No gene tree found for {gene['gene_id']}")
-            
-            # Mark as processed regardless of success
-            processed_genes.add(gene['gene_id'])
-            save_checkpoint(processed_genes, checkpoint_file)
-            
-        except Exception as e:
-            print(f"Error processing gene {gene['gene_id']}: {e}")
-            # Create error file
-            file_identifier = gene['gene_symbol'] if gene['gene_symbol'].lower() != "unknown" else gene['gene_id']
-            error_file = os.path.join(output_dir, f'{file_identifier}_ERROR.txt')
-            with open(error_file, 'w') as f:
-                f.write(f"Error processing gene: {str(e)}")
-            
-            # Still mark as processed to avoid infinite loop
-            processed_genes.add(gene['gene_id'])
-            save_checkpoint(processed_genes, checkpoint_file)
+    summary = summarize_gene_tree(gene_tree_info)
+    return [
+        {
+            'gene_id': leaf.gene_id or 'N/A',
+            'gene_name': leaf.gene_name or 'N/A',
+            'species': leaf.species or 'N/A'
+        }
+        for leaf in summary.leaves
+    ]
 
-        # Add delay to avoid overwhelming the API
-        time.sleep(0.5)
-    
 # Function to save checkpoint for a specific species
+class RetryQueue:
+    """
+    Failed genes waiting for another attempt, with per-gene attempt counts
+    and exponential backoff. Genes that exhaust their attempts are moved to
+    the dead-letter list. Limits left as None follow MAX_GENE_ATTEMPTS,
+    RETRY_BASE_DELAY and RETRY_MAX_DELAY as they are when the queue is made.
+    """
+
+    def __init__(self, entries=None, max_attempts=None, base_delay=None, max_delay=None):
+        self.entries = dict(entries or {})
+        for entry in self.entries.values():
+            # Retries that were running when the last run stopped are due again
+            entry.pop('in_flight', None)
+        self.max_attempts = MAX_GENE_ATTEMPTS if max_attempts is None else max_attempts
+        self.base_delay = RETRY_BASE_DELAY if base_delay is None else base_delay
+        self.max_delay = RETRY_MAX_DELAY if max_delay is None else max_delay
+        self.dead_letters = []
+
+    def fail(self, gene, gene_number, error, count_attempt=True):
+        """
+        Schedule a retry. Returns False once the gene is out of attempts.
+        """
+        entry = self.entries.get(gene['gene_id']) or {
+            'gene_id': gene['gene_id'],
+            'gene_symbol': gene['gene_symbol'],
+            'gene_number': gene_number,
+            'attempts': 0
+        }
+        # The whole gene, so a retry keeps its manifest columns
+        entry['gene'] = dict(gene)
+        if count_attempt:
+            entry['attempts'] += 1
+        entry.pop('in_flight', None)
+        entry['error'] = f"{type(error).__name__}: {error}"
+        if entry['attempts'] >= self.max_attempts:
+            self.entries.pop(gene['gene_id'], None)
+            self.dead_letters.append(entry)
+            return False
+        delay = min(self.base_delay * 2 ** max(entry['attempts'] - 1, 0), self.max_delay)
+        entry['next_attempt'] = time.time() + delay
+        self.entries[gene['gene_id']] = entry
+        return True
+
+    def succeeded(self, gene_id):
+        self.entries.pop(gene_id, None)
+
+    def due(self, now=None):
+        """
+        (gene_number, gene) for every retry that is due, marked in flight
+        until it succeeds or fails again
+        """
+        now = time.time() if now is None else now
+        ready = sorted((e for e in self.entries.values() if not e.get('in_flight') and e['next_attempt'] <= now),
+                       key=lambda e: e['next_attempt'])
+        for entry in ready:
+            entry['in_flight'] = True
+        return [(e['gene_number'], dict(e.get('gene') or {'gene_id': e['gene_id'], 'gene_symbol': e['gene_symbol']}))
+                for e in ready]
+
+    def next_attempt(self):
+        return min((e['next_attempt'] for e in self.entries.values() if not e.get('in_flight')), default=None)
+
+    def to_dict(self):
+        return dict(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+class RunInterrupted(Exception):
+    """
+    Raised once a species has been drained and checkpointed after a stop
+    was requested
+    """
+
+def stop_requested():
+    """
+    True once new genes should no longer be dispatched
+    """
+    if not stop_event.is_set() and run_deadline is not None and time.time() >= run_deadline:
+        print("\nApproaching the deadline; finishing in-flight genes and stopping")
+        logging.info("Deadline reached; draining")
+        stop_event.set()
+    return stop_event.is_set()
+
+def parse_deadline(value):
+    """
+    Deadline as a Unix time from an ISO date-time (2025-06-01T18:00) or a
+    SLURM-style duration from now ([D-]HH:MM:SS, MM:SS or minutes)
+    """
+    if 'T' in value or value.count('-') >= 2:
+        return datetime.fromisoformat(value).timestamp()
+    days = 0
+    if '-' in value:
+        days, value = value.split('-', 1)
+        days = int(days)
+    parts = [int(p) for p in value.split(':')]
+    if len(parts) == 1:
+        hours, minutes, seconds = 0, parts[0], 0
+    elif len(parts) == 2:
+        hours, minutes, seconds = 0, parts[0], parts[1]
+    else:
+        hours, minutes, seconds = parts[-3:]
+    return time.time() + ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+def slurm_deadline():
+    """
+    End time of the enclosing SLURM job, if the environment provides it
+    """
+    end_time = os.environ.get('SLURM_JOB_END_TIME')
+    if end_time and end_time.isdigit():
+        return int(end_time)
+    return None
+
+def report(message, level=logging.INFO):
+    """
+    Progress message: logged, and printed when running as the script
+    """
+    if console:
+        print(message)
+    logging.log(level, message.strip())
+
+def detail(message, gene_id=None, level=logging.DEBUG):
+    """
+    Per-gene detail: logged at the given level, and printed when running as
+    the script unless --quiet
+    """
+    if console and not quiet:
+        print(message)
+    logging.log(level, message.strip(), extra={'gene_id': gene_id} if gene_id else None)
+
+def gene_outcome(gene, status, **fields):
+    """
+    Log a gene's outcome ('tree', 'no_tree', 'retry' or 'failed') as one
+    structured record and count it on the progress line
+    """
+    fields = {key: value for key, value in fields.items() if value is not None}
+    logging.info(f"Gene {gene['gene_id']}: {status}", extra=dict(fields, gene_id=gene['gene_id'], status=status))
+    if progress:
+        progress.update(status)
+
+class ProgressLine:
+    """
+    Aggregated progress of a species, written to stderr at most once per
+    interval however many genes finish in between
+    """
+
+    def __init__(self, label, total, done=0, interval=DEFAULT_PROGRESS_INTERVAL, stream=None):
+        self.label = label
+        self.total = total
+        self.done = done
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.counts = {'tree': 0, 'no_tree': 0, 'retry': 0, 'failed': 0}
+        self.started = time.monotonic()
+        self.last_write = self.started
+
+    def update(self, status):
+        self.counts[status] += 1
+        if status != 'retry':
+            self.done += 1
+        self.write()
+
+    def write(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_write < self.interval:
+            return
+        self.last_write = now
+        finished = self.counts['tree'] + self.counts['no_tree'] + self.counts['failed']
+        rate = finished / max(now - self.started, 1e-9)
+        if rate and self.total > self.done:
+            eta = time.strftime('%H:%M:%S', time.gmtime((self.total - self.done) / rate))
+        else:
+            eta = '--:--:--' if self.total > self.done else '00:00:00'
+        percent = 100.0 * self.done / self.total if self.total else 100.0
+        self.stream.write(f"{self.label}: {self.done}/{self.total} genes ({percent:.1f}%) | "
+                          f"{self.counts['tree']} trees, {self.counts['no_tree']} without tree, "
+                          f"{self.counts['retry']} retries, {self.counts['failed']} failed | "
+                          f"{rate:.2f} genes/s | ETA {eta}\n")
+        self.stream.flush()
+
+    def close(self):
+        self.write(force=True)
+
 def save_checkpoint(processed_genes, checkpoint_file):
-    with open(checkpoint_file, 'w') as f:
-        json.dump({
-            'processed_genes': list(processed_genes),
-            'last_gene': last_processed_gene,
-            'current_gene_number': current_gene_number
-        }, f)
-    print(f"Checkpoint saved to {checkpoint_file}. Last processed gene: {last_processed_gene}")
+    # Genes of the gene list are saved as its bitmap; processed_genes keeps
+    # the IDs the bitmap does not cover
+    if isinstance(processed_genes, ProcessedGenes):
+        checkpoint_data = {'processed_genes': list(processed_genes.others), 'processed': processed_genes.state()}
+    else:
+        checkpoint_data = {'processed_genes': list(processed_genes)}
+    checkpoint_data.update({
+        'last_gene': last_processed_gene,
+        'retries': retry_queue.to_dict() if retry_queue is not None else {}
+    })
+    with atomic_write(checkpoint_file) as f:
+        json.dump(checkpoint_data, f)
+    detail(f"Checkpoint saved to {checkpoint_file}. Last processed gene: {last_processed_gene}")
 
 # Function to load checkpoint for a specific species
 def load_checkpoint(checkpoint_file):
@@ -667,143 +1507,393 @@ def load_checkpoint(checkpoint_file):
             return (
                 set(checkpoint_data['processed_genes']),
                 checkpoint_data['last_gene'],
-                checkpoint_data.get('current_gene_number', 0)
+                checkpoint_data.get('processed'),
+                checkpoint_data.get('retries', {})
             )
-    return set(), None, 0
+    return set(), None, None, {}
+
+def gene_order_file(checkpoint_file):
+    return os.path.join(os.path.dirname(checkpoint_file), GENE_ORDER_FILE)
+
+def save_gene_order(manifest, checkpoint_file):
+    """
+    Write the gene order the checkpoint's bitmap indexes, unless it is
+    already there. Call it after saving a checkpoint for the manifest: until
+    then the previous order may still be needed to read the checkpoint.
+    """
+    order_file = gene_order_file(checkpoint_file)
+    if load_gene_order(checkpoint_file, manifest.digest()) is not None:
+        return
+    with atomic_write(order_file) as f:
+        f.write(f"# {manifest.digest()}\n")
+        for gene_id in manifest.gene_ids:
+            f.write(f"{gene_id}\n")
+
+def load_gene_order(checkpoint_file, digest):
+    """
+    Gene IDs in the order saved next to a checkpoint, or None unless they
+    are the gene list with the given digest
+    """
+    try:
+        with open(gene_order_file(checkpoint_file), 'r') as f:
+            if f.readline().strip() != f"# {digest}":
+                return None
+            return [line.rstrip('\n') for line in f]
+    except OSError:
+        return None
+
+def restore_processed_genes(manifest, processed_ids, processed_state, gene_csv_file, checkpoint_file):
+    """
+    ProcessedGenes of a manifest from what load_checkpoint returned. If the
+    gene list has changed since the checkpoint, processed genes are carried
+    over by ID through the gene order saved with it.
+    """
+    processed = ProcessedGenes(manifest, processed_ids)
+    if not processed_state or processed.restore(processed_state):
+        return processed
+    saved_gene_ids = load_gene_order(checkpoint_file, processed_state.get('digest'))
+    if processed.restore(processed_state, saved_gene_ids):
+        print(f"{gene_csv_file} has changed since the checkpoint was written; "
+              f"carried over {len(processed)} processed genes by gene ID")
+    else:
+        print(f"Warning: {gene_csv_file} has changed since the checkpoint was written and "
+              f"{gene_order_file(checkpoint_file)} does not match it; "
+              f"genes processed before the change will be fetched again")
+    return processed
 
 # Signal handler function
 def signal_handler(signum, frame):
-    global current_checkpoint_file
+    if not stop_event.is_set():
+        # Let in-flight genes finish; the loops stop dispatching and checkpoint
+        print(f"\nReceived {signal.Signals(signum).name}. Finishing in-flight genes before stopping "
+              "(send again to stop immediately)...")
+        stop_event.set()
+        return
     print("\nProcess interrupted. Saving checkpoint...")
     if 'current_checkpoint_file' in globals():
         save_checkpoint(processed_genes, current_checkpoint_file)
     print("You can resume later by running the script again.")
-    exit(0)
+    sys.exit(EXIT_RESUMABLE)
+
+def has_manifest(gene):
+    """
+    Whether a gene came from a gene list with BioMart manifest columns
+    """
+    return any(column in gene for column in MANIFEST_ATTRIBUTES)
+
+def _thread_safe(func):
+    # timeout_decorator relies on SIGALRM, which only works in the main
+    # thread; worker threads rely on the per-request timeouts instead
+    return getattr(func, '__wrapped__', func)
+
+def wait_for_ensembl(base_url):
+    """
+    Block while every mirror of base_url has an open circuit. Returns False
+    if a stop was requested while waiting.
+    """
+    transport = get_transport()
+    if transport.is_available(base_url):
+        return True
+    with _ensembl_wait_lock:
+        if not transport.is_available(base_url):
+            print(f"\nEnsembl is unavailable at {base_url}; waiting for it to answer again")
+            logging.warning(f"Waiting for {base_url} to answer again")
+        while not transport.wait_until_available(base_url, timeout=5):
+            if stop_requested():
+                return False
+    return True
+
+def fetch_gene_tree_for_gene(gene, species_ensembl_format, base_url, resolver, in_worker=False):
+    """
+    Network part of processing one gene: look up its symbol and find its tree
+    Safe to run in worker threads. Returns (gene_symbol, gene_tree_info, compara).
+    Genes from a manifest gene list already carry their BioMart display name,
+    so the /lookup/id request is skipped, and a known tree ID is fetched
+    directly.
+    """
+    gene_symbol = gene['gene_symbol']  # Default to what we have
+
+    # While Ensembl is down every request would fail at once; wait for the
+    # circuit breaker's probe rather than failing gene after gene
+    wait_for_ensembl(base_url)
+
+    if has_manifest(gene):
+        detail(f"Using manifest gene symbol: {gene_symbol}", gene['gene_id'])
+    else:
+        # Fetch gene information with base_url
+        lookup = _thread_safe(fetch_gene_info) if in_worker else fetch_gene_info
+        gene_info = lookup(gene['gene_id'], base_url)
+        if gene_info:
+            gene_symbol = gene_info.get('display_name', gene['gene_symbol'])
+            detail(f"Retrieved gene info for: {gene_symbol}", gene['gene_id'])
+        else:
+            detail(f"Using provided gene symbol: {gene_symbol}", gene['gene_id'])
+
+    gene_tree_info = compara = None
+    if gene.get('gene_tree_id'):
+        gene_tree_info, compara = resolver.fetch_tree_by_id(gene['gene_tree_id'], gene['gene_id'])
+    if not gene_tree_info:
+        # Find the gene tree in this division's Compara database
+        gene_tree_info, compara = resolver.resolve(gene['gene_id'], gene_symbol, species_ensembl_format)
+
+    # Add backoff delay to avoid overwhelming the API
+    time.sleep(1)
+    return gene_symbol, gene_tree_info, compara
+
+def store_gene_result(gene, gene_symbol, gene_tree_info, compara, writer, species_ensembl_format,
+                      membership_index=None, from_index=False):
+    """
+    Write a gene's tree (or "No gene tree available") and index the tree
+    """
+    file_identifier = gene_file_identifier(gene['gene_id'], gene_symbol)
+    if gene_tree_info:
+        processed_data = process_gene_tree_data(gene_tree_info)
+        output_file = writer.write_tree(gene['gene_id'], gene_symbol, species_ensembl_format, gene_tree_info, processed_data)
+        if membership_index and not from_index:
+            membership_index.add_tree(compara, gene_tree_info, writer.last_location)
+
+        detail(f"Gene tree information for {file_identifier} has been written to {output_file}", gene['gene_id'])
+        detail(f"Number of entries: {len(processed_data)}", gene['gene_id'])
+        gene_outcome(gene, 'tree', compara=compara, tree_id=gene_tree_info.get('id'), from_index=from_index)
+    else:
+        output_file = writer.write_no_tree(gene['gene_id'], gene_symbol, species_ensembl_format)
+        detail(f"No gene tree available for {file_identifier}. Written to {output_file}", gene['gene_id'])
+        gene_outcome(gene, 'no_tree')
+
+def mark_gene_processed(gene, checkpoint_file):
+    global last_processed_gene
+    processed_genes.add(gene['gene_id'])
+    last_processed_gene = gene['gene_id']
+    retry_queue.succeeded(gene['gene_id'])
+    save_checkpoint(processed_genes, checkpoint_file)
+
+def record_gene_error(gene, error, writer, checkpoint_file, gene_number=None):
+    if isinstance(error, timeout_error()):
+        detail(f"Timeout occurred while processing gene {gene['gene_id']}. Moving to next gene.", gene['gene_id'],
+               logging.WARNING)
+    elif isinstance(error, CircuitOpenError):
+        detail(f"Ensembl unavailable for gene {gene['gene_id']}: {error}", gene['gene_id'], logging.WARNING)
+    elif isinstance(error, GeneTreeUnavailable):
+        detail(str(error), gene['gene_id'], logging.WARNING)
+    else:
+        detail(f"An error occurred while processing gene {gene['gene_id']}: {str(error)}", gene['gene_id'],
+               logging.WARNING)
+        logging.error(f"Error processing gene {gene['gene_id']}:", exc_info=error)
+
+    # An open circuit says nothing about the gene, so it does not use up an
+    # attempt, and losing such an entry loses nothing: the gene is still
+    # pending in the bitmap, so the checkpoint is not rewritten for it
+    circuit_open = isinstance(error, CircuitOpenError)
+    if retry_queue.fail(gene, gene_number, error, count_attempt=not circuit_open):
+        entry = retry_queue.entries[gene['gene_id']]
+        detail(f"Will retry {gene['gene_id']} in {entry['next_attempt'] - time.time():.0f} s "
+               f"(failed attempts: {entry['attempts']} of {retry_queue.max_attempts})", gene['gene_id'])
+        gene_outcome(gene, 'retry', attempts=entry['attempts'], error=str(error))
+        if not circuit_open:
+            save_checkpoint(processed_genes, checkpoint_file)
+        return
+
+    # Out of attempts: record the error and stop trying this gene
+    detail(f"Giving up on gene {gene['gene_id']} after {retry_queue.max_attempts} attempts", gene['gene_id'],
+           logging.WARNING)
+    gene_outcome(gene, 'failed', attempts=retry_queue.max_attempts, error=str(error))
+    writer.write_error(gene['gene_id'], gene['gene_symbol'], str(error))
+    mark_gene_processed(gene, checkpoint_file)
+
+def write_dead_letter_report(output_dir, dead_letters):
+    """
+    Append genes that ran out of attempts to the species' dead-letter report
+    """
+    if not dead_letters:
+        return None
+    report_file = os.path.join(output_dir, DEAD_LETTER_FILE)
+    write_header = not os.path.exists(report_file)
+    with open(report_file, 'a', newline='') as f:
+        report = csv.DictWriter(f, fieldnames=['gene_id', 'gene_symbol', 'attempts', 'error'],
+                                delimiter='\t', extrasaction='ignore')
+        if write_header:
+            report.writeheader()
+        report.writerows(dead_letters)
+    return report_file
+
+def lookup_indexed_tree(gene, resolver, membership_index):
+    """
+    Stored tree of a gene that is a member of a tree we already fetched, or None
+    """
+    if not membership_index:
+        return None, None
+    for compara in (resolver.compara, PAN_COMPARA_DATABASE):
+        gene_tree_info = membership_index.tree_for_gene(compara, gene['gene_id'])
+        if gene_tree_info:
+            return gene_tree_info, compara
+    return None, None
 
 # Function to process a batch of genes for a specific species
-def process_gene_batch_for_species(batch, output_dir, total_genes, species_ensembl_format, checkpoint_file, base_url):
-    global last_processed_gene, processed_genes, current_gene_number, current_checkpoint_file
+def process_gene_batch_for_species(batch, writer, total_genes, species_ensembl_format, checkpoint_file, base_url,
+                                   resolver, membership_index=None, workers=1):
+    """
+    Process a batch of (gene_number, gene) taken from the pending genes. With
+    workers > 1 the REST lookups of the batch run concurrently; results are
+    written and checkpointed on this thread.
+    """
+    global current_checkpoint_file
     
     # Set current checkpoint file for the signal handler
     current_checkpoint_file = checkpoint_file
 
-    for gene in tqdm(batch, desc="Processing genes", unit="gene"):
-        current_gene_number += 1
-        # Skip if gene has already been processed
-        if gene['gene_id'] in processed_genes:
-            print(f"Skipping already processed gene: {gene['gene_id']}")
-            continue
+    pending = []
+    for gene_number, gene in batch:
+        if stop_requested():
+            break
+        pending.append((gene_number, gene))
 
-        print(f"\nProcessing gene {current_gene_number} of {total_genes}: {gene['gene_id']}")
+    # Earlier failures whose backoff has expired share the batch
+    if not stop_requested():
+        pending.extend(retry_queue.due())
+    fetch_pending_genes(pending, writer, total_genes, species_ensembl_format, checkpoint_file, base_url,
+                        resolver, membership_index=membership_index, workers=workers)
 
+def fetch_pending_genes(pending, writer, total_genes, species_ensembl_format, checkpoint_file, base_url,
+                        resolver, membership_index=None, workers=1):
+    """
+    Fetch, write and checkpoint a list of (gene_number, gene)
+
+    Each gene is looked up in the membership index just before it would be
+    dispatched, so a tree fetched earlier in the same batch serves the
+    other members of its family. With workers > 1 at most 2 * workers genes
+    are in flight, which keeps that lookup close to the fetch.
+    """
+    from tqdm import tqdm
+
+    def served_from_index(gene_number, gene):
+        # Genes that are members of a tree we already fetched are served from the index
         try:
-            # Fetch gene information with base_url
-            gene_info = fetch_gene_info(gene['gene_id'], base_url)
-            gene_symbol = gene['gene_symbol']  # Default to what we have
-            
-            if gene_info:
-                gene_symbol = gene_info.get('display_name', gene['gene_symbol'])
-                print(f"Retrieved gene info for: {gene_symbol}")
-            else:
-                print(f"Using provided gene symbol: {gene_symbol}")
-
-            # Fetch gene tree information with species parameter and base_url
-            gene_tree_info = fetch_gene_tree_info(gene['gene_id'], gene_symbol, species_ensembl_format, base_url)
-
-            # Process gene tree data or write "No gene tree available"
-            if gene_tree_info:
-                processed_data = process_gene_tree_data(gene_tree_info)
-
-                if processed_data:
-                    # Use gene_id for file naming when gene_symbol is "Unknown"
-                    file_identifier = gene_symbol if gene_symbol.lower() != "unknown" else gene['gene_id']
-                    output_file = os.path.join(output_dir, f'{file_identifier}_gene_tree.csv')
-                    with open(output_file, 'w', newline='') as csvfile:
-                        fieldnames = ['gene_id', 'gene_name', 'species']
-                        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                        writer.writeheader()
-                        for row in processed_data:
-                            writer.writerow(row)
-
-                    print(f"Gene tree information for {file_identifier} has been written to {output_file}")
-                    print(f"Number of entries: {len(processed_data)}")
-                else:
-                    print(f"No gene tree data found for {gene_symbol} after processing.")
-                    file_identifier = gene_symbol if gene_symbol.lower() != "unknown" else gene['gene_id']
-                    output_file = os.path.join(output_dir, f'{file_identifier}_gene_tree.txt')
-                    with open(output_file, 'w') as txtfile:
-                        txtfile.write("No gene tree available")
-                    print(f"No gene tree available for {gene_symbol}. Written to {output_file}")
-            else:
-                file_identifier = gene_symbol if gene_symbol.lower() != "unknown" else gene['gene_id']
-                output_file = os.path.join(output_dir, f'{file_identifier}_gene_tree.txt')
-                with open(output_file, 'w') as txtfile:
-                    txtfile.write("No gene tree available")
-                print(f"No gene tree available for {file_identifier}. Written to {output_file}")
+            gene_tree_info, compara = lookup_indexed_tree(gene, resolver, membership_index)
+        except Exception as e:
+            record_gene_error(gene, e, writer, checkpoint_file, gene_number)
+            return True
+        if not gene_tree_info:
+            return False
+        detail(f"Gene tree {gene_tree_info.get('id')} for {gene['gene_id']} served from membership index",
+               gene['gene_id'])
+        store_gene_result(gene, gene['gene_symbol'], gene_tree_info, compara, writer,
+                          species_ensembl_format, membership_index, from_index=True)
+        mark_gene_processed(gene, checkpoint_file)
+        return True
 
-            print(f"Successfully processed {gene['gene_id']}")
+    def handle(gene_number, gene, fetch):
+        detail(f"\nProcessing gene {gene_number} of {total_genes}: {gene['gene_id']}", gene['gene_id'])
+        try:
+            gene_symbol, gene_tree_info, compara = fetch()
+            store_gene_result(gene, gene_symbol, gene_tree_info, compara, writer,
+                              species_ensembl_format, membership_index)
+            detail(f"Successfully processed {gene['gene_id']}", gene['gene_id'])
+            mark_gene_processed(gene, checkpoint_file)
+        except Exception as e:
+            record_gene_error(gene, e, writer, checkpoint_file, gene_number)
 
-            # Add processed gene to the set and update last processed gene
-            processed_genes.add(gene['gene_id'])
-            last_processed_gene = gene['gene_id']
+    undispatched = []
+    if workers <= 1:
+        for position, (gene_number, gene) in enumerate(tqdm(pending, desc="Processing genes", unit="gene", disable=quiet)):
+            if stop_requested():
+                undispatched = pending[position:]
+                break
+            if served_from_index(gene_number, gene):
+                continue
+            handle(gene_number, gene,
+                   lambda: fetch_gene_tree_for_gene(gene, species_ensembl_format, base_url, resolver))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor, \
+                tqdm(total=len(pending), desc="Processing genes", unit="gene", disable=quiet) as bar:
+            in_flight = {}
 
-            # Save checkpoint after each gene
-            save_checkpoint(processed_genes, checkpoint_file)
+            def collect(done):
+                # Results are written on this thread, so the index sees them before the next dispatch
+                for future in done:
+                    gene_number, gene = in_flight.pop(future)
+                    handle(gene_number, gene, future.result)
+                    bar.update()
 
-        except timeout_decorator.TimeoutError:
-            print(f"Timeout occurred while processing gene {gene['gene_id']}. Moving to next gene.")
-        except Exception as e:
-            print(f"An error occurred while processing gene {gene['gene_id']}: {str(e)}")
-            logging.exception(f"Error processing gene {gene['gene_id']}:")
-            
-            # Create a file to show the error
-            file_identifier = gene['gene_symbol'] if gene['gene_symbol'].lower() != "unknown" else gene['gene_id']
-            error_file = os.path.join(output_dir, f'{file_identifier}_ERROR.txt')
-            with open(error_file, 'w') as txtfile:
-                txtfile.write(f"Error processing gene: {str(e)}")
-            
-            # Still mark as processed to avoid infinite loop
-            processed_genes.add(gene['gene_id'])
-            last_processed_gene = gene['gene_id']
-            save_checkpoint(processed_genes, checkpoint_file)
+            for position, (gene_number, gene) in enumerate(pending):
+                if stop_requested():
+                    # Genes not dispatched yet are given back; running ones finish
+                    undispatched = pending[position:]
+                    break
+                if served_from_index(gene_number, gene):
+                    bar.update()
+                    continue
+                future = executor.submit(fetch_gene_tree_for_gene, gene, species_ensembl_format, base_url,
+                                         resolver, True)
+                in_flight[future] = (gene_number, gene)
+                if len(in_flight) >= 2 * workers:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+            collect(as_completed(list(in_flight)))
+    if undispatched:
+        release_undispatched(undispatched)
+
+def release_undispatched(undispatched):
+    """
+    Give back genes skipped by a stop. New genes stay pending in the bitmap
+    and are picked up next run; queued retries just leave the in-flight state.
+    """
+    for gene_number, gene in undispatched:
+        entry = retry_queue.entries.get(gene['gene_id'])
+        if entry:
+            entry.pop('in_flight', None)
+
+def drain_retry_queue(writer, species_ensembl_format, checkpoint_file, base_url, resolver,
+                      membership_index=None, workers=1):
+    """
+    Retry failed genes, waiting out their backoff, until each one succeeds or
+    runs out of attempts
+    """
+    while len(retry_queue) and not stop_requested():
+        next_attempt = retry_queue.next_attempt()
+        if next_attempt is None:
+            break
+        wait = next_attempt - time.time()
+        if wait > 0:
+            print(f"\n{len(retry_queue)} genes waiting to be retried; next attempt in {wait:.0f} s")
+            # Sleep in short steps so a stop request is noticed
+            while time.time() < next_attempt and not stop_requested():
+                time.sleep(min(5, max(next_attempt - time.time(), 0)))
+            continue
+        fetch_pending_genes(retry_queue.due(), writer, total_genes, species_ensembl_format, checkpoint_file,
+                            base_url, resolver, membership_index=membership_index, workers=workers)
 
-        # Add backoff delay to avoid overwhelming the API
-        time.sleep(1)
+def pending_batches(species_genes, indices=None, batch_size=100):
+    """
+    Batches of (gene_number, gene) for the genes of a run not processed yet,
+    read from the processed bitmap as the run goes. Genes waiting in the
+    retry queue are left to it.
+    """
+    pending = (index for index in processed_genes.pending(indices)
+               if species_genes.gene_ids[index] not in retry_queue.entries)
+    while True:
+        batch = [(index + 1, species_genes.gene(index)) for index in itertools.islice(pending, batch_size)]
+        if not batch:
+            return
+        yield batch
 
 # Function to process genes for a specific species
-def process_species_genes(species_name, species_api_info, gene_csv_file, output_dir):
-    global last_processed_gene, processed_genes, total_genes, current_gene_number
+def process_species_genes(species_name, species_api_info, gene_csv_file, output_dir, output_layout='files', shard_size=DEFAULT_SHARD_SIZE,
+                          membership_index=None, workers=1, max_attempts=None, gene_shard=None,
+                          selection=None):
+    global last_processed_gene, processed_genes, total_genes, retry_queue, progress
     
     base_url = species_api_info['rest_url']
     species_ensembl_format = convert_to_ensembl_format(species_name)
     
     # Reset tracking variables for this species
     checkpoint_file = os.path.join(output_dir, "checkpoint.json")
-    processed_genes, last_processed_gene, current_gene_number = load_checkpoint(checkpoint_file)
+    processed_ids, last_processed_gene, processed_state, retries = load_checkpoint(checkpoint_file)
+    retry_queue = RetryQueue(retries, max_attempts=max_attempts)
     
     # Read the species protein-coding genes CSV file
-    species_genes = []
     try:
-        with open(gene_csv_file, 'r') as csvfile:
-            reader = csv.DictReader(csvfile)
-            fieldnames = reader.fieldnames
-            print(f"CSV columns: {fieldnames}")
-            
-            for i, row in enumerate(reader):
-                if i < 5:  # Print first 5 rows for debugging
-                    print(f"Row {i+1}: {row}")
-
-                gene_id = row.get('gene_id') or row.get('ensembl_id') or row.get('WBGeneID')
-                gene_symbol = row.get('gene_symbol') or row.get('symbol') or gene_id
-
-                if not gene_id:
-                    print(f"Warning: No gene ID found for row: {row}")
-                    continue
-
-                species_genes.append({
-                    'gene_id': gene_id,
-                    'gene_symbol': gene_symbol
-                })
+        species_genes = read_gene_list(gene_csv_file)
+        indices = genes_to_process(species_genes, selection, gene_shard)
     except FileNotFoundError:
         print(f"Error: Gene list file {gene_csv_file} not found for {species_name}")
         return False
@@ -811,22 +1901,77 @@ def process_species_genes(species_name, species_api_info, gene_csv_file, output_
         print(f"Error reading gene file {gene_csv_file}: {str(e)}")
         return False
 
-    total_genes = len(species_genes)
-    print(f"Total {species_name} protein-coding genes: {total_genes}")
-    print(f"Starting from gene number: {current_gene_number + 1}")
+    # Processed genes are bits keyed by index in the full gene list, so
+    # selections and shards share one resume state
+    processed_genes = restore_processed_genes(species_genes, processed_ids, processed_state, gene_csv_file,
+                                              checkpoint_file)
+    save_checkpoint(processed_genes, checkpoint_file)
+    save_gene_order(species_genes, checkpoint_file)
+
+    if gene_shard:
+        part, parts = gene_shard
+        print(f"Processing part {part} of {parts} (0-based) of {len(species_genes)} genes")
+    total_genes = len(species_genes) if indices is None else len(indices)
+    if selection:
+        print(f"Selected {total_genes} {species_name} protein-coding genes")
+    else:
+        print(f"Total {species_name} protein-coding genes: {total_genes}")
+    if indices is None:
+        done_at_start = processed_genes.in_manifest()
+    else:
+        done_at_start = sum(1 for index in indices if index in processed_genes.bitmap)
+    print(f"Already processed: {done_at_start}; to process: {total_genes - done_at_start}")
+    if len(retry_queue):
+        print(f"{len(retry_queue)} genes from earlier runs are waiting to be retried")
     
     # Process genes in batches
+    resolver = GeneTreeResolver(species_api_info['api_key'], base_url)
+    writer = open_tree_writer(output_dir, output_layout, species_name=species_name, max_shard_bytes=shard_size)
     batch_size = 100
-    for i in range(current_gene_number, len(species_genes), batch_size):
-        batch = species_genes[i:i+batch_size]
-        print(f"\nProcessing batch {i//batch_size + 1} of {(len(species_genes)-1)//batch_size + 1}")
-        process_gene_batch_for_species(batch, output_dir, total_genes, species_ensembl_format, checkpoint_file, base_url)
+    genes_at_start = len(processed_genes)
+    start_time = time.monotonic()
+    traffic_at_start = get_transport().stats()
+    if quiet:
+        progress = ProgressLine(species_name, total_genes, done=done_at_start, interval=progress_interval)
+    try:
+        batches = (total_genes - done_at_start - 1) // batch_size + 1
+        for batch_number, batch in enumerate(pending_batches(species_genes, indices, batch_size), start=1):
+            if stop_requested():
+                break
+            detail(f"\nProcessing batch {batch_number} of {batches}")
+            process_gene_batch_for_species(batch, writer, total_genes, species_ensembl_format, checkpoint_file, base_url,
+                                           resolver, membership_index=membership_index, workers=workers)
+        drain_retry_queue(writer, species_ensembl_format, checkpoint_file, base_url, resolver,
+                          membership_index=membership_index, workers=workers)
+    finally:
+        writer.close()
+        resolver.save()
+        if progress:
+            progress.close()
+            progress = None
+        report_file = write_dead_letter_report(output_dir, retry_queue.dead_letters)
+        save_checkpoint(processed_genes, checkpoint_file)
+        genes_done = len(processed_genes) - genes_at_start
+        if genes_done:
+            traffic = get_transport().stats()
+            record_run_stats(species_name, species_api_info['api_key'], genes_done,
+                             time.monotonic() - start_time, workers, gene_shard,
+                             requests_made=traffic['requests'] - traffic_at_start['requests'],
+                             bytes_received=traffic['bytes_received'] - traffic_at_start['bytes_received'])
+
+    if stop_requested():
+        raise RunInterrupted(f"Stopped during {species_name} with {done_at_start + genes_done} of {total_genes} "
+                             f"genes processed")
         
     print(f"\nAll genes for {species_name} have been processed.")
+    if report_file:
+        print(f"{len(retry_queue.dead_letters)} genes failed after {retry_queue.max_attempts} attempts; see {report_file}")
     return True
 
 # Main function to process gene tree information for species from a text file
-def process_all_gene_trees(species_file, force_api=None):
+def process_all_gene_trees(species_file, force_api=None, output_layout='files', shard_size=DEFAULT_SHARD_SIZE,
+                           membership_index=None, workers=1, max_attempts=None, gene_shard=None,
+                           manifest_columns=DEFAULT_MANIFEST_COLUMNS, selection=None):
     # Create results directory for API search results
     os.makedirs("api_search_results", exist_ok=True)
     api_results_file = os.path.join("api_search_results", f"species_api_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
@@ -837,11 +1982,7 @@ def process_all_gene_trees(species_file, force_api=None):
         print("No species to process. Exiting.")
         return
     
-    # Species-specific API mapping
-    species_api_mapping = {
-        "Ciona savignyi": "Metazoa",
-        # Add other specific mappings if needed
-    }
+    species_api_mapping = SPECIES_API_MAPPING
     
     # Track species API info
     api_results = []
@@ -921,6 +2062,8 @@ def process_all_gene_trees(species_file, force_api=None):
     print("\n=== Processing gene trees for each species ===\n")
     for result in api_results:
         species_name = result['species']
+        if stop_requested():
+            raise RunInterrupted(f"Stopped before {species_name}")
         
         if not result['found'] and not force_api:
             print(f"\n{'='*50}")
@@ -964,7 +2107,7 @@ def process_all_gene_trees(species_file, force_api=None):
         print(f"{'='*50}")
         
         # Create a directory for this species
-        species_dir = f"{species_name.replace(' ', '_')}_gene_tree_files_{api_key.lower()}"
+        species_dir = species_output_dir(species_name, api_key, gene_shard)
         os.makedirs(species_dir, exist_ok=True)
         
         # Check if gene CSV file exists, if not, fetch genes from BioMart
@@ -972,8 +2115,8 @@ def process_all_gene_trees(species_file, force_api=None):
         
         if not os.path.exists(gene_csv_file):
             print(f"Gene list file {gene_csv_file} not found for {species_name}")
-            print(f"Fetching genes from BioMart...")
-            genes = fetch_genes_from_biomart(species_api_info)
+            print("Fetching genes from BioMart...")
+            genes = fetch_genes_from_biomart(species_api_info, manifest_columns=manifest_columns)
             if genes:
                 gene_csv_file = save_genes_to_csv(genes, species_name)
             else:
@@ -983,32 +2126,238 @@ def process_all_gene_trees(species_file, force_api=None):
             print(f"Using existing gene list file: {gene_csv_file}")
             
         # Process the genes for this species
-        success = process_species_genes(species_name, species_api_info, gene_csv_file, species_dir)
+        success = process_species_genes(species_name, species_api_info, gene_csv_file, species_dir,
+                                        output_layout=output_layout, shard_size=shard_size,
+                                        membership_index=membership_index, workers=workers,
+                                        max_attempts=max_attempts, gene_shard=gene_shard,
+                                        selection=selection)
         if success:
             print(f"Successfully processed all genes for {species_name} using {api_key}")
         else:
             print(f"Failed to process genes for {species_name}")
 
+def resolve_species_api(species_name, force_api=None):
+    """
+    Division, URLs, dataset and mart of a species, honouring
+    SPECIES_API_MAPPING and --force, or None if it cannot be found
+    """
+    api_key = SPECIES_API_MAPPING.get(species_name) or force_api
+    if not api_key:
+        return search_species_dataset(species_name)
+    mart_name, virtual_schema, datasets = get_registry_info(api_key)
+    dataset, score = find_dataset_for_species(species_name, datasets) if datasets else (None, 0)
+    if not dataset:
+        return None
+    return {
+        'api_key': api_key,
+        'rest_url': ENSEMBL_APIS[api_key]['rest'],
+        'mart_url': ENSEMBL_APIS[api_key]['mart'],
+        'dataset': dataset,
+        'score': score,
+        'mart_name': mart_name,
+        'virtual_schema': virtual_schema
+    }
+
+def dry_run(species_file, force_api=None, membership_index=None, workers=1, gene_shard=None,
+            stats_file=RUN_STATS_FILE, manifest_columns=DEFAULT_MANIFEST_COLUMNS, selection=None):
+    """
+    Estimate the REST calls, data volume and wall time of a run without
+    fetching any trees. Gene counts come from existing gene lists or BioMart
+    count queries; genes already in a checkpoint or the membership index are
+    not counted as fetches; rates come from earlier runs.
+    """
+    species_list = read_species_from_file(species_file)
+    if not species_list:
+        print("No species to process. Exiting.")
+        return
+
+    entries = load_run_stats(stats_file, workers)
+    genes_per_second, measured_rate = measured_throughput(entries, workers)
+    bytes_per_request, measured_bytes = measured_bytes_per_request(entries)
+
+    print("\n=== Dry run: estimating work without fetching gene trees ===\n")
+    totals = {'genes': 0, 'fetch': 0, 'requests': 0, 'bytes': 0, 'seconds': 0}
+    for species_name in species_list:
+        species_api_info = resolve_species_api(species_name, force_api)
+        if not species_api_info:
+            print(f"{species_name}: not found in any Ensembl API")
+            continue
+        api_key = species_api_info['api_key']
+        resolver = GeneTreeResolver(api_key, species_api_info['rest_url'])
+        checkpoint_file = os.path.join(species_output_dir(species_name, api_key, gene_shard), "checkpoint.json")
+        processed_ids, _, processed_state, _ = load_checkpoint(checkpoint_file)
+
+        done = indexed = 0
+        gene_csv_file = f"{species_name.replace(' ', '_')}_protein-coding_genes.csv"
+        if os.path.exists(gene_csv_file):
+            species_genes = read_gene_list(gene_csv_file)
+            try:
+                indices = genes_to_process(species_genes, selection, gene_shard)
+            except ValueError as e:
+                print(f"{species_name}: {e}")
+                continue
+            processed = restore_processed_genes(species_genes, processed_ids, processed_state, gene_csv_file,
+                                                checkpoint_file)
+            manifest = bool(species_genes.columns)
+            if indices is None:
+                indices = range(len(species_genes))
+            genes = len(indices)
+            for index in indices:
+                gene_id = species_genes.gene_ids[index]
+                if index in processed.bitmap:
+                    done += 1
+                elif membership_index and any(membership_index.lookup(compara, gene_id)
+                                              for compara in (resolver.compara, PAN_COMPARA_DATABASE)):
+                    indexed += 1
+            source = "gene list, selected" if selection else "gene list"
+        else:
+            genes = count_genes_in_biomart(species_api_info)
+            if genes is None:
+                print(f"{species_name}: could not count genes in {api_key} dataset {species_api_info['dataset']}")
+                continue
+            if gene_shard:
+                part, parts = gene_shard
+                genes = len(range(part, genes, parts))
+            source = "BioMart count, selection not applied" if selection else "BioMart count"
+            # The gene list this run fetches will be a manifest
+            manifest = bool(manifest_columns)
+
+        to_fetch = genes - done - indexed
+        # A /lookup/id call (unless the gene list is a manifest) plus the gene
+        # tree strategies tried per fetched gene
+        requests_made = to_fetch * ((0 if manifest else 1) + resolver.expected_requests())
+        volume = requests_made * bytes_per_request
+        seconds = to_fetch / genes_per_second
+        print(f"{species_name} ({api_key}, {species_api_info['dataset']}, from {source}): {genes} genes, "
+              f"{done} already done, {indexed} in the membership index, {to_fetch} to fetch; "
+              f"~{requests_made:.0f} REST calls, ~{volume / (1024 * 1024):.1f} MB, ~{seconds / 3600:.1f} h")
+        totals['genes'] += genes
+        totals['fetch'] += to_fetch
+        totals['requests'] += requests_made
+        totals['bytes'] += volume
+        totals['seconds'] += seconds
+
+    print(f"\nTotal: {totals['genes']} genes, {totals['fetch']} to fetch; ~{totals['requests']:.0f} REST calls, "
+          f"~{totals['bytes'] / (1024 * 1024):.1f} MB, ~{totals['seconds'] / 3600:.1f} h with {workers} workers")
+    rate_source = f"measured over {len(entries)} runs" if measured_rate else "default estimate"
+    bytes_source = "measured" if measured_bytes else "default estimate"
+    print(f"Based on {genes_per_second:.2f} genes/s ({rate_source}) and "
+          f"{bytes_per_request / 1024:.0f} KB per request ({bytes_source})")
+
 def parse_arguments():
     """Parse command line arguments"""
     parser = argparse.ArgumentParser(description="Fetch gene trees from Ensembl APIs with automatic dataset detection")
     parser.add_argument("species_file", help="Text file containing species names (one per line)")
     parser.add_argument("--force", choices=['Ensembl', 'Metazoa', 'Plants', 'Fungi', 'Protists'], 
                         help="Force use of a specific Ensembl API instead of auto-detection")
+    parser.add_argument("--output-layout", choices=OUTPUT_LAYOUTS, default='files',
+                        help="Per-gene output files (files) or compressed JSONL shards with an offset index (shards)")
+    parser.add_argument("--shard-size-mb", type=int, default=DEFAULT_SHARD_SIZE // (1024 * 1024),
+                        help="Maximum size of each compressed shard in MB when using --output-layout shards")
+    parser.add_argument("--membership-index", default=DEFAULT_INDEX_FILE,
+                        help="SQLite gene -> gene tree index shared across runs; known members skip the REST lookup")
+    parser.add_argument("--no-membership-index", action="store_true",
+                        help="Do not read or update the membership index")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of genes fetched concurrently; identical in-flight requests are shared")
+    parser.add_argument("--max-attempts", type=int, default=MAX_GENE_ATTEMPTS,
+                        help="Attempts per gene, with exponential backoff, before it is written to the dead-letter report")
+    parser.add_argument("--gene-shard", type=parse_gene_shard,
+                        help="Process only part I of N of each species' genes (e.g. $SLURM_ARRAY_TASK_ID/8) "
+                             "into its own _partIIIofNNN directory")
+    parser.add_argument("--deadline",
+                        help="Wall-clock limit as [D-]HH:MM:SS from now or an ISO date-time; "
+                             "defaults to the SLURM job end time when SLURM_JOB_END_TIME is set")
+    parser.add_argument("--drain-margin", type=int, default=DEFAULT_DRAIN_MARGIN,
+                        help="Seconds before the deadline to stop dispatching genes (default: 600)")
+    parser.add_argument("--mirror-choice-file", default=MIRROR_CHOICE_FILE,
+                        help="Cache of today's fastest Ensembl mirror (www, useast or asia)")
+    parser.add_argument("--refresh-mirrors", action="store_true",
+                        help="Probe the Ensembl mirrors again even if today's choice is cached")
+    parser.add_argument("--no-mirror-selection", action="store_true",
+                        help="Skip the mirror probe and use www.ensembl.org first")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Send a duplicate gene tree request when one runs past the observed p95 latency")
+    parser.add_argument("--hedge-budget", type=float, default=HEDGE_MAX_EXTRA,
+                        help="Maximum duplicate requests as a fraction of gene tree requests (default: 0.05)")
+    parser.add_argument("--gene-ids",
+                        help="Only process these gene IDs: a file with one per line or a comma-separated list")
+    parser.add_argument("--gene-symbols",
+                        help="Only process genes with these symbols (case-insensitive): a file or a comma-separated list")
+    parser.add_argument("--symbol-regex", help="Only process genes whose symbol matches this regular expression")
+    parser.add_argument("--region", type=parse_region, action="append",
+                        help="Only process genes on CHROMOSOME or overlapping CHROMOSOME:START-END; may be repeated "
+                             "(needs a gene list with location columns)")
+    parser.add_argument("--sample", type=int, help="Process a random sample of this many of the selected genes")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for --sample; keep it fixed to resume the same sample (default: 0)")
+    parser.add_argument("--manifest-columns", type=parse_manifest_columns, default=DEFAULT_MANIFEST_COLUMNS,
+                        help="Extra BioMart columns written to new gene lists, comma-separated, or 'none' "
+                             f"(default: {','.join(DEFAULT_MANIFEST_COLUMNS)}). Genes from such a list skip "
+                             "the per-gene /lookup/id request")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Estimate REST calls, data volume and duration per species without fetching trees")
+    parser.add_argument("--quiet", action="store_true",
+                        help="Replace per-gene output with one aggregated progress line per species")
+    parser.add_argument("--progress-interval", type=float, default=DEFAULT_PROGRESS_INTERVAL,
+                        help="Seconds between progress lines in --quiet mode (default: 30)")
+    parser.add_argument("--log-file", default=f'ensembl_gene_tree_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log',
+                        help="Log file (default: ensembl_gene_tree_<timestamp>.log)")
+    parser.add_argument("--no-log", action="store_true", help="Do not write a log file")
+    parser.add_argument("--log-level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='DEBUG',
+                        help="Log level; INFO logs one record per gene outcome (default: DEBUG)")
+    parser.add_argument("--log-format", choices=['text', 'json'], default='text',
+                        help="Log as text lines or as one JSON object per line")
     return parser.parse_args()
 
 # Run the main function
 if __name__ == "__main__":
-    # Set up signal handler
+    # Set up signal handler; SIGUSR1 suits sbatch --signal=B:USR1@<seconds>
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGUSR1, signal_handler)
     
     # Parse command line arguments
     args = parse_arguments()
+    configure_logging(None if args.no_log else args.log_file, args.log_level, args.log_format)
+    console = ensembl_transport.console = True
+    quiet = args.quiet
+    progress_interval = args.progress_interval
+    selection = selection_from_args(args)
+    
+    deadline = parse_deadline(args.deadline) if args.deadline else slurm_deadline()
+    if deadline is not None:
+        run_deadline = deadline - args.drain_margin
+        print(f"Will stop dispatching genes at {datetime.fromtimestamp(run_deadline).strftime('%Y-%m-%d %H:%M:%S')}")
     
+    membership_index = None if args.no_membership_index else GeneTreeIndex(args.membership_index)
+    
+    if not args.no_mirror_selection:
+        select_mirrors(get_transport(), args.mirror_choice_file, refresh=args.refresh_mirrors)
+    if args.hedge:
+        get_transport().enable_hedging(args.hedge_budget, workers=args.workers)
+    
+    exit_code = 0
     try:
-        process_all_gene_trees(args.species_file, args.force)
-        print("\nAll species have been processed successfully.")
+        if args.dry_run:
+            dry_run(args.species_file, args.force, membership_index=membership_index,
+                    workers=args.workers, gene_shard=args.gene_shard, manifest_columns=args.manifest_columns,
+                    selection=selection)
+        else:
+            process_all_gene_trees(args.species_file, args.force,
+                                   output_layout=args.output_layout,
+                                   shard_size=args.shard_size_mb * 1024 * 1024,
+                                   membership_index=membership_index,
+                                   workers=args.workers,
+                                   max_attempts=args.max_attempts,
+                                   gene_shard=args.gene_shard,
+                                   manifest_columns=args.manifest_columns,
+                                   selection=selection)
+            print("\nAll species have been processed successfully.")
+    except RunInterrupted as e:
+        print(f"\n{e}. Output and checkpoint are complete; run the same command again to resume.")
+        logging.info(f"Run interrupted: {e}")
+        exit_code = EXIT_RESUMABLE
     except Exception as e:
         print(f"\nAn error occurred: {e}")
         logging.exception("Fatal error")
@@ -1016,3 +2365,13 @@ if __name__ == "__main__":
             print("Saving checkpoint before exiting...")
             save_checkpoint(processed_genes, current_checkpoint_file)
         print("You can resume later by running the script again.")
+    finally:
+        if membership_index:
+            membership_index.close()
+        stats = get_transport().stats()
+        logging.info(f"Transport statistics: {stats}")
+        if args.hedge:
+            print(f"Hedged {stats['hedged']} of {stats['hedgeable']} gene tree requests; "
+                  f"the duplicate answered first {stats['hedge_wins']} times "
+                  f"({stats['hedge_over_budget']} slow requests not hedged to stay within budget)")
+    sys.exit(exit_code)
@@ -0,0 +1,657 @@
+"""
+Ensembl HTTP Transport
+
+Shared HTTP layer for the Ensembl REST and BioMart calls made by
+ensembl_gene_tree.py. All requests go through one requests.Session, and
+identical requests that are in flight at the same time are coalesced: the
+first caller performs the request, every concurrent caller with the same
+method, URL, parameters and body waits for it and receives the same
+response object (including its parsed JSON).
+
+Every origin (scheme + host) has a circuit breaker. Consecutive errors or
+slow responses trip it; while it is open, requests go to the next mirror
+of the same site (www, useast and asia for ensembl.org) or fail at once
+instead of waiting out their timeouts. A background probe closes the
+breaker again once the origin answers.
+
+select_mirrors() probes every origin of each mirror group at startup and
+moves the one with the lowest round-trip time to the front of its group; the choice is cached for the
+rest of the day in MIRROR_CHOICE_FILE.
+
+With hedging enabled, a request tagged with a hedge key that is still
+running after the p95 latency observed for that key gets a duplicate, and
+whichever finishes first is used. Duplicates are capped at a fraction of
+all hedgeable requests.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError as FuturesTimeout, wait
+from datetime import date
+from urllib.parse import urlsplit
+
+import requests
+
+# Interchangeable origins by site. A request for any origin in a group can be
+# served by the others; the first entry is the default preference.
+MIRROR_GROUPS = {
+    'ensembl.org': ['https://www.ensembl.org', 'https://useast.ensembl.org', 'https://asia.ensembl.org']
+}
+
+# Cheap URL path used to check whether a tripped origin has recovered
+PROBE_PATHS = {
+    'https://rest.ensembl.org': '/info/ping?content-type=application/json',
+    'https://rest.ensemblgenomes.org': '/info/ping?content-type=application/json'
+}
+DEFAULT_PROBE_PATH = '/biomart/martservice?type=registry'
+
+MIRROR_CHOICE_FILE = 'ensembl_mirror_choice.json'
+MIRROR_PROBE_ROUNDS = 3
+
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 500
+HEDGE_MAX_EXTRA = 0.05
+# Threads running hedgeable requests; at least two per gene worker, so a
+# primary and its duplicate never wait for a free thread
+HEDGE_MIN_THREADS = 16
+
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_SLOW_CALL_SECONDS = 30
+# A request given a longer timeout (BioMart queries) only counts as slow past
+# this fraction of it
+BREAKER_SLOW_CALL_FRACTION = 0.8
+BREAKER_RESET_SECONDS = 30
+BREAKER_MAX_RESET_SECONDS = 300
+
+# Breaker changes are also printed when set by a command line script;
+# library use only logs them
+console = False
+
+class RateLimiter:
+    """
+    Token bucket allowing rate requests per second on average, in bursts of
+    at most burst requests
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+    Raised without touching the network when every origin able to serve a
+    request has an open circuit breaker
+    """
+
+class CircuitBreaker:
+    """
+    Per-origin breaker: closed -> open after repeated failures -> closed
+    again when a background probe succeeds
+    """
+
+    def __init__(self, origin, probe, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 slow_call_seconds=BREAKER_SLOW_CALL_SECONDS, reset_seconds=BREAKER_RESET_SECONDS):
+        self.origin = origin
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        return self.state == 'closed'
+
+    def record(self, ok, elapsed, timeout=None):
+        """
+        Record the outcome of a call; slow successes count as failures. A
+        call is slow past slow_call_seconds, or past most of its own timeout
+        when that is longer.
+        """
+        if isinstance(timeout, tuple):
+            # (connect, read) timeout
+            timeout = timeout[-1]
+        slow_call_seconds = max(self.slow_call_seconds, (timeout or 0) * BREAKER_SLOW_CALL_FRACTION)
+        failed = not ok or elapsed > slow_call_seconds
+        with self._lock:
+            if not failed:
+                self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if self.state != 'closed' or self.consecutive_failures < self.failure_threshold:
+                return
+            self.state = 'open'
+            self.trips += 1
+        reason = f"{self.consecutive_failures} consecutive failures or slow responses"
+        if console:
+            print(f"Circuit breaker for {self.origin} opened after {reason}")
+        logging.warning(f"Circuit breaker for {self.origin} opened after {reason}")
+        threading.Thread(target=self._probe_until_recovered, name=f"probe {self.origin}", daemon=True).start()
+
+    def _probe_until_recovered(self):
+        wait = self.reset_seconds
+        while True:
+            time.sleep(wait)
+            if self.probe(self.origin):
+                with self._lock:
+                    self.state = 'closed'
+                    self.consecutive_failures = 0
+                if console:
+                    print(f"Circuit breaker for {self.origin} closed; origin is answering again")
+                logging.info(f"Circuit breaker for {self.origin} closed after successful probe")
+                return
+            wait = min(wait * 2, BREAKER_MAX_RESET_SECONDS)
+
+class RequestHedger:
+    """
+    Issue a duplicate of a slow request once it exceeds the observed latency
+    percentile for its kind, keeping duplicates below max_extra of requests
+    """
+
+    def __init__(self, max_extra=HEDGE_MAX_EXTRA, percentile=HEDGE_PERCENTILE,
+                 min_samples=HEDGE_MIN_SAMPLES, window=HEDGE_WINDOW, max_workers=HEDGE_MIN_THREADS):
+        self.max_extra = max_extra
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+        self.latencies = {}
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.over_budget = 0
+        self._lock = threading.Lock()
+
+    def threshold(self, key):
+        """
+        Latency percentile for a request kind, or None until enough samples
+        """
+        with self._lock:
+            samples = self.latencies.get(key)
+            if not samples or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        # Nearest-rank percentile
+        rank = -(-len(ordered) * self.percentile // 100)
+        return ordered[max(rank - 1, 0)]
+
+    def _timed(self, key, func):
+        start = time.monotonic()
+        result = func()
+        elapsed = time.monotonic() - start
+        with self._lock:
+            samples = self.latencies.get(key)
+            if samples is None:
+                samples = self.latencies[key] = deque(maxlen=self.window)
+            samples.append(elapsed)
+        return result
+
+    def resize(self, max_workers):
+        """
+        Grow the thread pool to max_workers threads
+        """
+        if max_workers <= self.max_workers:
+            return
+        old = self.executor
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+        self.max_workers = max_workers
+        old.shutdown(wait=False)
+
+    def run(self, key, func):
+        delay = self.threshold(key)
+        with self._lock:
+            self.requests += 1
+        started = threading.Event()
+
+        def primary_call():
+            started.set()
+            return self._timed(key, func)
+
+        primary = self.executor.submit(primary_call)
+        if delay is None:
+            return primary.result()
+        # Time spent queued for a thread is not the request being slow
+        started.wait()
+        try:
+            return primary.result(timeout=delay)
+        except FuturesTimeout:
+            pass
+
+        with self._lock:
+            allowed = self.hedged < self.max_extra * self.requests
+            if allowed:
+                self.hedged += 1
+            else:
+                self.over_budget += 1
+        if not allowed:
+            return primary.result()
+
+        logging.debug(f"Hedging {key} request after {delay:.2f} s")
+        hedge = self.executor.submit(self._timed, key, func)
+        done, _ = wait((primary, hedge), return_when=FIRST_COMPLETED)
+        first = primary if primary in done else hedge
+        if first.exception() is not None:
+            # The other copy may still succeed
+            other = hedge if first is primary else primary
+            if other.exception() is None:
+                first = other
+        if first.exception() is not None:
+            return primary.result()
+        if first is hedge:
+            with self._lock:
+                self.hedge_wins += 1
+        return first.result()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hedgeable': self.requests,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'hedge_over_budget': self.over_budget
+            }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+def split_origin(url):
+    """
+    Split a URL into (origin, rest) where origin is scheme://host[:port]
+    """
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}"
+    return origin, url[len(origin):]
+
+class SharedResponse:
+    """
+    Fully read HTTP response that can be handed to several callers
+
+    The body is read once by the request that produced it and json() parses
+    it at most once; callers must treat the parsed data as read-only.
+    """
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = response.url
+        self.content = response.content
+        self.encoding = response.encoding or 'utf-8'
+        self._text = None
+        self._json = None
+        self._json_parsed = False
+        self._lock = threading.Lock()
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.content.decode(self.encoding, errors='replace')
+        return self._text
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        with self._lock:
+            if not self._json_parsed:
+                self._json = json.loads(self.text)
+                self._json_parsed = True
+        return self._json
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Run at most one call per key at a time; concurrent callers share its result
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+class EnsemblTransport:
+    """
+    Session-backed HTTP client with single-flight request coalescing,
+    per-origin circuit breakers and mirror failover
+    """
+
+    def __init__(self, session=None, mirror_groups=None, rate_limit=None):
+        self.session = session or requests.Session()
+        # Requests per second across all threads using this transport
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self.single_flight = SingleFlight()
+        groups = mirror_groups if mirror_groups is not None else MIRROR_GROUPS
+        self.mirror_groups = {site: list(origins) for site, origins in groups.items()}
+        self.breakers = {}
+        self.failovers = 0
+        self.fast_failures = 0
+        self.bytes_received = 0
+        self.hedger = None
+        self._lock = threading.Lock()
+
+    def enable_hedging(self, max_extra=HEDGE_MAX_EXTRA, workers=1):
+        """
+        Hedge requests made with a hedge key, adding at most max_extra
+        duplicate requests per hedgeable request. workers is the number of
+        threads making hedgeable requests; the hedge pool gets two per worker.
+        """
+        max_workers = max(HEDGE_MIN_THREADS, 2 * workers)
+        if self.hedger is None:
+            self.hedger = RequestHedger(max_extra=max_extra, max_workers=max_workers)
+        else:
+            self.hedger.max_extra = max_extra
+            self.hedger.resize(max_workers)
+        return self.hedger
+
+    def breaker(self, origin):
+        with self._lock:
+            breaker = self.breakers.get(origin)
+            if breaker is None:
+                breaker = CircuitBreaker(origin, self.probe)
+                self.breakers[origin] = breaker
+            return breaker
+
+    def mirrors_for(self, origin):
+        """
+        Origins that can serve a request for origin, in order of preference
+        """
+        for origins in self.mirror_groups.values():
+            if origin in origins:
+                return list(origins)
+        return [origin]
+
+    def is_available(self, url):
+        """
+        Whether some origin able to serve url has a closed circuit breaker
+        """
+        origin, _ = split_origin(url)
+        return any(self.breaker(candidate).allow() for candidate in self.mirrors_for(origin))
+
+    def wait_until_available(self, url, timeout, poll=1.0):
+        """
+        Wait up to timeout seconds for a breaker probe to close a circuit for
+        url; returns whether one is closed
+        """
+        deadline = time.monotonic() + timeout
+        while not self.is_available(url):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll)
+        return True
+
+    def set_preferred_mirror(self, origin):
+        """
+        Move an origin to the front of its mirror group
+        """
+        with self._lock:
+            for origins in self.mirror_groups.values():
+                if origin in origins:
+                    origins.remove(origin)
+                    origins.insert(0, origin)
+
+    def preferred_url(self, url):
+        """
+        url rewritten to the preferred mirror of its origin
+        """
+        origin, rest = split_origin(url)
+        return f"{self.mirrors_for(origin)[0]}{rest}"
+
+    def measure(self, origin, rounds=MIRROR_PROBE_ROUNDS, timeout=10):
+        """
+        Best round-trip time in seconds to an origin's response headers, or
+        None if it did not answer. The probe body is a few KB, too small to
+        measure bandwidth, so mirrors are compared on latency alone.
+        """
+        path = PROBE_PATHS.get(origin, DEFAULT_PROBE_PATH)
+        best_rtt = None
+        for _ in range(rounds):
+            start = time.monotonic()
+            try:
+                response = self.session.get(f"{origin}{path}", timeout=timeout, stream=True)
+                rtt = time.monotonic() - start
+                response.close()
+            except requests.RequestException as e:
+                logging.info(f"Mirror probe of {origin} failed: {e}")
+                return None
+            if response.status_code >= 500:
+                return None
+            best_rtt = rtt if best_rtt is None else min(best_rtt, rtt)
+        return best_rtt
+
+    def probe(self, origin, timeout=10):
+        path = PROBE_PATHS.get(origin, DEFAULT_PROBE_PATH)
+        try:
+            response = self.session.get(f"{origin}{path}", timeout=timeout)
+            return response.status_code < 500
+        except requests.RequestException:
+            return False
+
+    def _send(self, method, url, **kwargs):
+        """
+        Send one request, failing over between mirrors with closed breakers
+        """
+        origin, rest = split_origin(url)
+        candidates = self.mirrors_for(origin)
+        available = [o for o in candidates if self.breaker(o).allow()]
+        if not available:
+            self.fast_failures += 1
+            raise CircuitOpenError(f"Circuit open for {', '.join(candidates)}; not requesting {url}")
+
+        for position, candidate in enumerate(available):
+            last = position == len(available) - 1
+            target = f"{candidate}{rest}"
+            if candidate != origin:
+                logging.info(f"Routing request for {origin} to mirror {candidate}")
+            breaker = self.breaker(candidate)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, target, **kwargs)
+            except requests.RequestException:
+                breaker.record(False, time.monotonic() - start, kwargs.get('timeout'))
+                if last:
+                    raise
+                self.failovers += 1
+                continue
+            server_error = response.status_code >= 500 or response.status_code == 429
+            breaker.record(not server_error, time.monotonic() - start, kwargs.get('timeout'))
+            if server_error and not last:
+                self.failovers += 1
+                continue
+            shared = SharedResponse(response)
+            with self._lock:
+                self.bytes_received += len(shared.content)
+            return shared
+
+    def request(self, method, url, params=None, data=None, headers=None, timeout=60, verify=True, hedge=None):
+        """
+        Perform a request (coalesced with identical in-flight requests) and
+        return a SharedResponse. Network errors propagate as requests
+        exceptions to every waiting caller. hedge names the kind of request
+        whose latency decides when to send a duplicate, if hedging is on.
+        """
+        accept = (headers or {}).get('Accept') or (headers or {}).get('Content-Type')
+        key = (method.upper(), url, _freeze(params), _freeze(data), accept)
+
+        def send():
+            return self._send(method, url, params=params, data=data, headers=headers,
+                              timeout=timeout, verify=verify)
+
+        def perform():
+            if hedge and self.hedger is not None:
+                return self.hedger.run(hedge, send)
+            return send()
+
+        return self.single_flight.do(key, perform)
+
+    def get(self, url, params=None, headers=None, timeout=60, verify=True, hedge=None):
+        return self.request('GET', url, params=params, headers=headers, timeout=timeout, verify=verify,
+                            hedge=hedge)
+
+    def post(self, url, data=None, headers=None, timeout=60, verify=True):
+        return self.request('POST', url, data=data, headers=headers, timeout=timeout, verify=verify)
+
+    def stats(self):
+        stats = {
+            'requests': self.single_flight.calls,
+            'coalesced': self.single_flight.coalesced,
+            'failovers': self.failovers,
+            'fast_failures': self.fast_failures,
+            'bytes_received': self.bytes_received,
+            'breaker_trips': sum(b.trips for b in self.breakers.values())
+        }
+        if self.hedger is not None:
+            stats.update(self.hedger.stats())
+        return stats
+
+    def close(self):
+        if self.hedger is not None:
+            self.hedger.close()
+        self.session.close()
+
+def _load_mirror_choice(choice_file):
+    try:
+        with open(choice_file, 'r') as f:
+            choice = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if choice.get('date') != date.today().isoformat():
+        return {}
+    return choice.get('preferred', {})
+
+def _save_mirror_choice(choice_file, preferred):
+    # Named after the process: concurrent jobs may save the choice at once
+    temp_file = f"{choice_file}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump({'date': date.today().isoformat(), 'preferred': preferred}, f, indent=2)
+        os.replace(temp_file, choice_file)
+    except OSError:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+def select_mirrors(transport, choice_file=MIRROR_CHOICE_FILE, refresh=False):
+    """
+    Prefer the fastest origin of each mirror group, probing each one unless
+    today's choice is already cached. Returns {site: chosen origin}.
+    """
+    cached = {} if refresh else _load_mirror_choice(choice_file)
+    preferred = {}
+    probed = False
+    for site, origins in transport.mirror_groups.items():
+        if len(origins) < 2:
+            continue
+        chosen = cached.get(site)
+        if chosen not in origins:
+            scores = []
+            for origin in list(origins):
+                rtt = transport.measure(origin)
+                if rtt is None:
+                    print(f"Mirror {origin}: no response")
+                    continue
+                print(f"Mirror {origin}: {rtt * 1000:.0f} ms round trip")
+                scores.append((rtt, origin))
+            probed = True
+            if not scores:
+                logging.warning(f"No mirror of {site} answered the probe; keeping the default order")
+                continue
+            chosen = min(scores)[1]
+        transport.set_preferred_mirror(chosen)
+        preferred[site] = chosen
+        print(f"Using {chosen} for {site} traffic")
+        logging.info(f"Preferred mirror for {site}: {chosen}")
+    if probed and preferred:
+        try:
+            _save_mirror_choice(choice_file, preferred)
+        except OSError as e:
+            logging.warning(f"Could not cache mirror choice in {choice_file}: {e}")
+    return preferred
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+def get_transport():
+    """
+    Process-wide transport shared by the module-level fetch functions
+    """
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = EnsemblTransport()
+            logging.debug("Created default Ensembl transport")
+        return _default_transport
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""
+Gene Family Analysis
+
+Aggregates downloaded gene trees into per-species gene copy counts. Trees
+are read from any species output directory (per-file or shard layout) or a
+tree store, deduplicated by their Compara stable ID, and counted once no
+matter how many of our genes pointed at them.
+
+Usage:
+  # Species x family copy-number table for CAFE
+  python gene_family_analysis.py matrix Daphnia_pulex_gene_tree_files_metazoa ... --species-file species_list.txt --output families.tsv
+
+  # Per-tree species presence bitsets and copy counts, then queries over all trees at once
+  python gene_family_analysis.py index Daphnia_pulex_gene_tree_files_metazoa ... --species-file species_list.txt --output tree_species_index.npz
+  python gene_family_analysis.py query tree_species_index.npz --single-copy
+  python gene_family_analysis.py query tree_species_index.npz --min-present 8 --absent-in "Mnemiopsis leidyi" "Amphimedon queenslandica"
+"""
+
+import argparse
+import csv
+import logging
+import sys
+
+import numpy as np
+
+from gene_tree_store import iter_stored_trees
+from gene_tree_traversal import summarize_gene_tree
+
+class FamilyCountMatrix:
+    """
+    Gene copies per species per gene tree, stored sparsely as coordinate
+    arrays (species index, family index, count)
+    """
+
+    def __init__(self, species, family_ids, species_index, family_index, counts):
+        self.species = list(species)
+        self.family_ids = list(family_ids)
+        self.species_index = np.asarray(species_index, dtype=np.int32)
+        self.family_index = np.asarray(family_index, dtype=np.int32)
+        self.counts = np.asarray(counts, dtype=np.int32)
+
+    @property
+    def shape(self):
+        return len(self.species), len(self.family_ids)
+
+    def to_dense(self):
+        """
+        Dense species x family count array
+        """
+        matrix = np.zeros(self.shape, dtype=np.int32)
+        np.add.at(matrix, (self.species_index, self.family_index), self.counts)
+        return matrix
+
+    def to_sparse(self):
+        """
+        scipy.sparse CSC matrix (species x family); requires scipy
+        """
+        from scipy import sparse
+        return sparse.csc_matrix((self.counts, (self.species_index, self.family_index)), shape=self.shape)
+
+    def family_species_counts(self):
+        """
+        Number of species each family is present in
+        """
+        return np.bincount(self.family_index, minlength=len(self.family_ids))
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            species=np.array(self.species, dtype=object),
+            family_ids=np.array(self.family_ids, dtype=object),
+            species_index=self.species_index,
+            family_index=self.family_index,
+            counts=self.counts
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=True)
+        return cls(data['species'].tolist(), data['family_ids'].tolist(),
+                   data['species_index'], data['family_index'], data['counts'])
+
+def collect_family_counts(sources, species_filter=None):
+    """
+    Count gene copies per species for every distinct tree in the sources
+
+    species_filter restricts the columns to the given scientific names (in
+    that order); otherwise every species seen in any tree is kept, ordered
+    by first appearance.
+    """
+    species = list(species_filter) if species_filter else []
+    species_positions = {name: i for i, name in enumerate(species)}
+    family_ids = []
+    seen_trees = set()
+    rows, cols, values = [], [], []
+
+    for source in sources:
+        for tree_id, gene_tree_info in iter_stored_trees(source):
+            if not tree_id or tree_id in seen_trees:
+                continue
+            seen_trees.add(tree_id)
+
+            per_species = {}
+            for leaf in summarize_gene_tree(gene_tree_info).leaves:
+                if leaf.species:
+                    per_species[leaf.species] = per_species.get(leaf.species, 0) + 1
+
+            family = len(family_ids)
+            family_ids.append(tree_id)
+            for name, count in per_species.items():
+                position = species_positions.get(name)
+                if position is None:
+                    if species_filter:
+                        continue
+                    position = len(species)
+                    species_positions[name] = position
+                    species.append(name)
+                rows.append(position)
+                cols.append(family)
+                values.append(count)
+        logging.info(f"Read trees from {source}: {len(family_ids)} distinct trees so far")
+
+    return FamilyCountMatrix(species, family_ids, rows, cols, values)
+
+def write_cafe_table(matrix, output_file, min_species=1):
+    """
+    Write the CAFE gene family table: Desc, Family ID, one column per species.
+    Returns the number of families written.
+    """
+    # Walk the coordinates grouped by family so no dense matrix is needed
+    order = np.argsort(matrix.family_index, kind='stable')
+    family_index = matrix.family_index[order]
+    species_index = matrix.species_index[order]
+    counts = matrix.counts[order]
+    bounds = np.searchsorted(family_index, np.arange(len(matrix.family_ids) + 1))
+    keep = np.nonzero(matrix.family_species_counts() >= min_species)[0]
+    header = ['Desc', 'Family ID'] + [name.replace(' ', '_') for name in matrix.species]
+
+    row = np.zeros(len(matrix.species), dtype=np.int32)
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(header)
+        for family in keep:
+            start, end = bounds[family], bounds[family + 1]
+            row[:] = 0
+            row[species_index[start:end]] = counts[start:end]
+            writer.writerow(['(null)', matrix.family_ids[family]] + row.tolist())
+    return len(keep)
+
+# Number of set bits in every byte value, for popcounts over packed bitsets
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+class TreeSpeciesIndex:
+    """
+    Per-tree species presence bitsets and copy-count vectors
+
+    copy_counts is a (trees x species) uint16 array and presence the same
+    information packed to one bit per species (np.packbits, big-endian bit
+    order), so presence queries are byte-wise AND/popcounts over all trees.
+    """
+
+    def __init__(self, species, tree_ids, copy_counts):
+        self.species = list(species)
+        self.tree_ids = np.asarray(tree_ids, dtype=object)
+        self.copy_counts = np.asarray(copy_counts, dtype=np.uint16)
+        self.presence = np.packbits(self.copy_counts > 0, axis=1)
+        self._species_positions = {name: i for i, name in enumerate(self.species)}
+
+    @classmethod
+    def from_family_counts(cls, matrix):
+        counts = np.zeros((len(matrix.family_ids), len(matrix.species)), dtype=np.uint16)
+        clipped = np.minimum(matrix.counts, np.iinfo(np.uint16).max).astype(np.uint16)
+        counts[matrix.family_index, matrix.species_index] = clipped
+        return cls(matrix.species, matrix.family_ids, counts)
+
+    def __len__(self):
+        return len(self.tree_ids)
+
+    def save(self, path):
+        np.savez_compressed(path, species=np.array(self.species, dtype=object),
+                            tree_ids=self.tree_ids, copy_counts=self.copy_counts,
+                            presence=self.presence)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path, allow_pickle=True)
+        return cls(data['species'].tolist(), data['tree_ids'], data['copy_counts'])
+
+    def species_columns(self, names=None):
+        """
+        Column indices for species names (all species when names is None)
+        """
+        if names is None:
+            return np.arange(len(self.species))
+        missing = [name for name in names if name not in self._species_positions]
+        if missing:
+            raise ValueError(f"Species not in index: {', '.join(missing)}")
+        return np.array([self._species_positions[name] for name in names], dtype=np.intp)
+
+    def species_bitmask(self, names=None):
+        """
+        Packed bitmask with the bits of the given species set
+        """
+        selected = np.zeros(len(self.species), dtype=bool)
+        selected[self.species_columns(names)] = True
+        return np.packbits(selected)
+
+    def present_count(self, names=None):
+        """
+        Number of the given species present in each tree
+        """
+        return _POPCOUNT[self.presence & self.species_bitmask(names)].sum(axis=1, dtype=np.int32)
+
+    def single_copy(self, names=None):
+        """
+        Trees with exactly one gene in each of the given species
+        """
+        columns = self.species_columns(names)
+        return (self.copy_counts[:, columns] == 1).all(axis=1)
+
+    def present_in_at_least(self, k, names=None):
+        """
+        Trees present in at least k of the given species
+        """
+        return self.present_count(names) >= k
+
+    def absent_in(self, names):
+        """
+        Trees with no gene in any of the given species (e.g. a clade)
+        """
+        return ~(self.presence & self.species_bitmask(names)).any(axis=1)
+
+def write_tree_selection(index, selected, output_file, names=None):
+    """
+    Write selected trees with their per-species copy counts. Returns the count.
+    """
+    columns = index.species_columns(names)
+    rows = np.nonzero(selected)[0]
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['tree_id'] + [index.species[c].replace(' ', '_') for c in columns])
+        for row in rows:
+            writer.writerow([index.tree_ids[row]] + index.copy_counts[row, columns].tolist())
+    return len(rows)
+
+def read_species_filter(filename):
+    """
+    Read species names (one per line, '#' comments allowed)
+    """
+    with open(filename, 'r') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+def parse_arguments():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Aggregate downloaded gene trees into gene family statistics")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    matrix = subparsers.add_parser('matrix', help="Build a species x family copy-number table")
+    matrix.add_argument("sources", nargs='+',
+                        help="Species output directories (per-file or shard layout) or tree stores")
+    matrix.add_argument("--species-file",
+                        help="Only count these species (one 'Genus species' per line); default is every species seen")
+    matrix.add_argument("--min-species", type=int, default=1,
+                        help="Only write families present in at least this many species")
+    matrix.add_argument("--output", "-o", default="gene_family_counts.tsv", help="CAFE table to write")
+    matrix.add_argument("--npz", help="Also save the sparse count matrix to this .npz file")
+
+    index = subparsers.add_parser('index', help="Build per-tree species presence bitsets and copy counts")
+    index.add_argument("sources", nargs='+',
+                       help="Species output directories (per-file or shard layout) or tree stores")
+    index.add_argument("--species-file",
+                       help="Index only these species (one 'Genus species' per line); default is every species seen")
+    index.add_argument("--output", "-o", default="tree_species_index.npz", help="Index file to write")
+
+    query = subparsers.add_parser('query', help="Select trees from a species index")
+    query.add_argument("index", help="Index built with the index command")
+    query.add_argument("--species-file",
+                       help="Species the query applies to (default: every species in the index)")
+    query.add_argument("--single-copy", action="store_true",
+                       help="Exactly one gene in each selected species")
+    query.add_argument("--min-present", type=int,
+                       help="Present in at least this many of the selected species")
+    query.add_argument("--absent-in", nargs='+', metavar="SPECIES",
+                       help="No gene in any of these species (e.g. an outgroup clade)")
+    query.add_argument("--output", "-o", default="selected_gene_trees.tsv", help="Selected trees to write")
+    return parser.parse_args()
+
+def main():
+    """Main function"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_arguments()
+
+    if args.command == 'matrix':
+        species_filter = read_species_filter(args.species_file) if args.species_file else None
+        matrix = collect_family_counts(args.sources, species_filter)
+        if not matrix.family_ids:
+            print("No gene trees found in the given sources.")
+            sys.exit(1)
+        written = write_cafe_table(matrix, args.output, args.min_species)
+        print(f"Counted {len(matrix.family_ids)} distinct gene trees across {len(matrix.species)} species")
+        print(f"Wrote {written} families to {args.output}")
+        if args.npz:
+            matrix.save(args.npz)
+            print(f"Saved count matrix to {args.npz}")
+
+    elif args.command == 'index':
+        species_filter = read_species_filter(args.species_file) if args.species_file else None
+        matrix = collect_family_counts(args.sources, species_filter)
+        index = TreeSpeciesIndex.from_family_counts(matrix)
+        index.save(args.output)
+        print(f"Indexed {len(index)} distinct gene trees across {len(index.species)} species into {args.output}")
+
+    elif args.command == 'query':
+        if not (args.single_copy or args.min_present is not None or args.absent_in):
+            print("Specify at least one of --single-copy, --min-present or --absent-in")
+            sys.exit(2)
+        index = TreeSpeciesIndex.load(args.index)
+        names = read_species_filter(args.species_file) if args.species_file else None
+        try:
+            selected = np.ones(len(index), dtype=bool)
+            if args.single_copy:
+                selected &= index.single_copy(names)
+            if args.min_present is not None:
+                selected &= index.present_in_at_least(args.min_present, names)
+            if args.absent_in:
+                selected &= index.absent_in(args.absent_in)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(2)
+        written = write_tree_selection(index, selected, args.output, names)
+        print(f"{written} of {len(index)} gene trees match; written to {args.output}")
+
+if __name__ == "__main__":
+    main()
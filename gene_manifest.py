@@ -0,0 +1,240 @@
+"""
+Gene Manifest
+
+Column-oriented in-memory form of a species gene list. Gene IDs, symbols
+and manifest columns are held in one list per column, with values
+interned so repeated strings (chromosome names, empty fields, common
+descriptions) are stored once. Each gene is addressed by its index in the
+list. GeneBitmap holds one status bit per gene index, and ProcessedGenes
+offers the set-of-gene-IDs interface of checkpoints on top of a bitmap.
+Checkpoints store that bitmap with a digest of the gene list it indexes,
+so resuming restores it directly instead of rebuilding it gene by gene.
+When the gene list has changed, a bitmap is carried over by gene ID using
+the gene order it was saved with.
+"""
+
+import base64
+import hashlib
+import sys
+import zlib
+
+def gene_list_digest(gene_ids):
+    """
+    SHA-1 of gene IDs in order; bitmaps saved for one list only apply to a
+    list with the same digest
+    """
+    sha = hashlib.sha1()
+    for gene_id in gene_ids:
+        sha.update(gene_id.encode())
+        sha.update(b'\n')
+    return sha.hexdigest()
+
+class GeneManifest:
+    """
+    Genes of a gene list by index, stored column by column
+    """
+
+    def __init__(self, columns=()):
+        self.columns = list(columns)
+        self.gene_ids = []
+        self.gene_symbols = []
+        self.values = {column: [] for column in self.columns}
+        self._index = {}
+        self._digest = None
+
+    def append(self, gene):
+        """
+        Add a gene dict (gene_id, gene_symbol and the manifest columns) and
+        return its index; a gene ID seen before keeps its first index
+        """
+        gene_id = sys.intern(gene['gene_id'])
+        index = self._index.get(gene_id)
+        if index is not None:
+            return index
+        index = len(self.gene_ids)
+        self._index[gene_id] = index
+        self._digest = None
+        self.gene_ids.append(gene_id)
+        self.gene_symbols.append(sys.intern(gene['gene_symbol']))
+        for column in self.columns:
+            self.values[column].append(sys.intern(gene.get(column) or ''))
+        return index
+
+    def index_of(self, gene_id):
+        return self._index.get(gene_id)
+
+    def digest(self):
+        if self._digest is None:
+            self._digest = gene_list_digest(self.gene_ids)
+        return self._digest
+
+    def gene(self, index):
+        """
+        The gene at an index as a dict, in the form the gene list was read in
+        """
+        gene = {'gene_id': self.gene_ids[index], 'gene_symbol': self.gene_symbols[index]}
+        for column in self.columns:
+            gene[column] = self.values[column][index]
+        return gene
+
+    def take(self, indices):
+        """
+        New manifest with the genes at the given indices, in that order
+        """
+        subset = GeneManifest(self.columns)
+        for index in indices:
+            subset.append(self.gene(index))
+        return subset
+
+    def __len__(self):
+        return len(self.gene_ids)
+
+    def __contains__(self, gene_id):
+        return gene_id in self._index
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.gene(index) for index in range(*key.indices(len(self)))]
+        return self.gene(key)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.gene(index)
+
+class GeneBitmap:
+    """
+    One bit per gene index
+    """
+
+    def __init__(self, size, data=None):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8) if data is None else bytearray(data)
+
+    def add(self, index):
+        """
+        Set a bit; returns True if it was not set before
+        """
+        byte, mask = index >> 3, 1 << (index & 7)
+        if self.bits[byte] & mask:
+            return False
+        self.bits[byte] |= mask
+        return True
+
+    def discard(self, index):
+        self.bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+    def __contains__(self, index):
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def count(self):
+        return bin(int.from_bytes(self.bits, 'little')).count('1')
+
+    def iter_set(self):
+        for byte_index, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield byte_index * 8 + bit
+
+    def encode(self):
+        return base64.b64encode(zlib.compress(bytes(self.bits))).decode('ascii')
+
+    @classmethod
+    def decode(cls, size, text):
+        data = zlib.decompress(base64.b64decode(text))
+        if len(data) != (size + 7) // 8:
+            raise ValueError(f"bitmap of {len(data)} bytes does not cover {size} genes")
+        return cls(size, data)
+
+    def iter_clear(self, start=0):
+        """
+        Indices from start on whose bit is not set, skipping full bytes
+        """
+        index = start
+        while index < self.size:
+            if index & 7 == 0 and self.bits[index >> 3] == 0xFF:
+                index += 8
+                continue
+            if not self.bits[index >> 3] & (1 << (index & 7)):
+                yield index
+            index += 1
+
+class ProcessedGenes:
+    """
+    Set of processed gene IDs backed by a bitmap over a manifest. IDs that
+    are not in the manifest, such as genes of another selection kept in the
+    checkpoint, are held in an ordinary set so they are saved again.
+    """
+
+    def __init__(self, manifest, gene_ids=()):
+        self.manifest = manifest
+        self.bitmap = GeneBitmap(len(manifest))
+        self.others = set()
+        self._count = 0
+        for gene_id in gene_ids:
+            self.add(gene_id)
+
+    def add(self, gene_id):
+        index = self.manifest.index_of(gene_id)
+        if index is None:
+            self.others.add(gene_id)
+        elif self.bitmap.add(index):
+            self._count += 1
+
+    def restore(self, state, saved_gene_ids=None):
+        """
+        Take the bitmap of a checkpoint state. A state written for the same
+        gene list is taken as it is; one written for a list that has changed
+        since is decoded with saved_gene_ids, the gene order it was written
+        for, and carried over by gene ID. Returns False, changing nothing,
+        when the state cannot be matched to a gene order.
+        """
+        if state.get('genes') == len(self.manifest) and state.get('digest') == self.manifest.digest():
+            bitmap = GeneBitmap.decode(len(self.manifest), state['bitmap'])
+            for index in self.bitmap.iter_set():
+                bitmap.add(index)
+            self.bitmap = bitmap
+            self._count = bitmap.count()
+            return True
+        if (saved_gene_ids is None or state.get('genes') != len(saved_gene_ids)
+                or state.get('digest') != gene_list_digest(saved_gene_ids)):
+            return False
+        for index in GeneBitmap.decode(len(saved_gene_ids), state['bitmap']).iter_set():
+            self.add(saved_gene_ids[index])
+        return True
+
+    def state(self):
+        """
+        Checkpoint form of the bitmap: gene count, gene list digest and the
+        compressed bits
+        """
+        return {'genes': len(self.manifest), 'digest': self.manifest.digest(), 'bitmap': self.bitmap.encode()}
+
+    def pending(self, indices=None):
+        """
+        Manifest indices not processed yet, of all genes or of the given
+        indices, read from the bitmap as they are consumed
+        """
+        if indices is None:
+            return self.bitmap.iter_clear()
+        return (index for index in indices if index not in self.bitmap)
+
+    def in_manifest(self):
+        """
+        Number of processed genes of the manifest
+        """
+        return self._count
+
+    def __contains__(self, gene_id):
+        index = self.manifest.index_of(gene_id)
+        if index is None:
+            return gene_id in self.others
+        return index in self.bitmap
+
+    def __len__(self):
+        return self._count + len(self.others)
+
+    def __iter__(self):
+        for index in self.bitmap.iter_set():
+            yield self.manifest.gene_ids[index]
+        yield from self.others
@@ -0,0 +1,241 @@
+"""
+Gene Tree Client
+
+Library interface to the Ensembl gene tree downloads done by
+ensembl_gene_tree.py, for use from workflows and notebooks without
+shelling out or writing intermediate files. A GeneTreeClient owns its HTTP
+session, rate limiter, BioMart registry cache, tree cache and Compara
+strategy state. Nothing is printed: progress messages go to the logging
+module, so configure logging to see them.
+
+Example:
+    from gene_tree_client import GeneTreeClient
+
+    with GeneTreeClient(rate_limit=10) as client:
+        genes = client.iter_genes("Daphnia pulex")
+        for result in client.iter_trees(genes, workers=4):
+            if result.gene_tree_info:
+                print(result.gene_id, result.tree_id)
+"""
+
+import csv
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+import ensembl_gene_tree
+from ensembl_transport import EnsemblTransport
+from gene_tree_store import tree_member_ids
+
+# One gene's outcome: gene_tree_info is None when the gene has no tree or the
+# lookup failed, in which case error holds the exception
+GeneTreeResult = namedtuple('GeneTreeResult', ['gene_id', 'gene_symbol', 'species', 'tree_id',
+                                               'gene_tree_info', 'compara', 'error'])
+
+# Ensembl asks REST clients to stay below 15 requests per second
+DEFAULT_RATE_LIMIT = 10
+DEFAULT_CACHE_SIZE = 256
+
+class GeneTreeClient:
+    """
+    Resolve species, list their genes and stream their gene trees
+    """
+
+    def __init__(self, division=None, rate_limit=DEFAULT_RATE_LIMIT, cache_size=DEFAULT_CACHE_SIZE, timeout=30,
+                 lookup_symbols=False, strategy_stats_file=None, transport=None):
+        """
+        division forces an Ensembl division ('Ensembl', 'Metazoa', ...)
+        instead of searching all of them. lookup_symbols asks /lookup/id for
+        each gene's display name before searching by symbol. Strategy
+        statistics are only persisted when strategy_stats_file is given.
+        """
+        self.division = division
+        self.transport = transport or EnsemblTransport(rate_limit=rate_limit)
+        self._owns_transport = transport is None
+        self.timeout = timeout
+        self.lookup_symbols = lookup_symbols
+        self.strategy_stats_file = strategy_stats_file
+        self.cache_size = cache_size
+        self.fetched = 0
+        self.cache_hits = 0
+        # tree ID -> (compara, gene_tree_info), least recently used first
+        self._trees = OrderedDict()
+        # gene ID -> tree ID for every member of a tree fetched so far
+        self._gene_trees = {}
+        self._species = {}
+        self._registries = {}
+        self._resolvers = {}
+        self._lock = threading.Lock()
+
+    def resolve_species(self, species_name):
+        """
+        Division, REST URL and BioMart dataset of a species, or None if no
+        division has it
+        """
+        with self._lock:
+            if species_name in self._species:
+                return self._species[species_name]
+
+        if self.division:
+            api_urls = ensembl_gene_tree.ENSEMBL_APIS[self.division]
+            mart_name, virtual_schema, datasets = ensembl_gene_tree.get_registry_info(self.division, self.transport,
+                                                                                      self._registries)
+            dataset, score = ensembl_gene_tree.find_dataset_for_species(species_name, datasets) if datasets else (None, 0)
+            species_api_info = {
+                'api_key': self.division,
+                'rest_url': api_urls['rest'],
+                'mart_url': api_urls['mart'],
+                'dataset': dataset,
+                'score': score,
+                'mart_name': mart_name,
+                'virtual_schema': virtual_schema
+            } if dataset else None
+        else:
+            species_api_info = ensembl_gene_tree.search_species_dataset(species_name, self.transport, self._registries)
+
+        with self._lock:
+            self._species[species_name] = species_api_info
+        return species_api_info
+
+    def iter_genes(self, species_name, gene_list=None):
+        """
+        Yield {'gene_id', 'gene_symbol', 'species', ...} for each
+        protein-coding gene of a species, read from a gene list CSV or fetched
+        from BioMart, with the manifest columns (description, chromosome, ...)
+        the list or dataset provides
+        """
+        if gene_list:
+            with open(gene_list, 'r') as csvfile:
+                reader = csv.DictReader(csvfile)
+                manifest_columns = [column for column in ensembl_gene_tree.MANIFEST_ATTRIBUTES
+                                    if column in (reader.fieldnames or [])]
+                for row in reader:
+                    gene = ensembl_gene_tree.gene_from_row(row, manifest_columns)
+                    if gene:
+                        gene['species'] = species_name
+                        yield gene
+            return
+
+        species_api_info = self.resolve_species(species_name)
+        if species_api_info is None:
+            raise ValueError(f"{species_name} was not found in any Ensembl division")
+        for gene in ensembl_gene_tree.fetch_genes_from_biomart(species_api_info, self.transport) or []:
+            gene = dict(gene, species=species_name)
+            del gene['ensembl_id']
+            yield gene
+
+    def _resolver(self, species_api_info):
+        key = species_api_info['api_key']
+        with self._lock:
+            resolver = self._resolvers.get(key)
+            if resolver is None:
+                resolver = ensembl_gene_tree.GeneTreeResolver(key, species_api_info['rest_url'],
+                                                              stats_file=self.strategy_stats_file,
+                                                              transport=self.transport)
+                self._resolvers[key] = resolver
+            return resolver
+
+    def _cached(self, gene_id):
+        with self._lock:
+            tree_id = self._gene_trees.get(gene_id)
+            entry = self._trees.get(tree_id) if tree_id else None
+            if entry is None:
+                return None
+            self._trees.move_to_end(tree_id)
+            self.cache_hits += 1
+            return tree_id, entry
+
+    def _remember(self, compara, gene_tree_info):
+        tree_id = gene_tree_info.get('id')
+        if not tree_id:
+            return
+        members = tree_member_ids(gene_tree_info)
+        with self._lock:
+            for member in members:
+                self._gene_trees[member] = tree_id
+            self._trees[tree_id] = (compara, gene_tree_info)
+            self._trees.move_to_end(tree_id)
+            while len(self._trees) > self.cache_size:
+                self._trees.popitem(last=False)
+
+    def fetch_tree(self, gene_id, gene_symbol=None, species_name=None):
+        """
+        GeneTreeResult for one gene; genes in a tree fetched earlier are
+        answered from the cache
+        """
+        gene_symbol = gene_symbol or gene_id
+        cached = self._cached(gene_id)
+        if cached:
+            tree_id, (compara, gene_tree_info) = cached
+            return GeneTreeResult(gene_id, gene_symbol, species_name, tree_id, gene_tree_info, compara, None)
+
+        try:
+            species_api_info = self.resolve_species(species_name) if species_name else None
+            if species_api_info is None:
+                raise ValueError(f"Species {species_name!r} could not be resolved")
+            if self.lookup_symbols:
+                # The undecorated function: SIGALRM timeouts only work in the main thread
+                fetch_gene_info = getattr(ensembl_gene_tree.fetch_gene_info, '__wrapped__',
+                                          ensembl_gene_tree.fetch_gene_info)
+                gene_info = fetch_gene_info(gene_id, species_api_info['rest_url'], self.transport)
+                if gene_info:
+                    gene_symbol = gene_info.get('display_name', gene_symbol)
+            gene_tree_info, compara = self._resolver(species_api_info).resolve(
+                gene_id, gene_symbol, ensembl_gene_tree.convert_to_ensembl_format(species_name), self.timeout)
+        except Exception as e:
+            return GeneTreeResult(gene_id, gene_symbol, species_name, None, None, None, e)
+
+        with self._lock:
+            self.fetched += 1
+        if not gene_tree_info:
+            return GeneTreeResult(gene_id, gene_symbol, species_name, None, None, None, None)
+        self._remember(compara, gene_tree_info)
+        return GeneTreeResult(gene_id, gene_symbol, species_name, gene_tree_info.get('id'),
+                              gene_tree_info, compara, None)
+
+    def _fetch_gene(self, gene, species_name):
+        if isinstance(gene, str):
+            return self.fetch_tree(gene, None, species_name)
+        return self.fetch_tree(gene['gene_id'], gene.get('gene_symbol'), gene.get('species') or species_name)
+
+    def iter_trees(self, genes, species_name=None, workers=1):
+        """
+        Yield a GeneTreeResult per gene as soon as it is available
+
+        genes is any iterable of gene IDs or of dicts as yielded by
+        iter_genes(); it is consumed lazily. With workers > 1 up to
+        2 * workers genes are in flight and results arrive in completion
+        order rather than input order.
+        """
+        if workers <= 1:
+            for gene in genes:
+                yield self._fetch_gene(gene, species_name)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = set()
+            for gene in genes:
+                in_flight.add(executor.submit(self._fetch_gene, gene, species_name))
+                if len(in_flight) >= 2 * workers:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in as_completed(in_flight):
+                yield future.result()
+
+    def stats(self):
+        stats = dict(self.transport.stats())
+        stats.update({'fetched': self.fetched, 'cache_hits': self.cache_hits, 'cached_trees': len(self._trees)})
+        return stats
+
+    def close(self):
+        for resolver in self._resolvers.values():
+            resolver.save()
+        if self._owns_transport:
+            self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Gene Tree Membership Index
+
+Persistent SQLite mapping from member gene ID to Compara gene tree ID, filled
+from every tree ensembl_gene_tree.py has fetched in any run, species or
+division. Each tree also records where its JSON was stored, so a gene whose
+tree is already known can be served without asking the REST server again.
+
+Usage:
+  # Add trees from earlier runs to the index
+  python gene_tree_index.py import --compara metazoa Daphnia_pulex_gene_tree_files_metazoa ...
+
+  # Which tree is a gene in?
+  python gene_tree_index.py lookup --compara metazoa Dapulex_12345
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+
+from gene_tree_store import ShardArchiveReader, TreeStore, is_shard_archive, is_tree_store, tree_member_ids
+
+DEFAULT_INDEX_FILE = 'gene_tree_index.sqlite'
+
+# Both tables are WITHOUT ROWID with the lookup columns as primary key, so
+# the primary key b-tree is a covering index for gene -> tree -> location
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS members (
+    compara TEXT NOT NULL,
+    gene_id TEXT NOT NULL,
+    tree_id TEXT NOT NULL,
+    PRIMARY KEY (compara, gene_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS trees (
+    compara TEXT NOT NULL,
+    tree_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (compara, tree_id)
+) WITHOUT ROWID;
+'''
+
+class GeneTreeIndex:
+    """
+    Gene ID -> tree ID -> stored tree location, keyed by Compara database
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_FILE):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_SCHEMA)
+        self.connection.commit()
+        self._readers = {}
+
+    def add_tree(self, compara, gene_tree_info, location):
+        """
+        Record all members of a tree and where the tree is stored.
+        location is (kind, path) with kind 'file', 'shards' or 'store'.
+        Returns the number of member genes indexed.
+        """
+        tree_id = gene_tree_info.get('id') if isinstance(gene_tree_info, dict) else None
+        if not tree_id or not location:
+            return 0
+        kind, path = location
+        members = [(compara, gene_id, tree_id) for gene_id in tree_member_ids(gene_tree_info)]
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO trees (compara, tree_id, kind, path) VALUES (?, ?, ?, ?)",
+                (compara, tree_id, kind, os.path.abspath(path)))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO members (compara, gene_id, tree_id) VALUES (?, ?, ?)", members)
+        return len(members)
+
+    def lookup(self, compara, gene_id):
+        """
+        Tree ID containing a gene, or None
+        """
+        row = self.connection.execute(
+            "SELECT tree_id FROM members WHERE compara = ? AND gene_id = ?", (compara, gene_id)).fetchone()
+        return row[0] if row else None
+
+    def _reader(self, kind, path):
+        reader = self._readers.get((kind, path))
+        if reader is None:
+            reader = ShardArchiveReader(path) if kind == 'shards' else TreeStore(path)
+            self._readers[(kind, path)] = reader
+        return reader
+
+    def load_tree(self, compara, tree_id):
+        """
+        Stored JSON of a tree, or None if it is unknown or its file is gone
+        """
+        row = self.connection.execute(
+            "SELECT kind, path FROM trees WHERE compara = ? AND tree_id = ?", (compara, tree_id)).fetchone()
+        if not row:
+            return None
+        kind, path = row
+        try:
+            if kind == 'file':
+                with open(path, 'r') as f:
+                    return json.load(f)
+            if kind in ('shards', 'store'):
+                gene_tree_info = self._reader(kind, path).get_tree(tree_id)
+                if gene_tree_info is None and kind == 'shards':
+                    # The archive may have grown since its index was read
+                    reader = self._reader(kind, path)
+                    if reader.refresh():
+                        gene_tree_info = reader.get_tree(tree_id)
+                return gene_tree_info
+        except (OSError, ValueError) as e:
+            logging.warning(f"Stored tree {tree_id} at {path} is not readable: {e}")
+        return None
+
+    def tree_for_gene(self, compara, gene_id):
+        """
+        Stored JSON of the tree containing a gene, or None
+        """
+        tree_id = self.lookup(compara, gene_id)
+        return self.load_tree(compara, tree_id) if tree_id else None
+
+    def import_source(self, compara, source):
+        """
+        Index every tree in a species output directory or tree store.
+        Returns (trees, genes) added.
+        """
+        trees = genes = 0
+        if is_tree_store(source):
+            with TreeStore(source) as store:
+                for tree_id, gene_tree_info in store.iter_trees():
+                    genes += self.add_tree(compara, gene_tree_info, ('store', source))
+                    trees += 1
+        elif is_shard_archive(source):
+            with ShardArchiveReader(source) as reader:
+                for tree_id, gene_tree_info in reader.iter_trees():
+                    genes += self.add_tree(compara, gene_tree_info, ('shards', source))
+                    trees += 1
+        else:
+            for name in sorted(os.listdir(source)):
+                if not name.endswith('_gene_tree.json'):
+                    continue
+                path = os.path.join(source, name)
+                try:
+                    with open(path, 'r') as f:
+                        gene_tree_info = json.load(f)
+                except (OSError, ValueError) as e:
+                    logging.warning(f"Skipping unreadable gene tree file {path}: {e}")
+                    continue
+                added = self.add_tree(compara, gene_tree_info, ('file', path))
+                if added:
+                    genes += added
+                    trees += 1
+        return trees, genes
+
+    def import_index(self, path, locations=None):
+        """
+        Copy the entries of another index file, such as one written by an
+        array task. locations maps tree IDs to a new (kind, path) for trees
+        that have since been merged elsewhere. Returns (trees, genes) added.
+        """
+        other = sqlite3.connect(path)
+        try:
+            trees = other.execute("SELECT compara, tree_id, kind, path FROM trees").fetchall()
+            members = other.execute("SELECT compara, gene_id, tree_id FROM members").fetchall()
+        finally:
+            other.close()
+        locations = locations or {}
+        rows = []
+        for compara, tree_id, kind, tree_path in trees:
+            kind, tree_path = locations.get(tree_id, (kind, tree_path))
+            rows.append((compara, tree_id, kind, os.path.abspath(tree_path)))
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO trees (compara, tree_id, kind, path) VALUES (?, ?, ?, ?)", rows)
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO members (compara, gene_id, tree_id) VALUES (?, ?, ?)", members)
+        return len(rows), len(members)
+
+    def counts(self):
+        members = self.connection.execute("SELECT COUNT(*) FROM members").fetchone()[0]
+        trees = self.connection.execute("SELECT COUNT(*) FROM trees").fetchone()[0]
+        return trees, members
+
+    def close(self):
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = {}
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def parse_arguments():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Maintain the gene -> gene tree membership index")
+    parser.add_argument("--index", default=DEFAULT_INDEX_FILE, help="SQLite index file")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = subparsers.add_parser('import', help="Index trees from existing output directories")
+    import_parser.add_argument("--compara", required=True,
+                               help="Compara database the trees came from (e.g. vertebrates, metazoa, plants)")
+    import_parser.add_argument("sources", nargs='+', help="Species output directories or tree stores")
+
+    lookup = subparsers.add_parser('lookup', help="Print the tree containing each gene")
+    lookup.add_argument("--compara", required=True, help="Compara database to look in")
+    lookup.add_argument("gene_ids", nargs='+', help="Gene stable IDs")
+    return parser.parse_args()
+
+def main():
+    """Main function"""
+    args = parse_arguments()
+    with GeneTreeIndex(args.index) as index:
+        if args.command == 'import':
+            for source in args.sources:
+                trees, genes = index.import_source(args.compara, source)
+                print(f"Indexed {trees} trees ({genes} member genes) from {source}")
+            trees, members = index.counts()
+            print(f"Index {args.index} now holds {trees} trees and {members} member genes")
+        elif args.command == 'lookup':
+            for gene_id in args.gene_ids:
+                print(f"{gene_id}\t{index.lookup(args.compara, gene_id) or 'Not Found'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+"""
+Gene Tree Jobs
+
+Plans SLURM array jobs for ensembl_gene_tree.py. Gene counts come from the
+<species>_protein-coding_genes.csv files (fetched from BioMart when
+missing) and throughput and memory from the run statistics that
+ensembl_gene_tree.py appends to gene_tree_run_stats.jsonl. Each species is
+split into enough --gene-shard parts that every array task fits the
+requested wall time.
+
+Merges the outputs of those parts (or of any runs over the same species)
+back into one species directory: trees are deduplicated by stable ID,
+checkpoints and retry queues are combined, and every gene in the gene list
+is accounted for in merge_summary.json. Genes are streamed from the gene
+list one at a time; only indexes and gene IDs are held in memory, never
+the trees.
+
+Usage:
+  # Write gene_tree_tasks.tsv and gene_tree_array.sbatch
+  python gene_tree_jobs.py plan species_ensembl-metazoa.txt --workers 4 --max-hours 12
+  sbatch gene_tree_array.sbatch
+
+  # Combine Daphnia_pulex_gene_tree_files_metazoa_part*of* into Daphnia_pulex_gene_tree_files_metazoa
+  python gene_tree_jobs.py merge "Daphnia pulex"
+"""
+
+import argparse
+import csv
+import glob
+import json
+import math
+import os
+import re
+import sys
+from datetime import datetime
+
+import ensembl_gene_tree
+import ensembl_transport
+from gene_manifest import ProcessedGenes
+from gene_tree_store import (ShardArchiveReader, open_tree_writer, gene_file_identifier, is_shard_archive,
+                             atomic_write, OUTPUT_LAYOUTS, DEFAULT_SHARD_SIZE)
+from gene_tree_index import GeneTreeIndex, DEFAULT_INDEX_FILE
+
+DEFAULT_TASKS_FILE = 'gene_tree_tasks.tsv'
+DEFAULT_SBATCH_FILE = 'gene_tree_array.sbatch'
+MERGE_SUMMARY_FILE = 'merge_summary.json'
+MISSING_GENES_FILE = 'missing_genes.txt'
+# Each array task writes its own membership index; merge adds them to the shared one
+TASK_INDEX_PATTERN = 'gene_tree_index_*.sqlite'
+_PART_SUFFIX = re.compile(r'_part\d+of\d+$')
+
+DEFAULT_MEMORY_MB = 2048
+MIN_MEMORY_MB = 1024
+# Reading the gene list, resolving the species and the drain at the end
+TASK_OVERHEAD_SECONDS = 15 * 60
+
+def count_genes(gene_csv_file):
+    """
+    Number of rows with a gene ID in a protein-coding gene list
+    """
+    count = 0
+    with open(gene_csv_file, 'r') as csvfile:
+        for row in csv.DictReader(csvfile):
+            if row.get('gene_id') or row.get('ensembl_id') or row.get('WBGeneID'):
+                count += 1
+    return count
+
+def gene_list_file(species_name):
+    return f"{species_name.replace(' ', '_')}_protein-coding_genes.csv"
+
+def fetch_gene_list(species_name):
+    """
+    Resolve a species to its Ensembl division and download its gene list
+    """
+    species_api_info = ensembl_gene_tree.search_species_dataset(species_name)
+    if not species_api_info:
+        return None
+    genes = ensembl_gene_tree.fetch_genes_from_biomart(species_api_info)
+    if not genes:
+        return None
+    return ensembl_gene_tree.save_genes_to_csv(genes, species_name)
+
+def memory_request_mb(entries):
+    peaks = [e['peak_rss_mb'] for e in entries if e.get('peak_rss_mb')]
+    if not peaks:
+        return DEFAULT_MEMORY_MB
+    return max(MIN_MEMORY_MB, int(math.ceil(max(peaks) * 1.5 / 256) * 256))
+
+def format_slurm_time(seconds):
+    # Round up to a quarter of an hour
+    minutes = int(math.ceil(seconds / 60 / 15) * 15)
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{days}-{hours:02d}:{minutes:02d}:00" if days else f"{hours:02d}:{minutes:02d}:00"
+
+def plan_tasks(species_counts, genes_per_second, max_seconds, safety):
+    """
+    Split each species into equal --gene-shard parts of at most the number of
+    genes one task gets through in max_seconds. Returns (tasks, seconds of
+    the longest task) with tasks as (species, part, parts, genes).
+    """
+    genes_per_task = max(1, int(genes_per_second * (max_seconds - TASK_OVERHEAD_SECONDS) / safety))
+    tasks = []
+    longest = 0
+    for species_name, genes in species_counts:
+        parts = max(1, math.ceil(genes / genes_per_task))
+        for part in range(parts):
+            part_genes = len(range(part, genes, parts))
+            tasks.append((species_name, part, parts, part_genes))
+            longest = max(longest, part_genes / genes_per_second * safety + TASK_OVERHEAD_SECONDS)
+    return tasks, longest
+
+def write_tasks_file(tasks, tasks_file):
+    with open(tasks_file, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(['task_id', 'species', 'gene_shard', 'genes'])
+        for task_id, (species_name, part, parts, genes) in enumerate(tasks):
+            writer.writerow([task_id, species_name, f"{part}/{parts}", genes])
+
+def write_sbatch_script(sbatch_file, tasks_file, task_count, wall_time, memory_mb, args, summary):
+    script = os.path.abspath(args.script)
+    workdir = os.path.abspath(args.workdir)
+    cpus = 1 if args.workers <= 4 else 2
+    extra = f" {args.extra_args}" if args.extra_args else ''
+    task_index = TASK_INDEX_PATTERN.replace('*', '${SLURM_ARRAY_TASK_ID}')
+    lines = [
+        "#!/bin/bash",
+        "",
+        f"#SBATCH --job-name={args.job_name}",
+        f"#SBATCH --array=0-{task_count - 1}%{args.max_concurrent}",
+        "#SBATCH --nodes 1",
+        "#SBATCH --tasks-per-node 1",
+        f"#SBATCH --cpus-per-task {cpus}",
+        f"#SBATCH --mem {memory_mb}M",
+        f"#SBATCH --time {wall_time}",
+        f"#SBATCH --signal=B:USR1@{args.drain_margin}",
+        f"#SBATCH --output={args.job_name}_%A_%a.out",
+        "",
+        f"# Generated by gene_tree_jobs.py plan on {datetime.now().strftime('%Y-%m-%d %H:%M')}",
+        f"# {summary}",
+        "# Tasks that run out of time drain, checkpoint and exit with status 75;",
+        "# submitting this script again resumes them where they stopped.",
+        "",
+        f"cd {workdir}",
+        f"task=$(awk -F'\\t' -v id=\"$SLURM_ARRAY_TASK_ID\" 'NR > 1 && $1 == id' {tasks_file})",
+        "species=$(printf '%s' \"$task\" | cut -f2)",
+        "gene_shard=$(printf '%s' \"$task\" | cut -f3)",
+        "species_file=\"species_task_${SLURM_ARRAY_TASK_ID}.txt\"",
+        "printf '%s\\n' \"$species\" > \"$species_file\"",
+        "",
+        "# exec so the USR1 sent to the batch shell reaches python",
+        f"exec python {script} \"$species_file\" --gene-shard \"$gene_shard\" --workers {args.workers} \\",
+        f"    --drain-margin {args.drain_margin} --membership-index \"{task_index}\"{extra}",
+        ""
+    ]
+    with open(sbatch_file, 'w') as f:
+        f.write('\n'.join(lines))
+
+def run_plan(args):
+    species_list = ensembl_gene_tree.read_species_from_file(args.species_file)
+    if not species_list:
+        return 1
+
+    species_counts = []
+    for species_name in species_list:
+        gene_csv_file = gene_list_file(species_name)
+        if not os.path.exists(gene_csv_file):
+            if args.offline:
+                print(f"Skipping {species_name}: {gene_csv_file} not found")
+                continue
+            print(f"Fetching the gene list of {species_name} from BioMart...")
+            gene_csv_file = fetch_gene_list(species_name)
+            if not gene_csv_file:
+                print(f"Skipping {species_name}: could not fetch its gene list")
+                continue
+        species_counts.append((species_name, count_genes(gene_csv_file)))
+
+    if not species_counts:
+        print("No species with a gene list to plan for.")
+        return 1
+
+    entries = ensembl_gene_tree.load_run_stats(args.run_stats, args.workers)
+    genes_per_second, measured = ensembl_gene_tree.measured_throughput(entries, args.workers)
+    memory_mb = args.mem_mb or memory_request_mb(entries)
+    tasks, longest = plan_tasks(species_counts, genes_per_second, args.max_hours * 3600, args.safety)
+    wall_time = format_slurm_time(longest + args.drain_margin)
+
+    write_tasks_file(tasks, args.tasks_file)
+    total_genes = sum(genes for _, genes in species_counts)
+    source = f"measured over {len(entries)} runs" if measured else "default estimate, no runs recorded yet"
+    summary = (f"{total_genes} genes of {len(species_counts)} species in {len(tasks)} tasks "
+               f"at {genes_per_second:.2f} genes/s per task ({source})")
+    write_sbatch_script(args.output, args.tasks_file, len(tasks), wall_time, memory_mb, args, summary)
+
+    for species_name, genes in species_counts:
+        parts = sum(1 for task in tasks if task[0] == species_name)
+        print(f"{species_name}: {genes} genes in {parts} task{'s' if parts != 1 else ''}")
+    print(summary)
+    print(f"Each task: --time {wall_time}, --mem {memory_mb}M, {args.workers} workers")
+    print(f"Wrote {args.tasks_file} and {args.output}; submit with: sbatch {args.output}")
+    return 0
+
+class FileSource:
+    """
+    Per-gene results in a per-file layout output directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def result(self, gene_id, gene_symbol):
+        """
+        (status, tree_id, load) for a gene, or None; load() returns the tree
+        """
+        for identifier in dict.fromkeys([gene_file_identifier(gene_id, gene_symbol), gene_id]):
+            base = os.path.join(self.path, identifier)
+            json_file = f"{base}_gene_tree.json"
+            if os.path.exists(json_file):
+                def load(json_file=json_file):
+                    with open(json_file, 'r') as f:
+                        return json.load(f)
+                return 'tree', None, load
+            if os.path.exists(f"{base}_gene_tree.txt"):
+                return 'no_tree', None, None
+            if os.path.exists(f"{base}_ERROR.txt"):
+                with open(f"{base}_ERROR.txt", 'r') as f:
+                    return 'error', f.read(), None
+        return None
+
+    def close(self):
+        pass
+
+class ShardSource:
+    """
+    Per-gene results in a shard archive
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = ShardArchiveReader(path)
+
+    def result(self, gene_id, gene_symbol):
+        row = self.reader.genes.get(gene_id)
+        if row is None:
+            return None
+        if row['status'] == 'tree':
+            return 'tree', row['tree_id'], lambda: self.reader.get_tree_for_gene(gene_id)
+        if row['status'] == 'error':
+            return 'error', row['message'], None
+        return row['status'], None, None
+
+    def close(self):
+        self.reader.close()
+
+def open_merge_source(path):
+    return ShardSource(path) if is_shard_archive(path) else FileSource(path)
+
+# Which result to keep when sources disagree about a gene
+_STATUS_RANK = {'tree': 0, 'no_tree': 1, 'error': 2}
+
+def best_result(sources, gene_id, gene_symbol):
+    best = None
+    for source in sources:
+        result = source.result(gene_id, gene_symbol)
+        if result is None or result[0] not in _STATUS_RANK:
+            continue
+        if best is None or _STATUS_RANK[result[0]] < _STATUS_RANK[best[0]]:
+            best = result
+            if best[0] == 'tree':
+                break
+    return best
+
+def iter_gene_list(gene_csv_file):
+    """
+    Yield (gene_id, gene_symbol) from a gene list, as ensembl_gene_tree.py reads it
+    """
+    with open(gene_csv_file, 'r') as csvfile:
+        for row in csv.DictReader(csvfile):
+            gene_id = row.get('gene_id') or row.get('ensembl_id') or row.get('WBGeneID')
+            if gene_id:
+                yield gene_id, row.get('gene_symbol') or row.get('symbol') or gene_id
+
+def merged_output_dir(sources):
+    """
+    The species directory the parts were split from, if they agree on one
+    """
+    names = {_PART_SUFFIX.sub('', os.path.basename(os.path.normpath(s))) for s in sources}
+    return names.pop() if len(names) == 1 else None
+
+def merge_species(species_name, sources, gene_csv_file, output_dir, output_layout='shards',
+                  shard_size=DEFAULT_SHARD_SIZE, membership_index=None, task_indexes=()):
+    """
+    Merge source directories into output_dir. Returns the summary dict.
+    The entries of the task_indexes files written by the array tasks are
+    added to membership_index, pointing at the merged copy of each tree.
+    """
+    retries = {}
+    dead_letter_rows = {}
+    for source in sources:
+        _, _, _, source_retries = ensembl_gene_tree.load_checkpoint(os.path.join(source, 'checkpoint.json'))
+        retries.update(source_retries)
+        dead_letter_file = os.path.join(source, ensembl_gene_tree.DEAD_LETTER_FILE)
+        if os.path.exists(dead_letter_file):
+            with open(dead_letter_file, 'r', newline='') as f:
+                for row in csv.DictReader(f, delimiter='\t'):
+                    dead_letter_rows[row['gene_id']] = row
+
+    opened = [open_merge_source(source) for source in sources]
+    writer = open_tree_writer(output_dir, output_layout, species_name=species_name, max_shard_bytes=shard_size)
+    counts = {'genes': 0, 'tree': 0, 'no_tree': 0, 'error': 0, 'pending_retry': 0, 'missing': 0}
+    tree_ids = set()
+    tree_locations = {}
+    duplicate_tree_refs = 0
+    processed_genes = set()
+    merged_retries = {}
+    dead_letters = []
+    missing_file = os.path.join(output_dir, MISSING_GENES_FILE)
+    try:
+        with open(missing_file, 'w') as missing:
+            for gene_number, (gene_id, gene_symbol) in enumerate(iter_gene_list(gene_csv_file), start=1):
+                counts['genes'] += 1
+                result = best_result(opened, gene_id, gene_symbol)
+                if result is None:
+                    if gene_id in retries:
+                        entry = dict(retries[gene_id], gene_number=gene_number)
+                        entry.pop('in_flight', None)
+                        merged_retries[gene_id] = entry
+                        counts['pending_retry'] += 1
+                    else:
+                        missing.write(f"{gene_id}\t{gene_symbol}\n")
+                        counts['missing'] += 1
+                    continue
+
+                status, detail, load = result
+                if status == 'tree':
+                    tree_id = detail
+                    # Trees already merged are referenced, not read again
+                    if not (tree_id and output_layout == 'shards' and writer.write_known_tree(gene_id, gene_symbol, tree_id)):
+                        gene_tree_info = load()
+                        leaf_rows = ensembl_gene_tree.process_gene_tree_data(gene_tree_info) if output_layout == 'files' else []
+                        writer.write_tree(gene_id, gene_symbol, species_name, gene_tree_info, leaf_rows)
+                        tree_id = gene_tree_info.get('id') or tree_id
+                        if tree_id and writer.last_location:
+                            tree_locations[tree_id] = writer.last_location
+                    if tree_id in tree_ids:
+                        duplicate_tree_refs += 1
+                    elif tree_id:
+                        tree_ids.add(tree_id)
+                elif status == 'no_tree':
+                    writer.write_no_tree(gene_id, gene_symbol, species_name)
+                else:
+                    message = detail or ''
+                    if message.startswith('Error processing gene: '):
+                        message = message[len('Error processing gene: '):]
+                    writer.write_error(gene_id, gene_symbol, message)
+                    if gene_id in dead_letter_rows:
+                        dead_letters.append(dead_letter_rows[gene_id])
+                counts[status] += 1
+                processed_genes.add(gene_id)
+    finally:
+        writer.close()
+        for source in opened:
+            source.close()
+
+    # Resuming the merged directory fetches the genes whose bits are still clear
+    manifest = ensembl_gene_tree.read_gene_list(gene_csv_file)
+    processed = ProcessedGenes(manifest, processed_genes)
+    checkpoint_file = os.path.join(output_dir, 'checkpoint.json')
+    with atomic_write(checkpoint_file) as f:
+        json.dump({
+            'processed_genes': list(processed.others),
+            'processed': processed.state(),
+            'last_gene': None,
+            'retries': merged_retries
+        }, f)
+    ensembl_gene_tree.save_gene_order(manifest, checkpoint_file)
+    ensembl_gene_tree.write_dead_letter_report(output_dir, dead_letters)
+
+    indexed_trees = indexed_genes = 0
+    if membership_index and task_indexes:
+        with GeneTreeIndex(membership_index) as index:
+            for task_index in task_indexes:
+                trees, genes = index.import_index(task_index, tree_locations)
+                indexed_trees += trees
+                indexed_genes += genes
+
+    summary = {
+        'species': species_name,
+        'gene_list': gene_csv_file,
+        'sources': sources,
+        'output': output_dir,
+        'output_layout': output_layout,
+        'genes_in_list': counts['genes'],
+        'with_tree': counts['tree'],
+        'no_tree': counts['no_tree'],
+        'error': counts['error'],
+        'pending_retry': counts['pending_retry'],
+        'missing': counts['missing'],
+        'unique_trees': len(tree_ids),
+        'duplicate_tree_references': duplicate_tree_refs,
+        'membership_index': membership_index if task_indexes else None,
+        'indexed_trees': indexed_trees,
+        'indexed_genes': indexed_genes,
+        'complete': counts['missing'] == 0 and counts['pending_retry'] == 0
+    }
+    with atomic_write(os.path.join(output_dir, MERGE_SUMMARY_FILE)) as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def run_merge(args):
+    species_prefix = args.species.replace(' ', '_')
+    sources = args.sources or sorted(glob.glob(f"{species_prefix}_gene_tree_files_*_part*of*"))
+    sources = [s for s in sources if os.path.isdir(s)]
+    if not sources:
+        print(f"No output directories to merge for {args.species}")
+        return 1
+
+    output_dir = args.output or merged_output_dir(sources)
+    if not output_dir:
+        print("The sources do not share a species directory name; use --output")
+        return 1
+    if any(os.path.abspath(output_dir) == os.path.abspath(s) for s in sources):
+        print(f"The output directory {output_dir} cannot also be a source")
+        return 1
+    if os.path.isdir(output_dir) and os.listdir(output_dir):
+        print(f"The output directory {output_dir} already exists and is not empty")
+        return 1
+
+    gene_csv_file = args.gene_list or gene_list_file(args.species)
+    if not os.path.exists(gene_csv_file):
+        print(f"Gene list {gene_csv_file} not found; use --gene-list")
+        return 1
+
+    membership_index = None if args.no_membership_index else args.membership_index
+    task_indexes = []
+    if membership_index:
+        task_indexes = [path for path in sorted(glob.glob(args.task_indexes))
+                        if os.path.abspath(path) != os.path.abspath(membership_index)]
+
+    print(f"Merging {len(sources)} directories into {output_dir}")
+    summary = merge_species(args.species, sources, gene_csv_file, output_dir, args.output_layout,
+                            args.shard_size_mb * 1024 * 1024, membership_index, task_indexes)
+    print(f"{summary['genes_in_list']} genes in {gene_csv_file}: {summary['with_tree']} with a tree "
+          f"({summary['unique_trees']} distinct trees), {summary['no_tree']} without, {summary['error']} failed, "
+          f"{summary['pending_retry']} waiting for a retry, {summary['missing']} never attempted")
+    if summary['membership_index']:
+        print(f"Added {summary['indexed_trees']} trees ({summary['indexed_genes']} genes) from "
+              f"{len(task_indexes)} task indexes to {membership_index}")
+    if summary['missing']:
+        print(f"Missing genes are listed in {os.path.join(output_dir, MISSING_GENES_FILE)}")
+    print(f"Summary written to {os.path.join(output_dir, MERGE_SUMMARY_FILE)}")
+    return 0 if summary['complete'] else 2
+
+def parse_arguments():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Plan and manage SLURM array runs of ensembl_gene_tree.py")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan = subparsers.add_parser('plan', help="Write an sbatch array script sized from gene counts and throughput")
+    plan.add_argument("species_file", help="Text file containing species names (one per line)")
+    plan.add_argument("--workers", type=int, default=1, help="--workers for each task")
+    plan.add_argument("--max-hours", type=float, default=24, help="Longest wall time wanted for one task")
+    plan.add_argument("--safety", type=float, default=1.5,
+                      help="Factor applied to the estimated run time of each task")
+    plan.add_argument("--run-stats", default=ensembl_gene_tree.RUN_STATS_FILE,
+                      help="Run statistics recorded by ensembl_gene_tree.py")
+    plan.add_argument("--mem-mb", type=int, help="Memory per task instead of the measured peak plus 50%%")
+    plan.add_argument("--max-concurrent", type=int, default=8,
+                      help="Array tasks allowed to run at once (keeps the load on Ensembl reasonable)")
+    plan.add_argument("--drain-margin", type=int, default=ensembl_gene_tree.DEFAULT_DRAIN_MARGIN,
+                      help="Seconds before the time limit at which tasks stop and checkpoint")
+    plan.add_argument("--job-name", default='TREES', help="SLURM job name")
+    plan.add_argument("--script", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ensembl_gene_tree.py'),
+                      help="Path to ensembl_gene_tree.py on the cluster")
+    plan.add_argument("--workdir", default='.', help="Directory the tasks run in")
+    plan.add_argument("--extra-args", help="Further ensembl_gene_tree.py options, e.g. \"--output-layout shards\"")
+    plan.add_argument("--offline", action="store_true",
+                      help="Do not fetch missing gene lists; skip those species instead")
+    plan.add_argument("--tasks-file", default=DEFAULT_TASKS_FILE, help="Task table read by the array script")
+    plan.add_argument("--output", default=DEFAULT_SBATCH_FILE, help="sbatch script to write")
+
+    merge = subparsers.add_parser('merge', help="Combine the part directories of a species into one")
+    merge.add_argument("species", help="Species name, e.g. \"Daphnia pulex\"")
+    merge.add_argument("sources", nargs='*',
+                       help="Directories to merge (default: <species>_gene_tree_files_*_part*of*)")
+    merge.add_argument("--gene-list", help="Gene list CSV (default: <species>_protein-coding_genes.csv)")
+    merge.add_argument("--output", help="Merged directory (default: the sources' name without _partIIIofNNN)")
+    merge.add_argument("--output-layout", choices=OUTPUT_LAYOUTS, default='shards',
+                       help="Layout of the merged directory; shards stores each distinct tree once")
+    merge.add_argument("--shard-size-mb", type=int, default=DEFAULT_SHARD_SIZE // (1024 * 1024),
+                       help="Maximum size of each compressed shard in MB")
+    merge.add_argument("--membership-index", default=DEFAULT_INDEX_FILE,
+                       help="Shared membership index the array tasks' indexes are added to")
+    merge.add_argument("--task-indexes", default=TASK_INDEX_PATTERN,
+                       help="Glob of the per-task membership indexes written by the array tasks")
+    merge.add_argument("--no-membership-index", action="store_true",
+                       help="Do not add the task indexes to the shared membership index")
+    return parser.parse_args()
+
+def main():
+    """Main function"""
+    args = parse_arguments()
+    ensembl_gene_tree.console = ensembl_transport.console = True
+    if args.command == 'plan':
+        sys.exit(run_plan(args))
+    elif args.command == 'merge':
+        sys.exit(run_merge(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,746 @@
+"""
+Gene Tree Output Storage
+
+Output backends used by ensembl_gene_tree.py to persist the gene trees it
+downloads, plus a reader for the sharded layout.
+
+Two layouts are supported:
+  files   - the original layout: one <gene>_gene_tree.json plus a
+            <gene>_gene_tree.csv / .txt / _ERROR.txt file per gene in a flat
+            directory
+  shards  - trees appended to size-bounded, gzip-compressed JSONL shards with
+            a tab-separated offset index for random access by gene ID or
+            tree ID
+
+It also builds and reads the memory-mapped tree store used for read-side
+lookups over a finished run:
+  python gene_tree_store.py build tree_store/ Homo_sapiens_gene_tree_files_ensembl ...
+  python gene_tree_store.py lookup tree_store/ ENSG00000139618
+"""
+
+import argparse
+import contextlib
+import csv
+import gzip
+import json
+import logging
+import mmap
+import os
+import struct
+
+from gene_tree_traversal import summarize_gene_tree
+
+SHARD_ARCHIVE_FORMAT = 'gene-tree-shards'
+SHARD_ARCHIVE_VERSION = 1
+SHARD_METADATA_FILE = 'archive.json'
+SHARD_INDEX_FILE = 'index.tsv'
+SHARD_INDEX_FIELDS = ['gene_id', 'gene_symbol', 'status', 'tree_id', 'shard', 'offset', 'length', 'message']
+DEFAULT_SHARD_SIZE = 256 * 1024 * 1024
+
+OUTPUT_LAYOUTS = ['files', 'shards']
+
+def gene_file_identifier(gene_id, gene_symbol):
+    """
+    Name used for per-gene output files: the symbol, or the gene ID when the
+    symbol is unknown
+    """
+    if gene_symbol and gene_symbol.lower() != "unknown":
+        return gene_symbol
+    return gene_id
+
+@contextlib.contextmanager
+def atomic_write(path, newline=None):
+    """
+    Open a file for writing that only replaces path once it is complete, so
+    an interrupted run never leaves a half-written file behind. The temporary
+    file is named after the process, so concurrent jobs writing the same
+    shared file do not move each other's half-written copies.
+    """
+    temp_file = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, 'w', newline=newline) as f:
+            yield f
+        os.replace(temp_file, path)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+class PerFileTreeWriter:
+    """
+    Write one set of files per gene into a flat directory (original layout)
+    """
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        # (kind, path) of the most recently written tree, for the membership index
+        self.last_location = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def write_tree(self, gene_id, gene_symbol, species_name, gene_tree_info, leaf_rows):
+        file_identifier = gene_file_identifier(gene_id, gene_symbol)
+        json_file = os.path.join(self.output_dir, f'{file_identifier}_gene_tree.json')
+        with atomic_write(json_file) as f:
+            json.dump(gene_tree_info, f, indent=2)
+        self.last_location = ('file', json_file)
+
+        if leaf_rows:
+            output_file = os.path.join(self.output_dir, f'{file_identifier}_gene_tree.csv')
+            with atomic_write(output_file, newline='') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=['gene_id', 'gene_name', 'species'])
+                writer.writeheader()
+                for row in leaf_rows:
+                    writer.writerow(row)
+        else:
+            output_file = json_file
+        return output_file
+
+    def write_no_tree(self, gene_id, gene_symbol, species_name):
+        file_identifier = gene_file_identifier(gene_id, gene_symbol)
+        output_file = os.path.join(self.output_dir, f'{file_identifier}_gene_tree.txt')
+        with atomic_write(output_file) as txtfile:
+            txtfile.write("No gene tree available")
+        return output_file
+
+    def write_error(self, gene_id, gene_symbol, message):
+        file_identifier = gene_file_identifier(gene_id, gene_symbol)
+        error_file = os.path.join(self.output_dir, f'{file_identifier}_ERROR.txt')
+        with atomic_write(error_file) as txtfile:
+            txtfile.write(f"Error processing gene: {message}")
+        return error_file
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+class ShardedTreeWriter:
+    """
+    Append gene trees to size-bounded gzip JSONL shards
+
+    Every tree is written as its own gzip member, so a shard is still a
+    valid .jsonl.gz stream while any single tree can be decompressed from
+    its (offset, length) entry in index.tsv. Trees shared by several genes
+    are stored once; later genes only get an index row pointing at it.
+    A new shard is started on every open so a crashed run can never leave
+    a torn record in the middle of a shard that is appended to later.
+    """
+
+    def __init__(self, output_dir, species_name=None, max_shard_bytes=DEFAULT_SHARD_SIZE, compresslevel=6):
+        self.output_dir = output_dir
+        self.max_shard_bytes = max_shard_bytes
+        self.compresslevel = compresslevel
+        self.last_location = None
+        os.makedirs(output_dir, exist_ok=True)
+
+        write_archive_metadata(output_dir, species_name)
+
+        # Trees already in the archive, so a resumed run keeps deduplicating
+        self.tree_locations = {}
+        for row in read_shard_index(output_dir):
+            if row['tree_id'] and row['shard']:
+                self.tree_locations[row['tree_id']] = (row['shard'], row['offset'], row['length'])
+
+        self.shard_number = _next_shard_number(output_dir)
+        self.shard_name = None
+        self.shard_file = None
+        self.shard_size = 0
+
+        index_path = os.path.join(output_dir, SHARD_INDEX_FILE)
+        needs_header = not os.path.exists(index_path) or os.path.getsize(index_path) == 0
+        self.index_file = open(index_path, 'a', newline='')
+        if not needs_header and not _ends_with_newline(index_path):
+            # Previous run died mid-line; keep the torn row on its own line
+            self.index_file.write('\n')
+        self.index_writer = csv.writer(self.index_file, delimiter='\t', lineterminator='\n')
+        if needs_header:
+            self.index_writer.writerow(SHARD_INDEX_FIELDS)
+
+    def _open_next_shard(self):
+        if self.shard_file:
+            self.shard_file.close()
+        self.shard_name = f"trees-{self.shard_number:05d}.jsonl.gz"
+        self.shard_number += 1
+        self.shard_file = open(os.path.join(self.output_dir, self.shard_name), 'ab')
+        self.shard_size = 0
+        logging.info(f"Opened tree shard {self.shard_name}")
+
+    def _append_tree(self, gene_tree_info):
+        if self.shard_file is None or self.shard_size >= self.max_shard_bytes:
+            self._open_next_shard()
+
+        line = json.dumps(gene_tree_info, separators=(',', ':')) + '\n'
+        member = gzip.compress(line.encode('utf-8'), compresslevel=self.compresslevel)
+        offset = self.shard_size
+        self.shard_file.write(member)
+        self.shard_size += len(member)
+        return self.shard_name, offset, len(member)
+
+    def _write_index_row(self, gene_id, gene_symbol, status, tree_id='', location=None, message=''):
+        shard, offset, length = location if location else ('', '', '')
+        # Keep each row on one line regardless of what the error text contains
+        message = ' '.join(str(message).split())
+        self.index_writer.writerow([gene_id, gene_symbol, status, tree_id, shard, offset, length, message])
+
+    def write_tree(self, gene_id, gene_symbol, species_name, gene_tree_info, leaf_rows):
+        tree_id = gene_tree_info.get('id') or ''
+        location = self.tree_locations.get(tree_id) if tree_id else None
+        if location is None:
+            location = self._append_tree(gene_tree_info)
+            # Data must be on disk before the index points at it
+            self.shard_file.flush()
+            if tree_id:
+                self.tree_locations[tree_id] = location
+        self._write_index_row(gene_id, gene_symbol, 'tree', tree_id, location)
+        self.index_file.flush()
+        self.last_location = ('shards', self.output_dir)
+        return os.path.join(self.output_dir, location[0])
+
+    def write_known_tree(self, gene_id, gene_symbol, tree_id):
+        """
+        Point a gene at a tree already in the archive without reading or
+        rewriting it. Returns False if the tree is not stored yet.
+        """
+        location = self.tree_locations.get(tree_id) if tree_id else None
+        if location is None:
+            return False
+        self._write_index_row(gene_id, gene_symbol, 'tree', tree_id, location)
+        self.index_file.flush()
+        self.last_location = ('shards', self.output_dir)
+        return True
+
+    def write_no_tree(self, gene_id, gene_symbol, species_name):
+        self._write_index_row(gene_id, gene_symbol, 'no_tree')
+        self.index_file.flush()
+        return os.path.join(self.output_dir, SHARD_INDEX_FILE)
+
+    def write_error(self, gene_id, gene_symbol, message):
+        self._write_index_row(gene_id, gene_symbol, 'error', message=message)
+        self.index_file.flush()
+        return os.path.join(self.output_dir, SHARD_INDEX_FILE)
+
+    def flush(self):
+        if self.shard_file:
+            self.shard_file.flush()
+            os.fsync(self.shard_file.fileno())
+        self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+
+    def close(self):
+        if self.shard_file:
+            self.shard_file.close()
+            self.shard_file = None
+        if not self.index_file.closed:
+            self.index_file.close()
+
+def open_tree_writer(output_dir, layout='files', species_name=None, max_shard_bytes=DEFAULT_SHARD_SIZE):
+    """
+    Create the output backend for a species directory
+    """
+    if layout == 'files':
+        return PerFileTreeWriter(output_dir)
+    if layout == 'shards':
+        return ShardedTreeWriter(output_dir, species_name=species_name, max_shard_bytes=max_shard_bytes)
+    raise ValueError(f"Unknown output layout: {layout}")
+
+def write_archive_metadata(output_dir, species_name=None):
+    metadata_path = os.path.join(output_dir, SHARD_METADATA_FILE)
+    if os.path.exists(metadata_path):
+        return
+    with open(metadata_path, 'w') as f:
+        json.dump({
+            'format': SHARD_ARCHIVE_FORMAT,
+            'version': SHARD_ARCHIVE_VERSION,
+            'species': species_name,
+            'compression': 'gzip',
+            'index': SHARD_INDEX_FILE
+        }, f, indent=2)
+
+def is_shard_archive(path):
+    """
+    Check whether a directory holds a sharded gene tree archive
+    """
+    return os.path.isfile(os.path.join(path, SHARD_METADATA_FILE)) and \
+        os.path.isfile(os.path.join(path, SHARD_INDEX_FILE))
+
+def read_shard_index(archive_dir):
+    """
+    Yield index rows of a shard archive as dicts, skipping torn lines
+    """
+    index_path = os.path.join(archive_dir, SHARD_INDEX_FILE)
+    if not os.path.exists(index_path):
+        return
+    with open(index_path, 'r', newline='') as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader, None)
+        if header != SHARD_INDEX_FIELDS:
+            logging.warning(f"Unexpected shard index header in {index_path}: {header}")
+            return
+        for parts in reader:
+            row = _shard_index_row(parts)
+            if row:
+                yield row
+
+def _shard_index_row(parts):
+    """
+    Index row dict of the fields of one index.tsv line, or None if torn
+    """
+    if len(parts) != len(SHARD_INDEX_FIELDS):
+        return None
+    row = dict(zip(SHARD_INDEX_FIELDS, parts))
+    if row['shard']:
+        try:
+            row['offset'] = int(row['offset'])
+            row['length'] = int(row['length'])
+        except ValueError:
+            return None
+    return row
+
+def _next_shard_number(archive_dir):
+    numbers = []
+    for name in os.listdir(archive_dir):
+        if name.startswith('trees-') and name.endswith('.jsonl.gz'):
+            try:
+                numbers.append(int(name[len('trees-'):-len('.jsonl.gz')]))
+            except ValueError:
+                continue
+    return max(numbers) + 1 if numbers else 0
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+class ShardArchiveReader:
+    """
+    Random access to trees in a sharded archive
+
+    Loads index.tsv once; each lookup then seeks to a single gzip member
+    and decompresses only that tree. refresh() reads the rows a writer has
+    appended since.
+    """
+
+    def __init__(self, archive_dir):
+        if not is_shard_archive(archive_dir):
+            raise ValueError(f"{archive_dir} is not a gene tree shard archive")
+        self.archive_dir = archive_dir
+        with open(os.path.join(archive_dir, SHARD_METADATA_FILE), 'r') as f:
+            self.metadata = json.load(f)
+
+        self.genes = {}
+        self.tree_locations = {}
+        self._index_offset = 0
+        self._handles = {}
+        self.refresh()
+
+    def refresh(self):
+        """
+        Read the index rows appended since the index was last read, up to
+        the last complete line. Returns the number of rows read.
+        """
+        index_path = os.path.join(self.archive_dir, SHARD_INDEX_FILE)
+        rows = 0
+        with open(index_path, 'rb') as f:
+            f.seek(self._index_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # Still being written; read it again next time
+                    break
+                parts = next(csv.reader([line.decode('utf-8')], delimiter='\t'), None)
+                if self._index_offset == 0:
+                    if parts != SHARD_INDEX_FIELDS:
+                        logging.warning(f"Unexpected shard index header in {index_path}: {parts}")
+                        break
+                    self._index_offset = len(line)
+                    continue
+                self._index_offset += len(line)
+                row = _shard_index_row(parts or [])
+                if row is None:
+                    continue
+                # Later rows win so a gene re-fetched after a crash uses its newest entry
+                self.genes[row['gene_id']] = row
+                if row['tree_id'] and row['shard'] and row['tree_id'] not in self.tree_locations:
+                    self.tree_locations[row['tree_id']] = (row['shard'], row['offset'], row['length'])
+                rows += 1
+        return rows
+
+    def _read_location(self, shard, offset, length):
+        handle = self._handles.get(shard)
+        if handle is None:
+            handle = open(os.path.join(self.archive_dir, shard), 'rb')
+            self._handles[shard] = handle
+        handle.seek(offset)
+        return json.loads(gzip.decompress(handle.read(length)))
+
+    def get_tree(self, tree_id):
+        """
+        Return the gene tree JSON for a tree stable ID, or None
+        """
+        location = self.tree_locations.get(tree_id)
+        if location is None:
+            return None
+        return self._read_location(*location)
+
+    def get_tree_for_gene(self, gene_id):
+        """
+        Return the gene tree JSON that was stored for a gene, or None
+        """
+        row = self.genes.get(gene_id)
+        if row is None or not row['shard']:
+            return None
+        return self._read_location(row['shard'], row['offset'], row['length'])
+
+    def gene_status(self, gene_id):
+        row = self.genes.get(gene_id)
+        return row['status'] if row else None
+
+    def iter_trees(self):
+        """
+        Yield (tree_id, gene_tree_info) for every distinct tree in the archive
+        """
+        seen = set()
+        for row in self.genes.values():
+            if not row['shard']:
+                continue
+            key = (row['shard'], row['offset'])
+            if key in seen:
+                continue
+            seen.add(key)
+            yield row['tree_id'], self._read_location(row['shard'], row['offset'], row['length'])
+
+    def close(self):
+        for handle in self._handles.values():
+            handle.close()
+        self._handles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Memory-mapped tree store
+#
+# store.json  - metadata
+# trees.dat   - compact JSON of every distinct tree, back to back
+# trees.idx   - header + records sorted by tree ID: key, offset (u64), length (u64)
+# genes.idx   - header + records sorted by gene ID: key, tree ordinal in trees.idx (u32)
+#
+# Keys are NUL-padded to a fixed width recorded in the header, so lookups are a
+# binary search over fixed-size records of the mapped index.
+
+STORE_FORMAT = 'gene-tree-store'
+STORE_VERSION = 1
+STORE_METADATA_FILE = 'store.json'
+STORE_DATA_FILE = 'trees.dat'
+STORE_TREE_INDEX_FILE = 'trees.idx'
+STORE_GENE_INDEX_FILE = 'genes.idx'
+_TREE_INDEX_MAGIC = b'GTSTREE1'
+_GENE_INDEX_MAGIC = b'GTSGENE1'
+_INDEX_HEADER = struct.Struct('<8sIQ')
+_TREE_LOCATION = struct.Struct('<QQ')
+_TREE_ORDINAL = struct.Struct('<I')
+
+def is_tree_store(path):
+    """
+    Check whether a directory holds a memory-mapped gene tree store
+    """
+    return os.path.isfile(os.path.join(path, STORE_METADATA_FILE)) and \
+        os.path.isfile(os.path.join(path, STORE_TREE_INDEX_FILE))
+
+def iter_per_file_trees(output_dir):
+    """
+    Yield (tree_id, gene_tree_info) from a per-gene file directory
+    """
+    for name in sorted(os.listdir(output_dir)):
+        if not name.endswith('_gene_tree.json'):
+            continue
+        path = os.path.join(output_dir, name)
+        try:
+            with open(path, 'r') as f:
+                gene_tree_info = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f"Skipping unreadable gene tree file {path}: {e}")
+            continue
+        if isinstance(gene_tree_info, dict) and 'tree' in gene_tree_info:
+            yield gene_tree_info.get('id') or '', gene_tree_info
+
+def iter_stored_trees(path):
+    """
+    Yield (tree_id, gene_tree_info) from any supported output location:
+    a tree store, a shard archive or a per-gene file directory
+    """
+    if is_tree_store(path):
+        with TreeStore(path) as store:
+            yield from store.iter_trees()
+    elif is_shard_archive(path):
+        with ShardArchiveReader(path) as reader:
+            yield from reader.iter_trees()
+    else:
+        yield from iter_per_file_trees(path)
+
+def tree_member_ids(gene_tree_info):
+    """
+    Gene stable IDs of all leaves of a gene tree
+    """
+    return [leaf.gene_id for leaf in summarize_gene_tree(gene_tree_info).leaves if leaf.gene_id]
+
+def _write_index(path, magic, records, key_width, value_struct):
+    with open(path, 'wb') as f:
+        f.write(_INDEX_HEADER.pack(magic, key_width, len(records)))
+        for key, value in records:
+            f.write(key.ljust(key_width, b'\0'))
+            f.write(value_struct.pack(*value))
+
+def build_tree_store(sources, store_dir):
+    """
+    Build a memory-mapped tree store from shard archives, per-file
+    directories or other stores. Trees are deduplicated by stable ID.
+    Returns (tree_count, gene_count).
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    tree_locations = {}
+    gene_trees = {}
+
+    data_path = os.path.join(store_dir, STORE_DATA_FILE)
+    with open(data_path + '.tmp', 'wb') as data_file:
+        offset = 0
+        for source in sources:
+            for tree_id, gene_tree_info in iter_stored_trees(source):
+                if not tree_id:
+                    logging.warning(f"Skipping gene tree without stable ID in {source}")
+                    continue
+                if tree_id in tree_locations:
+                    continue
+                payload = json.dumps(gene_tree_info, separators=(',', ':')).encode('utf-8')
+                data_file.write(payload)
+                tree_locations[tree_id] = (offset, len(payload))
+                offset += len(payload)
+                for gene_id in tree_member_ids(gene_tree_info):
+                    gene_trees.setdefault(gene_id, tree_id)
+            if is_shard_archive(source):
+                # Queried genes are leaves too, but keep any that are not
+                for row in read_shard_index(source):
+                    if row['tree_id'] in tree_locations:
+                        gene_trees.setdefault(row['gene_id'], row['tree_id'])
+
+    tree_keys = sorted(tree_locations)
+    tree_ordinals = {tree_id: i for i, tree_id in enumerate(tree_keys)}
+    tree_records = [(k.encode('utf-8'), tree_locations[k]) for k in tree_keys]
+    gene_records = sorted((g.encode('utf-8'), (tree_ordinals[t],)) for g, t in gene_trees.items())
+    tree_key_width = max((len(k) for k, _ in tree_records), default=1)
+    gene_key_width = max((len(k) for k, _ in gene_records), default=1)
+
+    _write_index(os.path.join(store_dir, STORE_TREE_INDEX_FILE) + '.tmp', _TREE_INDEX_MAGIC,
+                 tree_records, tree_key_width, _TREE_LOCATION)
+    _write_index(os.path.join(store_dir, STORE_GENE_INDEX_FILE) + '.tmp', _GENE_INDEX_MAGIC,
+                 gene_records, gene_key_width, _TREE_ORDINAL)
+    for name in (STORE_DATA_FILE, STORE_TREE_INDEX_FILE, STORE_GENE_INDEX_FILE):
+        path = os.path.join(store_dir, name)
+        os.replace(path + '.tmp', path)
+
+    with open(os.path.join(store_dir, STORE_METADATA_FILE), 'w') as f:
+        json.dump({
+            'format': STORE_FORMAT,
+            'version': STORE_VERSION,
+            'trees': len(tree_records),
+            'genes': len(gene_records),
+            'sources': [os.path.abspath(s) for s in sources]
+        }, f, indent=2)
+
+    logging.info(f"Built tree store {store_dir}: {len(tree_records)} trees, {len(gene_records)} genes")
+    return len(tree_records), len(gene_records)
+
+class _MappedIndex:
+    """
+    Sorted fixed-width key index inside a memory-mapped file
+    """
+
+    def __init__(self, path, magic, value_struct):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.path.getsize(path) > _INDEX_HEADER.size else None
+        header = self._map[:_INDEX_HEADER.size] if self._map else self._read_header()
+        found_magic, self.key_width, self.count = _INDEX_HEADER.unpack(header)
+        if found_magic != magic:
+            raise ValueError(f"{path} is not a gene tree store index")
+        self.value_struct = value_struct
+        self.record_size = self.key_width + value_struct.size
+
+    def _read_header(self):
+        self._file.seek(0)
+        return self._file.read(_INDEX_HEADER.size)
+
+    def _record_offset(self, i):
+        return _INDEX_HEADER.size + i * self.record_size
+
+    def key_at(self, i):
+        start = self._record_offset(i)
+        return self._map[start:start + self.key_width].rstrip(b'\0')
+
+    def value_at(self, i):
+        return self.value_struct.unpack_from(self._map, self._record_offset(i) + self.key_width)
+
+    def find(self, key):
+        """
+        Binary search for a key; returns its record number or -1
+        """
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        if len(key) > self.key_width or not self.count:
+            return -1
+        padded = key.ljust(self.key_width, b'\0')
+        width = self.key_width
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._record_offset(mid)
+            if self._map[start:start + width] < padded:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            start = self._record_offset(lo)
+            if self._map[start:start + width] == padded:
+                return lo
+        return -1
+
+    def close(self):
+        if self._map:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+class TreeStore:
+    """
+    Read-only random access to a memory-mapped gene tree store
+
+    Opening maps the index and data files without reading them; each lookup
+    touches only the index pages on its search path and the bytes of the
+    tree it returns.
+    """
+
+    def __init__(self, store_dir):
+        if not is_tree_store(store_dir):
+            raise ValueError(f"{store_dir} is not a gene tree store")
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, STORE_METADATA_FILE), 'r') as f:
+            self.metadata = json.load(f)
+        self._trees = _MappedIndex(os.path.join(store_dir, STORE_TREE_INDEX_FILE), _TREE_INDEX_MAGIC, _TREE_LOCATION)
+        self._genes = _MappedIndex(os.path.join(store_dir, STORE_GENE_INDEX_FILE), _GENE_INDEX_MAGIC, _TREE_ORDINAL)
+        data_path = os.path.join(store_dir, STORE_DATA_FILE)
+        self._data_file = open(data_path, 'rb')
+        self._data = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.path.getsize(data_path) else None
+        self._view = memoryview(self._data) if self._data else memoryview(b'')
+
+    def __len__(self):
+        return self._trees.count
+
+    def __contains__(self, tree_id):
+        return self._trees.find(tree_id) >= 0
+
+    def tree_id_for_gene(self, gene_id):
+        """
+        Stable ID of the tree a gene belongs to, or None
+        """
+        i = self._genes.find(gene_id)
+        if i < 0:
+            return None
+        return self._trees.key_at(self._genes.value_at(i)[0]).decode('utf-8')
+
+    def _raw_at(self, ordinal):
+        offset, length = self._trees.value_at(ordinal)
+        return self._view[offset:offset + length]
+
+    def get_tree_bytes(self, tree_id):
+        """
+        Zero-copy memoryview of a tree's JSON, or None. The view stays valid
+        after close(); call its release() to unmap the data sooner.
+        """
+        i = self._trees.find(tree_id)
+        if i < 0:
+            return None
+        return self._raw_at(i)
+
+    def get_tree(self, tree_id):
+        """
+        Parsed gene tree JSON for a tree stable ID, or None
+        """
+        raw = self.get_tree_bytes(tree_id)
+        return json.loads(bytes(raw)) if raw is not None else None
+
+    def get_tree_for_gene(self, gene_id):
+        """
+        Parsed gene tree JSON of the tree containing a gene, or None
+        """
+        i = self._genes.find(gene_id)
+        if i < 0:
+            return None
+        return json.loads(bytes(self._raw_at(self._genes.value_at(i)[0])))
+
+    def tree_ids(self):
+        for i in range(self._trees.count):
+            yield self._trees.key_at(i).decode('utf-8')
+
+    def iter_trees(self):
+        """
+        Yield (tree_id, gene_tree_info) in tree ID order
+        """
+        for i in range(self._trees.count):
+            yield self._trees.key_at(i).decode('utf-8'), json.loads(bytes(self._raw_at(i)))
+
+    def close(self):
+        """
+        Close the store. Views from get_tree_bytes that are still alive keep
+        the data mapped until they are garbage collected.
+        """
+        try:
+            self._view.release()
+            if self._data:
+                self._data.close()
+        except BufferError:
+            # A view from get_tree_bytes is still referenced; the mapping
+            # goes away with it
+            pass
+        self._data = None
+        self._data_file.close()
+        self._trees.close()
+        self._genes.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def parse_arguments():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Build and query gene tree stores")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help="Build a memory-mapped tree store from downloaded trees")
+    build.add_argument("store_dir", help="Directory to write the store to")
+    build.add_argument("sources", nargs='+',
+                       help="Species output directories (per-file or shard layout) or other stores")
+
+    lookup = subparsers.add_parser('lookup', help="Print the tree containing a gene")
+    lookup.add_argument("store_dir", help="Tree store directory")
+    lookup.add_argument("gene_ids", nargs='+', help="Gene stable IDs")
+    return parser.parse_args()
+
+def main():
+    """Main function"""
+    args = parse_arguments()
+    if args.command == 'build':
+        tree_count, gene_count = build_tree_store(args.sources, args.store_dir)
+        print(f"Tree store {args.store_dir} written: {tree_count} trees, {gene_count} genes")
+    elif args.command == 'lookup':
+        with TreeStore(args.store_dir) as store:
+            for gene_id in args.gene_ids:
+                tree_id = store.tree_id_for_gene(gene_id)
+                print(f"{gene_id}\t{tree_id or 'Not Found'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Gene Tree Traversal
+
+Single-pass, explicit-stack traversal of the nested gene tree JSON returned
+by the Ensembl /genetree endpoints. Safe for trees of any depth (no
+recursion) and collects everything the rest of the tools need from a tree
+in one walk: leaves, taxonomy IDs, species names, node types and depths.
+"""
+
+from collections import namedtuple
+
+# One leaf of a gene tree: gene stable ID, protein (sequence) ID, display
+# name, NCBI taxonomy ID, scientific name and depth below the root
+TreeLeaf = namedtuple('TreeLeaf', ['gene_id', 'protein_id', 'gene_name', 'taxon_id', 'species', 'depth'])
+
+class TreeSummary:
+    """
+    Everything collected from one traversal of a gene tree
+    """
+    __slots__ = ('leaves', 'taxon_ids', 'species', 'node_types', 'node_count', 'max_depth')
+
+    def __init__(self):
+        self.leaves = []
+        self.taxon_ids = set()
+        self.species = set()
+        self.node_types = {}
+        self.node_count = 0
+        self.max_depth = 0
+
+    @property
+    def leaf_count(self):
+        return len(self.leaves)
+
+    @property
+    def duplication_count(self):
+        return self.node_types.get('duplication', 0)
+
+def node_accession(value):
+    # Ensembl writes IDs either as a plain string or as {"accession": ..., "source": ...}
+    if isinstance(value, dict):
+        return value.get('accession')
+    if isinstance(value, list):
+        return node_accession(value[0]) if value else None
+    return value
+
+def get_tree_root(gene_tree_info):
+    """
+    Root node of a /genetree response (a dict, or a list holding one)
+    """
+    if isinstance(gene_tree_info, list):
+        gene_tree_info = gene_tree_info[0] if gene_tree_info else None
+    if isinstance(gene_tree_info, dict):
+        return gene_tree_info.get('tree', gene_tree_info)
+    return None
+
+def walk_gene_tree(tree_node, collect_leaves=True):
+    """
+    Traverse a gene tree node iteratively and return a TreeSummary
+
+    Species come from each leaf's taxonomy block, not from sequence names.
+    Leaves are collected in left-to-right order.
+    """
+    summary = TreeSummary()
+    if not isinstance(tree_node, dict):
+        return summary
+
+    leaves = summary.leaves
+    taxon_ids = summary.taxon_ids
+    species = summary.species
+    node_types = summary.node_types
+    node_count = 0
+    max_depth = 0
+
+    stack = [(tree_node, 0)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node, depth = pop()
+        node_count += 1
+        if depth > max_depth:
+            max_depth = depth
+
+        children = node.get('children')
+        if children:
+            events = node.get('events')
+            node_type = events.get('type', 'unknown') if events else 'unknown'
+            node_types[node_type] = node_types.get(node_type, 0) + 1
+            child_depth = depth + 1
+            # Reverse so the leftmost child is visited first
+            for child in reversed(children):
+                if isinstance(child, dict):
+                    push((child, child_depth))
+            continue
+
+        node_types['leaf'] = node_types.get('leaf', 0) + 1
+        taxonomy = node.get('taxonomy') or {}
+        taxon_id = taxonomy.get('id')
+        scientific_name = taxonomy.get('scientific_name')
+        if taxon_id is not None:
+            taxon_ids.add(taxon_id)
+        if scientific_name:
+            species.add(scientific_name)
+        if not collect_leaves:
+            continue
+
+        gene_member = node.get('gene_member') or {}
+        sequence = node.get('sequence') or {}
+        gene_id = node_accession(node.get('id')) or gene_member.get('stable_id')
+        gene_name = gene_member.get('display_name') or sequence.get('name') or gene_id
+        leaves.append(TreeLeaf(gene_id, node_accession(sequence.get('id')), gene_name,
+                               taxon_id, scientific_name, depth))
+
+    summary.node_count = node_count
+    summary.max_depth = max_depth
+    return summary
+
+def summarize_gene_tree(gene_tree_info, collect_leaves=True):
+    """
+    walk_gene_tree() over a full /genetree response
+    """
+    return walk_gene_tree(get_tree_root(gene_tree_info), collect_leaves=collect_leaves)
@@ -0,0 +1,236 @@
+"""
+Tests for gene tree lookups, gene selection, checkpoint carry-over and the
+retry queue of ensembl_gene_tree.py
+"""
+
+import argparse
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import ensembl_gene_tree
+from ensembl_gene_tree import (GeneSelection, GeneTreeResolver, GeneTreeUnavailable, RetryQueue, genes_to_process,
+                               parse_region)
+from gene_manifest import GeneManifest, ProcessedGenes
+
+class GeneTreeResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = GeneTreeResolver('Metazoa', 'https://rest.example', stats_file=None)
+        self.outcomes = {}
+        patcher = mock.patch.object(ensembl_gene_tree, 'request_gene_tree', side_effect=self.request)
+        self.requests = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, url, gene_id, timeout=30, transport=None):
+        for endpoint, outcome in self.outcomes.items():
+            if endpoint in url:
+                return outcome
+        return 'missing', None
+
+    def test_outage_does_not_disable_strategies(self):
+        self.outcomes = {'/member/': ('failed', None)}
+        for number in range(3 * ensembl_gene_tree.STRATEGY_MIN_ATTEMPTS):
+            with self.assertRaises(GeneTreeUnavailable):
+                self.resolver.resolve(f"G{number}", f"sym{number}", 'daphnia_pulex')
+
+        self.outcomes = {'/member/id/': ('found', {'id': 'GT1'})}
+        self.assertEqual(self.resolver.resolve('G1', 'sym1', 'daphnia_pulex'), ({'id': 'GT1'}, 'metazoa'))
+        self.assertEqual(len(self.resolver.ordered_strategies()), 3)
+
+    def test_rejected_strategy_is_disabled_then_reprobed(self):
+        self.outcomes = {'pan_homology': ('rejected', None), '/member/symbol/': ('unknown', None),
+                         '/member/id/': ('unknown', None)}
+        for number in range(ensembl_gene_tree.STRATEGY_MIN_ATTEMPTS):
+            self.resolver.resolve(f"G{number}", f"sym{number}", 'daphnia_pulex')
+        self.assertTrue(self.resolver.is_disabled('pan_member_id'))
+        self.assertFalse(self.resolver.is_disabled('member_id'))
+
+        self.resolver.stats['pan_member_id']['disabled_at'] -= ensembl_gene_tree.STRATEGY_REPROBE_SECONDS
+        self.assertFalse(self.resolver.is_disabled('pan_member_id'))
+        self.outcomes['pan_homology'] = ('found', {'id': 'GT2'})
+        self.assertEqual(self.resolver.resolve('G2', 'sym2', 'daphnia_pulex'), ({'id': 'GT2'}, 'pan_homology'))
+        self.assertNotIn('disabled_at', self.resolver.stats['pan_member_id'])
+
+    def test_authoritative_strategy_is_never_disabled(self):
+        self.outcomes = {'/member/': ('rejected', None)}
+        for number in range(2 * ensembl_gene_tree.STRATEGY_MIN_ATTEMPTS):
+            self.resolver.resolve(f"G{number}", f"sym{number}", 'daphnia_pulex')
+        self.assertEqual([entry[0] for entry in self.resolver.ordered_strategies()], ['member_id'])
+
+    def test_no_enabled_strategy_raises(self):
+        with mock.patch.object(self.resolver, 'ordered_strategies', return_value=[]):
+            with self.assertRaises(GeneTreeUnavailable):
+                self.resolver.resolve('G1', 'sym1', 'daphnia_pulex')
+        self.requests.assert_not_called()
+
+class ParseRegionTest(unittest.TestCase):
+
+    def test_whole_chromosome(self):
+        self.assertEqual(parse_region('2L'), ('2L', None, None))
+
+    def test_span_with_thousands_separators(self):
+        self.assertEqual(parse_region('scaffold_12:1,000-25,000'), ('scaffold_12', 1000, 25000))
+
+    def test_colon_in_name_without_span(self):
+        self.assertEqual(parse_region('chrUn:random'), ('chrUn:random', None, None))
+
+    def test_reversed_span_is_rejected(self):
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_region('X:500-100')
+
+class GeneSelectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manifest = GeneManifest(['chromosome', 'start', 'end'])
+        for number, (symbol, chromosome, start, end) in enumerate([
+                ('Hox1', '2L', 100, 200), ('hox2', '2L', 300, 400), ('Wnt4', '2R', 100, 200),
+                ('Abd-B', 'X', 1000, 5000), ('wnt7', 'X', 9000, 9500)]):
+            self.manifest.append({'gene_id': f"G{number}", 'gene_symbol': symbol, 'chromosome': chromosome,
+                                  'start': str(start), 'end': str(end)})
+
+    def selected(self, **filters):
+        return [self.manifest.gene_ids[index] for index in GeneSelection(**filters).select(self.manifest)]
+
+    def test_gene_ids(self):
+        self.assertEqual(self.selected(gene_ids=['G3', 'G1', 'G9']), ['G1', 'G3'])
+
+    def test_symbols_ignore_case(self):
+        self.assertEqual(self.selected(symbols=['HOX1', 'Hox2']), ['G0', 'G1'])
+
+    def test_symbol_regex(self):
+        self.assertEqual(self.selected(symbol_regex='^[Ww]nt'), ['G2', 'G4'])
+
+    def test_whole_chromosome_region(self):
+        self.assertEqual(self.selected(regions=[parse_region('2L')]), ['G0', 'G1'])
+
+    def test_region_keeps_overlapping_genes(self):
+        self.assertEqual(self.selected(regions=[parse_region('X:4,500-9,000')]), ['G3', 'G4'])
+        self.assertEqual(self.selected(regions=[parse_region('2L:201-299')]), [])
+
+    def test_filters_combine(self):
+        self.assertEqual(self.selected(symbol_regex='(?i)wnt', regions=[parse_region('X')]), ['G4'])
+
+    def test_region_needs_location_columns(self):
+        manifest = GeneManifest()
+        manifest.append({'gene_id': 'G0', 'gene_symbol': 'Hox1'})
+        with self.assertRaises(ValueError):
+            GeneSelection(regions=[parse_region('2L')]).select(manifest)
+
+    def test_sample_is_seeded_and_in_list_order(self):
+        first = self.selected(sample=3, seed=7)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(first, sorted(first, key=lambda gene_id: int(gene_id[1:])))
+        self.assertEqual(self.selected(sample=3, seed=7), first)
+
+    def test_empty_selection_is_false(self):
+        self.assertFalse(GeneSelection())
+
+    def test_shard_splits_the_selected_genes(self):
+        selection = GeneSelection(symbol_regex='(?i)hox|wnt')
+        self.assertEqual(genes_to_process(self.manifest, selection, (0, 2)), [0, 2])
+        self.assertEqual(genes_to_process(self.manifest, selection, (1, 2)), [1, 4])
+
+class GeneListChangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.gene_csv_file = os.path.join(self.work_dir, 'genes.csv')
+        self.checkpoint_file = os.path.join(self.work_dir, 'checkpoint.json')
+
+    def write_gene_list(self, gene_ids):
+        with open(self.gene_csv_file, 'w') as f:
+            f.write('gene_id,gene_symbol\n')
+            f.writelines(f"{gene_id},{gene_id.lower()}\n" for gene_id in gene_ids)
+        return ensembl_gene_tree.read_gene_list(self.gene_csv_file)
+
+    def test_processed_genes_follow_their_ids(self):
+        manifest = self.write_gene_list(['G1', 'G2', 'G3', 'G4'])
+        state = ProcessedGenes(manifest, ['G1', 'G3']).state()
+        ensembl_gene_tree.save_gene_order(manifest, self.checkpoint_file)
+
+        # BioMart returned the list in another order, with one gene gone and one new
+        manifest = self.write_gene_list(['G4', 'G5', 'G3', 'G2'])
+        processed = ensembl_gene_tree.restore_processed_genes(manifest, set(), state, self.gene_csv_file,
+                                                              self.checkpoint_file)
+        self.assertEqual([manifest.gene_ids[index] for index in processed.pending()], ['G4', 'G5', 'G2'])
+        self.assertIn('G1', processed.others)
+
+    def test_without_saved_order_nothing_is_carried_over(self):
+        manifest = self.write_gene_list(['G1', 'G2', 'G3'])
+        state = ProcessedGenes(manifest, ['G1', 'G3']).state()
+        manifest = self.write_gene_list(['G3', 'G2', 'G1'])
+        processed = ensembl_gene_tree.restore_processed_genes(manifest, set(), state, self.gene_csv_file,
+                                                              self.checkpoint_file)
+        self.assertEqual(len(processed), 0)
+
+class RetryQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = RetryQueue(max_attempts=3, base_delay=10, max_delay=25)
+        self.gene = {'gene_id': 'G1', 'gene_symbol': 'sym1', 'description': 'kinase'}
+
+    def test_backoff_doubles_up_to_the_limit(self):
+        queue = RetryQueue(max_attempts=10, base_delay=10, max_delay=25)
+        delays = []
+        for _ in range(4):
+            with mock.patch('time.time', return_value=1000.0):
+                queue.fail(self.gene, 1, RuntimeError('boom'))
+            delays.append(queue.entries['G1']['next_attempt'] - 1000.0)
+        self.assertEqual(delays, [10, 20, 25, 25])
+
+    def test_defaults_are_read_when_the_queue_is_made(self):
+        with mock.patch.object(ensembl_gene_tree, 'RETRY_BASE_DELAY', 0.5), \
+                mock.patch.object(ensembl_gene_tree, 'MAX_GENE_ATTEMPTS', 2):
+            queue = RetryQueue()
+        self.assertEqual((queue.base_delay, queue.max_attempts), (0.5, 2))
+
+    def test_attempt_limit_moves_the_gene_to_the_dead_letters(self):
+        self.assertTrue(self.queue.fail(self.gene, 1, RuntimeError('first')))
+        self.assertTrue(self.queue.fail(self.gene, 1, RuntimeError('second')))
+        self.assertFalse(self.queue.fail(self.gene, 1, RuntimeError('third')))
+        self.assertEqual(len(self.queue), 0)
+        [dead] = self.queue.dead_letters
+        self.assertEqual((dead['gene_id'], dead['attempts'], dead['error']), ('G1', 3, 'RuntimeError: third'))
+
+    def test_uncounted_failure_keeps_its_attempts(self):
+        self.queue.fail(self.gene, 1, RuntimeError('boom'))
+        for _ in range(5):
+            self.assertTrue(self.queue.fail(self.gene, 1, ConnectionError('circuit open'), count_attempt=False))
+        self.assertEqual(self.queue.entries['G1']['attempts'], 1)
+        self.assertEqual(self.queue.dead_letters, [])
+
+    def test_due_hands_back_the_whole_gene_once(self):
+        self.queue.fail(self.gene, 7, RuntimeError('boom'))
+        self.assertEqual(self.queue.due(now=self.queue.next_attempt() - 1), [])
+        due = self.queue.due(now=self.queue.next_attempt())
+        self.assertEqual(due, [(7, self.gene)])
+        self.assertEqual(self.queue.due(now=float('inf')), [])
+        self.assertIsNone(self.queue.next_attempt())
+
+    def test_in_flight_retries_are_due_again_after_a_restart(self):
+        self.queue.fail(self.gene, 7, RuntimeError('boom'))
+        self.queue.due(now=float('inf'))
+        restarted = RetryQueue(self.queue.to_dict(), max_attempts=3)
+        self.assertEqual(restarted.due(now=float('inf')), [(7, self.gene)])
+
+    def test_dead_letter_report(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        for _ in range(3):
+            self.queue.fail(self.gene, 1, RuntimeError('boom'))
+        report_file = ensembl_gene_tree.write_dead_letter_report(work_dir, self.queue.dead_letters)
+        ensembl_gene_tree.write_dead_letter_report(work_dir, [{'gene_id': 'G2', 'gene_symbol': 'sym2',
+                                                               'attempts': 3, 'error': 'x'}])
+        with open(report_file, newline='') as f:
+            rows = list(csv.DictReader(f, delimiter='\t'))
+        self.assertEqual([(row['gene_id'], row['attempts'], row['error']) for row in rows],
+                         [('G1', '3', 'RuntimeError: boom'), ('G2', '3', 'x')])
+        self.assertIsNone(ensembl_gene_tree.write_dead_letter_report(work_dir, []))
+
+if __name__ == '__main__':
+    unittest.main()
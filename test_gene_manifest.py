@@ -0,0 +1,78 @@
+"""
+Tests for the gene manifest and the processed-gene bitmap
+"""
+
+import unittest
+
+from gene_manifest import GeneBitmap, GeneManifest, ProcessedGenes
+
+def manifest_of(gene_ids):
+    manifest = GeneManifest()
+    for gene_id in gene_ids:
+        manifest.append({'gene_id': gene_id, 'gene_symbol': gene_id.lower()})
+    return manifest
+
+class GeneBitmapTest(unittest.TestCase):
+
+    def test_encode_round_trip(self):
+        bitmap = GeneBitmap(20)
+        for index in (0, 7, 8, 19):
+            bitmap.add(index)
+        decoded = GeneBitmap.decode(20, bitmap.encode())
+        self.assertEqual(list(decoded.iter_set()), [0, 7, 8, 19])
+        self.assertEqual(decoded.count(), 4)
+
+    def test_decode_rejects_other_size(self):
+        with self.assertRaises(ValueError):
+            GeneBitmap.decode(100, GeneBitmap(20).encode())
+
+    def test_iter_clear_skips_full_bytes(self):
+        bitmap = GeneBitmap(20)
+        for index in range(17):
+            bitmap.add(index)
+        self.assertEqual(list(bitmap.iter_clear()), [17, 18, 19])
+
+class ProcessedGenesRestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.old_ids = ['G1', 'G2', 'G3', 'G4', 'G5']
+        processed = ProcessedGenes(manifest_of(self.old_ids), ['G2', 'G4', 'G5'])
+        self.state = processed.state()
+
+    def test_same_gene_list_restores_by_digest(self):
+        processed = ProcessedGenes(manifest_of(self.old_ids))
+        self.assertTrue(processed.restore(self.state))
+        self.assertEqual(sorted(processed), ['G2', 'G4', 'G5'])
+        self.assertEqual(processed.in_manifest(), 3)
+
+    def test_restore_keeps_genes_added_before(self):
+        processed = ProcessedGenes(manifest_of(self.old_ids), ['G1'])
+        self.assertTrue(processed.restore(self.state))
+        self.assertEqual(sorted(processed), ['G1', 'G2', 'G4', 'G5'])
+
+    def test_changed_gene_list_without_saved_order_is_not_restored(self):
+        processed = ProcessedGenes(manifest_of(['G5', 'G4', 'G3', 'G2', 'G1']))
+        self.assertFalse(processed.restore(self.state))
+        self.assertEqual(len(processed), 0)
+
+    def test_reordered_gene_list_restores_by_saved_order(self):
+        processed = ProcessedGenes(manifest_of(['G5', 'G4', 'G3', 'G2', 'G1']))
+        self.assertTrue(processed.restore(self.state, self.old_ids))
+        self.assertEqual(sorted(processed), ['G2', 'G4', 'G5'])
+        self.assertEqual(list(processed.pending()), [2, 4])
+
+    def test_genes_dropped_from_the_list_are_kept_as_others(self):
+        processed = ProcessedGenes(manifest_of(['G1', 'G2', 'G3', 'G6']))
+        self.assertTrue(processed.restore(self.state, self.old_ids))
+        self.assertIn('G2', processed)
+        self.assertNotIn('G6', processed)
+        self.assertEqual(processed.in_manifest(), 1)
+        self.assertEqual(processed.others, {'G4', 'G5'})
+
+    def test_saved_order_not_matching_the_state_is_rejected(self):
+        processed = ProcessedGenes(manifest_of(['G1', 'G2', 'G3']))
+        self.assertFalse(processed.restore(self.state, ['G1', 'G2', 'G3', 'G5', 'G4']))
+        self.assertEqual(len(processed), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+"""
+Tests for the library interface of gene_tree_client.py
+"""
+
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+import ensembl_gene_tree
+from gene_tree_client import GeneTreeClient
+
+class GeneTreeClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = GeneTreeClient(division='Metazoa', transport=mock.Mock())
+        self.addCleanup(self.client.close)
+        self.client._species['Daphnia pulex'] = {'api_key': 'Metazoa', 'rest_url': 'https://rest.example'}
+
+    def test_fetch_tree_prints_nothing(self):
+        self.client.transport.get.return_value = mock.Mock(status_code=400, text='Gene G1 is not in a gene tree')
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result = self.client.fetch_tree('G1', 'sym1', 'Daphnia pulex')
+        self.assertIsNone(result.error)
+        self.assertIsNone(result.gene_tree_info)
+        self.assertEqual(output.getvalue(), '')
+
+    def test_registry_cache_belongs_to_the_client(self):
+        registry = ('metazoa_mart', 'metazoa_mart', [{'name': 'dpulex_eg_gene', 'displayName': 'Daphnia pulex'}])
+        url = 'https://mart.example?type=registry'
+        self.client.transport.preferred_url.return_value = 'https://mart.example'
+        self.client._registries[url] = registry
+        self.assertEqual(ensembl_gene_tree.get_registry_info('Metazoa', self.client.transport,
+                                                             self.client._registries), registry)
+        self.assertNotIn(url, ensembl_gene_tree._registry_cache)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+Tests for the memory-mapped gene tree store
+"""
+
+import shutil
+import tempfile
+import unittest
+
+from gene_tree_store import PerFileTreeWriter, ShardArchiveReader, TreeStore, build_tree_store, open_tree_writer
+
+class TreeStoreCloseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        source_dir = f"{self.work_dir}/trees"
+        writer = PerFileTreeWriter(source_dir)
+        writer.write_tree('G1', 'sym1', 'daphnia_pulex',
+                          {'id': 'GT1', 'tree': {'id': {'accession': 'G1'}, 'children': []}}, [])
+        self.store_dir = f"{self.work_dir}/store"
+        build_tree_store([source_dir], self.store_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_close_while_view_is_held(self):
+        with TreeStore(self.store_dir) as store:
+            raw = store.get_tree_bytes('GT1')
+        # The view outlives the store and still reads the tree
+        self.assertTrue(bytes(raw).startswith(b'{"id":"GT1"'))
+        raw.release()
+
+    def test_close_after_view_is_released(self):
+        store = TreeStore(self.store_dir)
+        raw = store.get_tree_bytes('GT1')
+        raw.release()
+        store.close()
+        self.assertIsNone(store._data)
+
+class ShardArchiveRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.writer = open_tree_writer(self.work_dir, 'shards', species_name='daphnia_pulex')
+        self.writer.write_tree('G1', 'sym1', 'daphnia_pulex', {'id': 'GT1', 'tree': {}}, [])
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.work_dir)
+
+    def test_refresh_reads_appended_rows(self):
+        with ShardArchiveReader(self.work_dir) as reader:
+            self.writer.write_tree('G2', 'sym2', 'daphnia_pulex', {'id': 'GT2', 'tree': {}}, [])
+            self.assertIsNone(reader.get_tree('GT2'))
+            self.assertEqual(reader.refresh(), 1)
+            self.assertEqual(reader.get_tree('GT2')['id'], 'GT2')
+            self.assertEqual(reader.refresh(), 0)
+
+    def test_refresh_leaves_a_partial_line(self):
+        with ShardArchiveReader(self.work_dir) as reader:
+            self.writer.write_no_tree('G2', 'sym2', 'daphnia_pulex')
+            with open(f"{self.work_dir}/index.tsv", 'a') as f:
+                f.write('G3\tsym3\tno_tree')
+            self.assertEqual(reader.refresh(), 1)
+            with open(f"{self.work_dir}/index.tsv", 'a') as f:
+                f.write('\t\t\t\t\t\n')
+            self.assertEqual(reader.refresh(), 1)
+            self.assertEqual(reader.gene_status('G3'), 'no_tree')
+
+if __name__ == '__main__':
+    unittest.main()